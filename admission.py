@@ -0,0 +1,122 @@
+"""Per-user admission control of the command handlers, `admission` section of config.json
+
+  "admission": {
+    "rate": 1.0,                // tokens every user gets per second ...
+    "burst": 20,                // ... up to this many
+    "costs": {"tasks": 5, "find": 3},   // tokens per command, others cost 1
+    "max_concurrent": 8,        // handlers running at once for all users
+    "wait": 2.0                 // seconds to wait for a free slot
+  }
+
+Without the section there is no admission control, with it the values
+above are the defaults.
+
+A command over the user's budget is rejected with a short reply instead
+of loading the db. An expensive command (cost > 1) arriving while an
+identical one of the user, with the same arguments, still runs is
+coalesced into it, the running one's answer is the answer to both. When
+all `max_concurrent` slots stay taken for `wait` seconds the command is
+turned away as well.
+"""
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+REJECTED = "Slow down, try again in {}s"
+COALESCED = "Still working on your last /{}"
+BUSY = "Too busy right now, try again in a moment"
+
+DEFAULT_COSTS = {"tasks": 5, "find": 3}
+
+
+class Admission:
+    """Token buckets per user and a limit of concurrently running handlers
+
+    `reply(update, text)` answers turned away updates.
+    """
+
+    def __init__(self, reply, rate=1.0, burst=20, costs=None, max_concurrent=8, wait=2.0,
+                 max_users=10000):
+        self.reply = reply
+        self.rate = rate
+        self.burst = burst
+        self.costs = dict(DEFAULT_COSTS, **(costs or {}))
+        self.wait = wait
+        self.max_users = max_users
+        self.buckets = {}   # user -> (tokens, monotonic time of tokens)
+        self.running = Counter()    # (user, command, text) -> handlers running
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+
+    def admit(self, user, command, text=""):
+        """Takes the tokens of `command` for `user`, `text` is the whole message
+
+        Returns
+        (None, 0) if admitted, else ("coalesced" or "rejected", seconds to wait)
+        """
+        cost = self.costs.get(command, 1)
+        now = time.monotonic()
+        with self.lock:
+            if cost > 1 and self.running[user, command, text]:
+                return "coalesced", 0
+
+            tokens, last = self.buckets.get(user, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < cost:
+                self.buckets[user] = (tokens, now)
+                return "rejected", (cost - tokens) / self.rate
+
+            if len(self.buckets) >= self.max_users and user not in self.buckets:
+                self._prune(now)
+            self.buckets[user] = (tokens - cost, now)
+            self.running[user, command, text] += 1
+        return None, 0
+
+    def release(self, user, command, text="", refund=False):
+        with self.lock:
+            self.running[user, command, text] -= 1
+            if not self.running[user, command, text]:
+                del self.running[user, command, text]
+            if refund and user in self.buckets:
+                tokens, last = self.buckets[user]
+                self.buckets[user] = (min(self.burst, tokens + self.costs.get(command, 1)), last)
+
+    def wrap(self, command, func):
+        """Handler `func` of `command` only called for admitted updates"""
+        @wraps(func)
+        def wrapper(bot, update, *a, **kw):
+            user, text = update.message.from_user.id, update.message.text
+            verdict, wait = self.admit(user, command, text)
+            if verdict:
+                metrics.inc(f"admission_{verdict}_total", command=command)
+                logger.debug("%s /%s of '%s'", verdict.capitalize(), command, user)
+                if verdict == "rejected":
+                    self.reply(update, REJECTED.format(math.ceil(wait)))
+                else:
+                    self.reply(update, COALESCED.format(command))
+                return
+
+            if not self.slots.acquire(timeout=self.wait):
+                self.release(user, command, text, refund=True)
+                metrics.inc("admission_busy_total", command=command)
+                self.reply(update, BUSY)
+                return
+            try:
+                return func(bot, update, *a, **kw)
+            finally:
+                self.slots.release()
+                self.release(user, command, text)
+        return wrapper
+
+    def _prune(self, now):
+        """Forgets users whose bucket is full again, holding `lock`"""
+        for user, (tokens, last) in list(self.buckets.items()):
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self.buckets[user]
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDispatcher:
+    """Runs update callbacks off the telegram dispatcher thread
+
+    Callbacks are queued per user on an asyncio loop running in its own
+    thread. Updates of one user run in the order they arrived, different
+    users run in parallel. The callbacks themselves do blocking storage
+    I/O, so they are executed on a thread pool of `workers` threads and
+    never block the loop or the dispatcher.
+    """
+
+    def __init__(self, workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="aiodispatch")
+        self.loop = asyncio.new_event_loop()
+        self.queues = {}    # user -> deque of pending callbacks
+        self.tasks = set()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name="aiodispatch", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Waits for queued callbacks and stops the loop"""
+        if not self.thread:
+            return
+        future = asyncio.run_coroutine_threadsafe(self.join(), self.loop)
+        future.result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+        self.executor.shutdown()
+
+    def submit(self, user, func, *args):
+        """Queues `func(*args)` behind earlier callbacks of `user`"""
+        self.loop.call_soon_threadsafe(self._enqueue, user, func, args)
+
+    def handler(self, func):
+        """Wraps a `(bot, update)` callback so it returns immediately"""
+        @wraps(func)
+        def wrapper(bot, update):
+            self.submit(update.message.from_user.id, func, bot, update)
+        return wrapper
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    def _enqueue(self, user, func, args):
+        queue = self.queues.get(user)
+        if queue is None:
+            queue = self.queues[user] = deque()
+            task = self.loop.create_task(self._run(user, queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        queue.append((func, args))
+
+    async def _run(self, user, queue):
+        while queue:
+            func, args = queue.popleft()
+            try:
+                await self.loop.run_in_executor(self.executor, func, *args)
+            except Exception:
+                logger.exception("Callback %s failed for '%s'", func.__name__, user)
+        del self.queues[user]
@@ -0,0 +1,251 @@
+"""Cold storage of old days, configured by the `archive` section of config.json
+
+  "archive": {
+    "after_days": 90,           // days older than this are archived
+    "compression": "zlib",      // or "lzma", smaller and slower
+    "path": "archive"
+  }
+
+Without the section nothing is archived.
+
+Every user has an append-only archive file `<path>/<user>.arc` of
+compressed records, each holding the days moved by one archiver run.
+Archived days leave the user's db, so commands don't load them anymore;
+`DBManager.get(day)` and `get_range` still find them. A change to an
+archived day moves it back into the db first, deleting one appends a
+record with the day set to null. Only days before the latest cutoff of
+the archiver, kept in `<path>/before`, are looked up in the archive, so
+misses of recent days (rollover, reminders) don't read it.
+"""
+import json
+import logging
+import lzma
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import metrics
+from dbmanager import DBManager as dbm
+from extras import DATEFORMAT
+from storage import write_file
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct("<BI")   # codec, length of the compressed days
+
+CODECS = {"zlib": (1, lambda data: zlib.compress(data, 9), zlib.decompress),
+          "lzma": (2, lzma.compress, lzma.decompress)}
+DECOMPRESS = {codec: decompress for codec, _, decompress in CODECS.values()}
+
+
+class Archive:
+    """Per-user append-only archives of compressed days in `directory`
+
+    The last `cache_size` archives read are kept decompressed.
+    """
+
+    def __init__(self, directory, compression="zlib", cache_size=16):
+        if compression not in CODECS:
+            raise ValueError(f"Unknown compression '{compression}'")
+        self.directory = directory
+        self.codec, self.compress, _ = CODECS[compression]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # user -> (file size, days, sorted days)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(f"{directory}/before") as f:
+                self.before = f.read().strip()
+        except FileNotFoundError:
+            self.before = ""    # nothing archived yet
+
+    def path(self, user):
+        return f"{self.directory}/{user}.arc"
+
+    def append(self, user, days: dict):
+        """Adds `days` to the archive of `user`, durable when it returns"""
+        data = self.compress(json.dumps(days, separators=(',', ':')).encode())
+        with open(self.path(user), 'a+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            end = _complete(f, size)
+            if end < size: # the new record must not follow a torn one
+                logger.error("Truncating torn archive record of %s after %d bytes", user, end)
+                f.truncate(end)
+                with self.lock: # the cache is only checked by file size
+                    self.cache.pop(user, None)
+            f.write(RECORD.pack(self.codec, len(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+            created = f.tell() == RECORD.size + len(data)
+        metrics.inc("archive_bytes_written_total", RECORD.size + len(data))
+
+        if created: # the days are deleted from the db next, make the file durable
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def advance(self, before):
+        """Allows archiving days before `before`, call before archiving them"""
+        if before > self.before:
+            write_file(f"{self.directory}/before", before.encode(), "dir")
+            self.before = before
+
+    def load(self, user) -> dict:
+        """All archived days of `user`, later records win, deleted days are None"""
+        return self._load(user)[1]
+
+    def _load(self, user):
+        try:
+            size = os.path.getsize(self.path(user))
+        except FileNotFoundError:
+            return 0, {}, []
+
+        with self.lock:
+            cached = self.cache.get(user)
+            if cached and cached[0] == size:
+                self.cache.move_to_end(user)
+                return cached
+
+        days = {}
+        with open(self.path(user), 'rb') as f:
+            data = f.read(size)
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            codec, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + length > len(data): # torn write of the last record
+                break
+            try:
+                days.update(json.loads(DECOMPRESS[codec](data[offset:offset + length])))
+            except (KeyError, ValueError, zlib.error, lzma.LZMAError):
+                logger.error("Damaged archive record of %s at %d bytes", user, offset)
+                break
+            offset += length
+
+        cached = (size, days, sorted(day for day, data in days.items() if data))
+        with self.lock:
+            self.cache[user] = cached
+            self.cache.move_to_end(user)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return cached
+
+    def get(self, user, day):
+        if day >= self.before:
+            return None
+        return self.load(user).get(day)
+
+    def range(self, user, start, end) -> list:
+        """Archived days of `user` from `start` to `end`, both included"""
+        if start >= self.before:
+            return []
+        days = self._load(user)[2]
+        return days[bisect_left(days, start):bisect_right(days, end)]
+
+    def remove(self, user):
+        """Deletes the whole archive of `user`"""
+        try:
+            os.remove(self.path(user))
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.cache.pop(user, None)
+
+    def users(self) -> list:
+        return sorted(name[:-4] for name in os.listdir(self.directory)
+                      if name.endswith(".arc"))
+
+
+def _complete(f, size) -> int:
+    """Size of the complete records at the start of archive file `f`"""
+    offset = 0
+    while offset + RECORD.size <= size:
+        f.seek(offset)
+        _, length = RECORD.unpack(f.read(RECORD.size))
+        if offset + RECORD.size + length > size:
+            break
+        offset += RECORD.size + length
+    return offset
+
+
+def make_archive(archive_config: dict, botdir: str, shard=None):
+    """Archive of the `archive` section of config.json, None without it"""
+    if archive_config is None:
+        return None
+    directory = archive_config.get("path", f"{botdir}/archive")
+    if shard is not None:
+        directory = f"{directory}/shard-{shard}"
+    return Archive(directory, archive_config.get("compression", "zlib"))
+
+
+def archive_user(archive, user, before: str) -> int:
+    """Moves days of `user` older than `before` (YYYY-MM-DD) to `archive`
+
+    The days are stored in the archive before they are deleted from the
+    db, a crash in between leaves them in both, where the db wins.
+
+    Returns number of archived days
+    """
+    with dbm(user) as db:
+        days = db.get_range("", before, archived=False)
+        if days and days[-1] == before:
+            days.pop()
+        if not days:
+            return 0
+
+        archive.append(user, {day: db.get(day) for day in days})
+        db.unload(days)
+    return len(days)
+
+
+def archive_old(archive, today: str, after_days=90) -> dict:
+    """Archives days older than `after_days` before `today` for every user
+
+    Returns summary of the run
+    """
+    before = datetime.strftime(datetime.strptime(today, DATEFORMAT) - timedelta(days=after_days),
+                               DATEFORMAT)
+    archive.advance(before)
+    start = time.perf_counter()
+    users = days = errors = 0
+    for user in dbm.cache.storage.users():
+        try:
+            moved = archive_user(archive, user, before)
+        except Exception:
+            errors += 1
+            logger.exception("Archiving before %s failed for '%s'", before, user)
+            continue
+        users += bool(moved)
+        days += moved
+
+    summary = {"before": before, "users": users, "days": days, "errors": errors,
+               "duration": time.perf_counter() - start}
+    logger.info("Archived days before %s: %s", before, summary)
+    return summary
+
+
+if __name__ == "__main__":
+    # usage: python archive.py [after days]
+    from dbmanager import BOTDIR
+    from storage import make_storage
+
+    with open("config.json") as f:
+        config = json.load(f)
+    archive_config = config.get("archive") or {}
+    after_days = int(sys.argv[1]) if len(sys.argv) > 1 else archive_config.get("after_days", 90)
+
+    dbm.cache.configure(storage=make_storage(config.get("db", {}), BOTDIR),
+                        archive=make_archive(archive_config, BOTDIR))
+    summary = archive_old(dbm.cache.archive, datetime.strftime(datetime.today(), DATEFORMAT),
+                          after_days)
+    dbm.cache.flush(wait=True)
+    print(f"Archived {summary['days']} days of {summary['users']} users "
+          f"in {summary['duration']:.2f}s, {summary['errors']} errors")
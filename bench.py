@@ -0,0 +1,1504 @@
+"""Benchmarks and consistency checks of the bot
+
+usage: python bench.py <scenario> [args...]
+"""
+import http.client
+import importlib
+import json
+import os
+import platform
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+
+from telegram.error import RetryAfter, TimedOut
+from telegram.ext import Dispatcher, JobQueue
+
+from admission import Admission
+from aiodispatch import AsyncDispatcher
+from archive import RECORD, Archive, archive_old
+from dedup import Deduplicator
+from dbmanager import DBManager as dbm
+from extras import DATEFORMAT, DATEREGEX, REGEX
+import commands
+import dates
+import metrics
+import render
+import search
+import shards
+from outbox import Outbox
+from reminders import ALARM, Reminders
+from storage import BinaryStorage, DayStorage, JSONStorage, apply_op, make_storage
+
+DAY = "2019-01-01"
+
+
+def _stress_worker(db_config, worker, iterations):
+    dbm.cache.configure(storage=make_storage(db_config, ""), locking=True)
+    for i in range(iterations):
+        with dbm("stress") as db:
+            db.add(DAY, f"{worker}-{i}")
+
+
+class _FailingStorage:
+    """`storage` whose next `failures` stores raise OSError"""
+
+    def __init__(self, storage, failures=1):
+        self.storage = storage
+        self.failures = failures
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def store(self, user, db, ops=None):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("No space left on device")
+        self.storage.store(user, db, ops)
+
+
+def stress(backend="json", workers="8", iterations="200"):
+    """Concurrent adds for one user from many processes, none may be lost"""
+    workers, iterations = int(workers), int(iterations)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = f"{tmp}/db.sqlite" if backend == "sqlite" else tmp
+        db_config = {"backend": backend, "path": path, "durability": "none"}
+
+        ctx = get_context("fork")
+        procs = [ctx.Process(target=_stress_worker,
+                             args=(db_config, n, iterations))
+                 for n in range(workers)]
+
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        duration = time.perf_counter() - start
+
+        storage = make_storage(db_config, "")
+        tasks = storage.load("stress")[DAY]["tasks"]
+
+        torn = True
+        if backend == "journal":
+            # records stored after a torn one must survive the next load
+            with open(storage.logpath("stress"), "ab") as f:
+                f.write(b'["add", "2019-01-0')
+            db = storage.load("stress")
+            ops = [("add", DAY, {str(len(tasks) + 1): {"text": "after", "done": 0}})]
+            apply_op(db, ops[0])
+            storage.store("stress", db, ops)
+            torn = storage.load("stress") == db
+
+        # a failed store is written again by the next flush, an emptied day stays
+        dbm.cache.configure(storage=_FailingStorage(storage), interval=3600)
+        with dbm("stress") as db:
+            db.add("2019-01-02", ["kept", "gone"])
+            db.add("2019-01-03", "gone")
+            db.delete_many("2019-01-03", [1])
+            wanted = json.loads(json.dumps(dict(db.get())))
+        dbm.cache.flush(wait=True)
+        retried = "stress" in dbm.cache.pending
+        dbm.cache.flush(wait=True)
+        dbm.cache.configure(storage=JSONStorage(tmp, "none"))
+        retried &= json.loads(json.dumps(dict(storage.load("stress")))) == wanted
+
+    expected = workers * iterations
+    texts = {task["text"] for task in tasks.values()}
+    numbers = sorted(int(num) for num in tasks)
+
+    print(f"{backend}: {expected} updates from {workers} processes "
+          f"in {duration:.2f}s ({expected / duration:.0f}/s)")
+    print(f"stored {len(tasks)} tasks, {len(texts)} unique")
+
+    ok = len(texts) == expected and numbers == list(range(1, expected + 1)) and torn
+    if not retried:
+        print("failed store lost")
+    ok &= retried
+    print("OK" if ok else "LOST UPDATES")
+    return ok
+
+
+def _dispatch_handler(user, text, latency):
+    with dbm(user) as db:
+        db.add(DAY, text)
+    time.sleep(latency * random.expovariate(1)) # simulated disk latency
+
+
+def dispatch(updates="2000", users="50", latency_ms="2", workers="8"):
+    """Updates/sec of the thread based dispatcher vs. AsyncDispatcher"""
+    updates, users = int(updates), int(users)
+    latency, workers = float(latency_ms) / 1000, int(workers)
+    load = [(f"u{random.randrange(users)}", f"task {i}") for i in range(updates)]
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            tempfile.TemporaryDirectory() as aiotmp:
+        dbm.cache.configure(storage=JSONStorage(tmp, "none"), interval=0)
+
+        # telegram.ext.Dispatcher runs callbacks one by one in its thread
+        start = time.perf_counter()
+        for user, text in load:
+            _dispatch_handler(user, text, latency)
+        threaded = updates / (time.perf_counter() - start)
+
+        dbm.cache.configure(storage=JSONStorage(aiotmp, "none"))
+        aio = AsyncDispatcher(workers)
+        aio.start()
+        start = time.perf_counter()
+        for user, text in load:
+            aio.submit(user, _dispatch_handler, user, text, latency)
+        aio.stop()
+        asynchronous = updates / (time.perf_counter() - start)
+        dbm.cache.flush()
+
+        # per-user order has to be preserved
+        ordered = True
+        for user in {user for user, _ in load}:
+            tasks = dbm.cache.storage.load(user)[DAY]["tasks"].values()
+            numbers = [int(task["text"].split()[1]) for task in tasks]
+            ordered &= numbers == sorted(numbers)
+
+    print(f"{updates} updates, {users} users, {latency * 1000:.1f}ms latency")
+    print(f"thread dispatcher: {threaded:.0f} updates/s")
+    print(f"async dispatcher:  {asynchronous:.0f} updates/s ({workers} workers)")
+    print("order OK" if ordered else "ORDER BROKEN")
+    return ordered
+
+
+class FakeBot:
+    """Stand-in for `telegram.Bot` enforcing Telegram-like flood limits
+
+    Raises `RetryAfter` when a chat gets more than `chat_limit` or all
+    chats more than `global_limit` messages within one second,
+    `TimedOut` for a `failures` fraction of calls and `ValueError` for
+    the chat ids in `broken`.
+    """
+
+    def __init__(self, chat_limit=3, global_limit=30, failures=0.0, latency=0.0, broken=()):
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.failures = failures
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.chat_recent = defaultdict(deque)
+        self.messages = defaultdict(list)   # chat_id -> delivered texts
+        self.flooded = 0
+        self.broken = set(broken)
+        self.username = "bench_bot"     # CommandHandler matches /cmd@bench_bot
+
+    def send_message(self, chat_id, text, **kw):
+        time.sleep(self.latency)
+        if chat_id in self.broken:
+            raise ValueError(f"unexpected error for chat {chat_id}")
+        with self.lock:
+            now = time.monotonic()
+            for window in (self.recent, self.chat_recent[chat_id]):
+                while window and window[0] <= now - 1:
+                    window.popleft()
+            if len(self.recent) >= self.global_limit or \
+                    len(self.chat_recent[chat_id]) >= self.chat_limit:
+                self.flooded += 1
+                raise RetryAfter(1)
+            if random.random() < self.failures:
+                raise TimedOut()
+            self.recent.append(now)
+            self.chat_recent[chat_id].append(now)
+            self.messages[chat_id].append(text)
+
+
+def outbox(messages="100", chats="20", failures="0.02"):
+    """Bursty replies through Outbox against a flood limited FakeBot
+
+    One message goes to a chat whose sends raise an unexpected error,
+    the rest must still be delivered.
+    """
+    messages, chats, failures = int(messages), int(chats), float(failures)
+    bot = FakeBot(failures=failures, latency=0.002, broken=(-1,))
+    box = Outbox(bot, global_rate=20, global_burst=5, chat_rate=1,
+                 chat_burst=1, backoff=0.05)
+    box.start()
+
+    start = time.perf_counter()
+    box.send(-1, "broken")
+    for i in range(messages):
+        box.send(random.randrange(chats), str(i))
+    enqueue = time.perf_counter() - start
+    depth = box.stats()["depth"]
+    box.stop(timeout=messages)
+    duration = time.perf_counter() - start
+    stats = box.stats()
+
+    delivered = sum(len(texts) for texts in bot.messages.values())
+    ordered = all([int(t) for t in texts] == sorted(int(t) for t in texts)
+                  for texts in bot.messages.values())
+
+    print(f"queued {messages} messages for {chats} chats in {enqueue * 1000:.1f}ms "
+          f"(peak depth {depth})")
+    print(f"delivered {delivered} in {duration:.1f}s, {bot.flooded} flood errors, "
+          f"{stats['retried']} retries, {stats['failed']} failed")
+    print(f"send latency avg {stats['latency_avg']:.2f}s "
+          f"max {stats['latency_max']:.2f}s")
+    ok = delivered + stats["failed"] == messages + 1 and ordered and not bot.flooded
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+def _history(days, tasks=5):
+    """Synthetic user db with `days` consecutive days of tasks"""
+    first = datetime(2000, 1, 1)
+    return {datetime.strftime(first + timedelta(days=n), DATEFORMAT):
+            {"tasks": {str(i): {"text": f"task number {i} of day {n}", "done": i % 2}
+                       for i in range(1, tasks + 1)}}
+            for n in range(days)}
+
+
+def _cold_get(storage, user, day, repeat):
+    """Average ms of loading `user` and getting `day` with an empty cache"""
+    dbm.cache.configure(storage=storage)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        dbm.cache.configure(storage=storage)  # drops cached dbs
+        with dbm(user) as db:
+            assert db.get(day)["tasks"]
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+WORDS = ("buy milk call mum pay rent fix the bike book dentist water plants "
+         "send invoice review pull request clean kitchen gym run 5k read chapter "
+         "pick up parcel renew passport meeting with team prepare slides").split()
+
+
+def _realistic_history(rng, days, today):
+    """`days` days before `today` with 0-8 tasks of a few words, mostly done"""
+    first = datetime.strptime(today, DATEFORMAT) - timedelta(days=days)
+    history = {}
+    for n in range(days + 1):
+        tasks = {str(i): {"text": " ".join(rng.sample(WORDS, rng.randint(2, 6))),
+                          "done": int(rng.random() < 0.8)}
+                 for i in range(1, rng.randint(0, 8) + 1)}
+        if tasks:
+            history[datetime.strftime(first + timedelta(days=n), DATEFORMAT)] = {"tasks": tasks}
+    return history
+
+
+def archiving(users="200", days="730", after="90", compression="zlib"):
+    """Hot db size and load time before and after archiving old days
+
+    Every user has `days` days of realistic history, days older than
+    `after` days are archived; checks reads of archived days.
+    """
+    users, days, after = int(users), int(days), int(after)
+    rng = random.Random(1)
+    today = datetime.strftime(datetime.now(), DATEFORMAT)
+    histories = {str(user): _realistic_history(rng, days, today) for user in range(users)}
+    ok = True
+
+    def size(directory):
+        return sum(os.path.getsize(f"{directory}/{name}") for name in os.listdir(directory)
+                   if os.path.isfile(f"{directory}/{name}"))
+
+    def cold_load():
+        start = time.perf_counter()
+        for user in histories:
+            dbm.cache.configure(storage=dbm.cache.storage)  # drops cached dbs
+            with dbm(user) as db:
+                db.get(today)
+        return (time.perf_counter() - start) / len(histories) * 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = JSONStorage(f"{tmp}/tododb", "none")
+        os.makedirs(storage.directory)
+        for user, history in histories.items():
+            storage.store(user, history)
+        arc = Archive(f"{tmp}/archive", compression)
+        dbm.cache.configure(storage=storage, archive=arc, interval=3600)
+
+        def found(user, day):
+            """All tasks of archived `day` are found by their text"""
+            with dbm(user) as db:
+                return all((day, num) in db.find(task["text"])
+                           for num, task in histories[user][day]["tasks"].items())
+
+        hot_before, load_before = size(storage.directory), cold_load()
+        for user in histories: # archiving keeps the days of built search indexes
+            with dbm(user) as db:
+                db.find("task")
+        summary = archive_old(arc, today, after)
+        for user, history in histories.items():
+            ok &= found(user, min(history))
+        dbm.cache.flush(wait=True)
+        hot_after, load_after = size(storage.directory), cold_load()
+        archived = size(arc.directory)
+
+        cutoff = arc.before
+        reads = []
+        for user, history in histories.items():
+            dbm.cache.configure(storage=storage)
+            arc.cache.clear()
+            with dbm(user) as db:
+                ok &= all(day >= cutoff for day in db.get())
+                for day in rng.sample(sorted(history), 5):
+                    start = time.perf_counter()
+                    ok &= db.get(day) == history[day]
+                    reads.append(time.perf_counter() - start)
+                ok &= db.get(archived=True) == history
+                ok &= db.get_range("", today) == sorted(history)
+            ok &= found(user, min(history))
+
+        # changes move archived days back into the db, deletes stick
+        touched = rng.sample(sorted(histories), 10)
+        for user in touched:
+            history = histories[user]
+            changed, deleted = rng.sample([day for day in history if day < cutoff], 2)
+            with dbm(user) as db:
+                db.done(changed, 1)
+                db.add(changed, "new task")
+                db.delete(deleted)
+            dbm.cache.flush(wait=True)
+            dbm.cache.configure(storage=storage)
+            with dbm(user) as db:
+                tasks = db.get(changed)["tasks"]
+                ok &= tasks["1"]["done"] != history[changed]["tasks"]["1"]["done"]
+                ok &= [task["text"] for task in tasks.values()] == \
+                    [task["text"] for task in history[changed]["tasks"].values()] + ["new task"]
+                ok &= db.get(deleted) is None and deleted not in db.get_range("", today)
+                ok &= changed in db.get_range(changed, changed)
+                ok &= not any(day == deleted for task in history[deleted]["tasks"].values()
+                              for day, _ in db.find(task["text"]))
+            ok &= found(user, changed) and found(user, min(day for day in history if day < cutoff
+                                                             and day not in (changed, deleted)))
+
+        # a record appended after a torn one doesn't hide the archive
+        user = next(user for user in sorted(histories) if user not in touched)
+        history = histories[user]
+        kept, deleted = rng.sample([day for day in history if day < cutoff], 2)
+        with open(arc.path(user), "ab") as f:
+            f.write(RECORD.pack(1, 1000) + b"torn")
+        with dbm(user) as db:
+            db.delete(deleted)
+        dbm.cache.flush(wait=True)
+        dbm.cache.configure(storage=storage)
+        arc.cache.clear()
+        with dbm(user) as db:
+            ok &= db.get(kept) == history[kept] and db.get(deleted) is None
+
+    print(f"{users} users, {days} days of history, archived {summary['days']} days "
+          f"older than {after} days in {summary['duration']:.1f}s ({compression})")
+    print(f"hot db:  {hot_before / 2 ** 20:7.2f} MB -> {hot_after / 2 ** 20:7.2f} MB "
+          f"({1 - hot_after / hot_before:.0%} smaller), archive {archived / 2 ** 20:.2f} MB")
+    print(f"cold load per user: {load_before:.2f} ms -> {load_after:.2f} ms")
+    print(f"get(day) p50 {_percentile(reads, 0.5) * 1000:.3f} ms, "
+          f"p99 {_percentile(reads, 0.99) * 1000:.3f} ms (first read of each archive decompresses it)")
+    print("OK" if ok else "WRONG")
+    return ok
+
+
+def lazy(sizes="10,1000,100000", repeat="20"):
+    """Cold `/tasks today` latency of JSONStorage vs DayStorage"""
+    repeat = int(repeat)
+    print(f"{'days':>8} {'json ms':>10} {'days ms':>10}")
+
+    for size in map(int, sizes.split(",")):
+        db = _history(size)
+        today = max(db)
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(f"{tmp}/user.json", 'w') as f:
+                json.dump(db, f, indent=2)
+            os.makedirs(f"{tmp}/user")
+            for day, data in db.items():
+                with open(f"{tmp}/user/{day}.json", 'w') as f:
+                    json.dump(data, f)
+            del db
+
+            results = [_cold_get(storage, "user", today, repeat)
+                       for storage in (JSONStorage(tmp, "none"), DayStorage(tmp, "none"))]
+
+        print(f"{size:>8} {results[0]:>10.3f} {results[1]:>10.3f}")
+
+
+def snapshot(sizes="10,1000,100000", repeat="20"):
+    """Size and load time of indent=2 json vs. BinaryStorage snapshots
+
+    `bin edit` is a store of the loaded snapshot after changing one day.
+    """
+    repeat = int(repeat)
+    print(f"{'days':>8} {'json KB':>10} {'binary KB':>10} "
+          f"{'json ms':>9} {'binary ms':>9} {'json all':>9} {'bin all':>9} {'bin edit':>9}")
+
+    def load_all(storage):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            db = storage.load("user")
+            for day in db:
+                db[day]["tasks"]
+        return (time.perf_counter() - start) / repeat * 1000
+
+    def edit(storage, day):
+        loaded = storage.load("user")
+        start = time.perf_counter()
+        for i in range(repeat):
+            loaded[day]["tasks"]["1"]["done"] = i % 2
+            storage.store("user", loaded)
+        return (time.perf_counter() - start) / repeat * 1000
+
+    for size in map(int, sizes.split(",")):
+        db = _history(size)
+        today = max(db)
+        with tempfile.TemporaryDirectory() as tmp:
+            storages = (JSONStorage(tmp, "none"), BinaryStorage(tmp, "none"))
+            for storage in storages:
+                storage.store("user", db)
+            kb = [os.path.getsize(f"{tmp}/user.{ext}") / 1024 for ext in ("json", "tdb")]
+            cold = [_cold_get(storage, "user", today, repeat) for storage in storages]
+            full = [load_all(storage) for storage in storages]
+            same = dict(storages[1].load("user")) == db
+            edited = edit(storages[1], today)
+            db[today]["tasks"]["1"]["done"] = (repeat - 1) % 2
+            same &= dict(storages[1].load("user")) == db
+
+        print(f"{size:>8} {kb[0]:>10.1f} {kb[1]:>10.1f} {cold[0]:>9.3f} {cold[1]:>9.3f} "
+              f"{full[0]:>9.2f} {full[1]:>9.2f} {edited:>9.2f}{'' if same else '  MISMATCH'}")
+
+
+def reminders(count="100000", users="1000", batch="500"):
+    """100k pending reminders: memory, rebuild from the index, firing cost"""
+    count, users, batch = int(count), int(users), int(batch)
+    sent = []
+    now = int(time.time())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dbm.cache.configure(storage=JSONStorage(tmp, "none"), size=users, interval=3600)
+        index = f"{tmp}/reminders.idx"
+        scheduler = Reminders(index, lambda user, text: sent.append(user), batch)
+
+        # half is due already, the rest later
+        start = time.perf_counter()
+        for i in range(count):
+            user, due = str(i % users), now - 60 - i if i % 2 else now + 3600 + i
+            with dbm(user) as db:
+                db.add(DAY, f"reminder {i}", due=due)
+            scheduler.add(user, DAY, due)
+        added = time.perf_counter() - start
+        dbm.cache.flush(wait=True)
+
+        # restart
+        scheduler = Reminders(index, lambda user, text: sent.append(user), batch)
+        start = time.perf_counter()
+        scheduler.load()
+        rebuild = time.perf_counter() - start
+
+        tracemalloc.start()
+        scheduler.load()
+        memory = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        tracemalloc.stop()
+
+        ticks = []
+        while scheduler.next_due() is not None and scheduler.next_due() <= now:
+            start = time.perf_counter()
+            scheduler.fire()
+            ticks.append(time.perf_counter() - start)
+        pending = len(scheduler)
+
+        # nothing fires twice, even when the index is rebuilt again
+        for user in range(users):
+            scheduler.add(str(user), DAY, now - 60)
+        scheduler.fire()
+        dbm.cache.flush(wait=True)
+
+    # /add through the handler with the scheduler of bot.setup, still empty
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(f"{tmp}/tododb")
+        bot = _load_bot(tmp, {"backend": "json", "path": f"{tmp}/tododb", "durability": "none"})
+        tgbot = FakeBot()
+        jobq = JobQueue(tgbot)
+        bot.setup(Dispatcher(tgbot, None, job_queue=jobq), jobq, tgbot)
+        update = FakeUpdate(1, "/add in 2 hours take cake", datetime.now() - timedelta(hours=3))
+        bot.add_task(tgbot, update)
+        bot.reminders.fire()
+        bot.shutdown()
+    handled = update.message.replies == ["Updating tasklist, I'll remind you"] \
+        and tgbot.messages["1"] == [f"{ALARM} take cake"]
+
+    expected = count // 2
+    ok = len(sent) == expected and pending == count - expected and handled
+    print(f"{count} reminders for {users} users, added in {added:.1f}s")
+    print(f"rebuild from index {rebuild * 1000:.0f}ms, heap {memory:.1f} MB")
+    print(f"fired {len(sent)} in {len(ticks)} ticks of <= {batch}, "
+          f"max tick {max(ticks) * 1000:.0f}ms, {pending} pending")
+    print(f"/add in 2 hours: {'reminded' if handled else 'NOT REMINDED'}")
+    print("OK" if ok else "WRONG")
+    return ok
+
+
+def _scan(db, query):
+    """/find as a scan of every task, the reference for the index"""
+    words = search.tokenize(query)
+    return sorted(((day, num) for day, data in db.items() for num, task in data['tasks'].items()
+                   if words <= search.tokenize(task['text'])),
+                  key=lambda hit: (hit[0], int(hit[1])))
+
+
+def searching(sizes="100,1000,10000", tasks="5", repeat="200", changes="2000"):
+    """/find latency by history size: scanning all tasks vs. the inverted index
+
+    Checks the index against a scan after random adds, edits and deletes.
+    """
+    tasks, repeat, changes = int(tasks), int(repeat), int(changes)
+    queries = ["task", "number 3", "day 42", "3 of day 7", "missing"]
+    ok = True
+
+    def timed(func):
+        start = time.perf_counter()
+        for i in range(repeat):
+            func(queries[i % len(queries)])
+        return (time.perf_counter() - start) / repeat * 1000
+
+    print(f"{'days':>7} {'scan ms':>9} {'index ms':>9} {'build ms':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        dbm.cache.configure(storage=JSONStorage(tmp, "none"), interval=3600)
+        for days in map(int, sizes.split(",")):
+            user = f"user{days}"
+            dbm.cache.storage.store(user, _history(days, tasks))
+            with dbm(user) as db:
+                data = db.get()
+                start = time.perf_counter()
+                db.find("task")
+                build = (time.perf_counter() - start) * 1000
+                scan = timed(lambda query: _scan(data, query))
+                index = timed(lambda query: db.find(query, 50))
+            print(f"{days:>7} {scan:>9.3f} {index:>9.3f} {build:>9.1f}")
+
+        # the index follows every change, renumbering included
+        rng = random.Random(1)
+        user = "changes"
+        history = _history(30, tasks)
+        dbm.cache.storage.store(user, history)
+        with dbm(user) as db:
+            db.find("task")
+        for i in range(changes):
+            with dbm(user) as db:
+                day = rng.choice(sorted(history))
+                size = len(db.get(day)['tasks']) if db.get(day) else 0
+                action = rng.random()
+                if action < 0.4 or not size:  # deleted days come back
+                    db.add(day, f"added {rng.choice(['buy', 'call', 'fix'])} {i}")
+                elif action < 0.6:
+                    db.edit(day, rng.randint(1, size), f"edited {rng.choice(['buy', 'read'])} {i}")
+                elif action < 0.9:
+                    db.delete_many(day, rng.sample(range(1, size + 1), min(size, rng.randint(1, 2))))
+                elif action < 0.97:
+                    db.done(day, rng.randint(1, size))
+                else:
+                    db.delete(day)
+            if i % 100 == 0:
+                with dbm(user) as db:
+                    for query in queries + ["buy", "call", "edited read", "task 2"]:
+                        ok &= db.find(query) == _scan(db.get(), query)
+
+        # reloading from the storage rebuilds it
+        dbm.cache.flush(wait=True)
+        dbm.cache.configure(storage=dbm.cache.storage)
+        with dbm(user) as db:
+            ok &= db.find("buy") == _scan(db.get(), "buy")
+
+    print(f"{changes} random changes: " + ("index matches scan" if ok else "INDEX DIFFERS"))
+    return ok
+
+
+def ranges(sizes="100,1000,10000", repeat="500", changes="2000"):
+    """/tasks week: sorting all days vs. the sorted day index, by history size
+
+    Checks the index against sorting after random adds and deletes.
+    """
+    repeat, changes = int(repeat), int(changes)
+    ok = True
+
+    def timed(func):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    print(f"{'days':>7} {'sort ms':>9} {'index ms':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        dbm.cache.configure(storage=JSONStorage(tmp, "none"), interval=3600)
+        for days in map(int, sizes.split(",")):
+            user = f"user{days}"
+            history = _history(days, 1)
+            dbm.cache.storage.store(user, history)
+            week = sorted(history)[days // 2], sorted(history)[days // 2 + 6]
+            with dbm(user) as db:
+                db.days()
+                data = db.get()
+                scan = timed(lambda: [day for day in sorted(data) if week[0] <= day <= week[1]])
+                index = timed(lambda: db.next_n_days(week[0], 7))
+                ok &= db.next_n_days(week[0], 7) == sorted(history)[days // 2:days // 2 + 7]
+            print(f"{days:>7} {scan:>9.4f} {index:>9.4f}")
+
+        rng = random.Random(1)
+        user = "changes"
+        candidates = sorted(_history(60))
+        with dbm(user) as db:
+            db.days()
+        for i in range(changes):
+            day = rng.choice(candidates)
+            with dbm(user) as db:
+                action = rng.random()
+                if action < 0.6:
+                    db.add(day, f"task {i}")
+                elif action < 0.99:
+                    if db.get(day):
+                        db.delete(day)
+                else:
+                    db.delete(force=True)
+            with dbm(user) as db:
+                start, end = sorted(rng.sample(candidates, 2))
+                expected = sorted(db.get())
+                ok &= db.days() == expected
+                ok &= db.get_range(start, end) == [d for d in expected if start <= d <= end]
+
+    print(f"{changes} random changes: " + ("index matches sort" if ok else "INDEX DIFFERS"))
+    return ok
+
+
+def _render_concat(data):
+    """/tasks formatting as get_task did it before render.py"""
+    items = [(day, day_data) for day, day_data in data.items()]
+    items.sort(key=lambda x: x[0])
+    days = []
+    for day, data in items:
+        reply_piece = f"*{day}*\n"
+        for num, task in data['tasks'].items():
+            if task['done']:
+                reply_piece += f"`{num})` \u2705 "
+            else:
+                reply_piece += f"`{num})` \u274c "
+            reply_piece += f"{task['text']}\n"
+        days.append(reply_piece)
+    return "\n".join(days)
+
+
+def _render_cached(user):
+    with dbm(user) as db:
+        blocks = render.render_days(db, sorted(db.get()))
+    return render.split_message(blocks)
+
+
+def rendering(days="1000", tasks="8", repeat="50"):
+    """/tasks formatting: string concatenation vs. cached day blocks"""
+    days, tasks, repeat = int(days), int(tasks), int(repeat)
+
+    def timed(func, *args):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(*args)
+        return (time.perf_counter() - start) / repeat * 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dbm.cache.configure(storage=JSONStorage(tmp, "none"), interval=3600)
+        dbm.cache.storage.store("user", _history(days, tasks))
+        with dbm("user") as db:
+            data = db.get()
+            last = max(data)
+
+        concat = timed(_render_concat, data)
+        render.cache.entries.clear()
+        cold = timed(lambda: (render.cache.entries.clear(), _render_cached("user")))
+
+        def toggle_and_render():
+            with dbm("user") as db:
+                db.done(last, 1)
+            _render_cached("user")
+        warm = timed(toggle_and_render)
+
+        joined = "\n".join(_render_cached("user"))
+        same = joined == _render_concat(data)
+
+    print(f"{days} days x {tasks} tasks")
+    print(f"concatenation:          {concat:8.2f} ms")
+    print(f"blocks, empty cache:    {cold:8.2f} ms")
+    print(f"blocks, one day change: {warm:8.2f} ms")
+    print("output OK" if same else "OUTPUT DIFFERS")
+    return same
+
+
+COMMANDS = [
+    "/add buy milk", "/add tmr walk the dog", "/add in 2 days call mum",
+    "/add 2019-03-01 pay rent", "/add in 3 weeks dentist appointment at 10",
+    "/tasks", "/tasks today", "/tasks tmr", "/tasks in 5 days",
+    "/done 2", "/done tmr 1", "/done 2019-02-02 3",
+    "/del 1", "/del tmr", "/del 2019-10-10 3", "/del all",
+    "/edit 2 do shopping", "/edit tomorrow 3 change plans", "/add help", "/done h",
+]
+
+
+def _match_re_old(inp):
+    """extras.match_re before dates.py"""
+    match = re.match(REGEX, inp)
+    if not match:
+        return None
+    return match.groups()
+
+
+# extras.timeperiods before dates.py, months of 28 days and years of 336
+TIMEPERIODS_OLD = {
+    "s": lambda x: timedelta(seconds=x),
+    "m": lambda x: timedelta(seconds=x*60),
+    "h": lambda x: timedelta(seconds=x*60*60),
+    "d": lambda x: timedelta(days=x),
+    "w": lambda x: timedelta(days=x*7),
+    "mo": lambda x: timedelta(days=x*7*4),
+    "y": lambda x: timedelta(days=x*7*4*12),
+}
+
+
+def _parse_date_old(datestring):
+    """bot.parse_date before commands.py, without the reply"""
+    today = datetime.today()
+    accepted_keywords = {'today': today,
+                         'tomorrow': today + timedelta(days=1),
+                         'tmr': today + timedelta(days=1)}
+    response = []
+    wordsused = 0
+    if datestring[0] in accepted_keywords.keys():
+        response.append(accepted_keywords[datestring[0]])
+        wordsused += 1
+    elif datestring[0] == "in":
+        if not datestring[1].isdigit():
+            return None
+        if not _match_re_old(" ".join(datestring[1:3])):
+            return None
+        num, period = datestring[1:3]
+        period = period.lower()
+        num = int(num)
+        if period[:2] == 'mo':
+            delta = TIMEPERIODS_OLD[period[:2]](num)
+        else:
+            delta = TIMEPERIODS_OLD[period[0]](num)
+        response.append(today + delta)
+        wordsused += 3
+    else:
+        response.append(today)
+    response.append(" ".join(datestring[wordsused:]))
+    return response
+
+
+def _parse_old(text):
+    """Parsing work the handlers did per update before commands.py"""
+    words = text.split()   # help decorator
+    if len(words) == 2 and words[1] in ['help', 'h']:
+        return
+    message = text.split()[1:]
+    name = words[0]
+    if name in ("/add", "/tasks"):
+        return _parse_date_old(message) if message else None
+    if message and not message[0].isdigit():
+        return re.match(DATEREGEX, message[0])
+
+
+def parser(repeat="20000"):
+    """Command parsing throughput: ad-hoc splitting vs. commands.parse"""
+    repeat = int(repeat)
+    corpus = COMMANDS * (repeat // len(COMMANDS))
+
+    def timed(func):
+        durations = []
+        for _ in range(7): # median run, single runs vary by 20%
+            start = time.perf_counter()
+            for text in corpus:
+                try:
+                    func(text)
+                except commands.ParseError:
+                    pass
+            durations.append(time.perf_counter() - start)
+        return len(corpus) / sorted(durations)[3]
+
+    old, new = timed(_parse_old), timed(commands.parse)
+    print(f"{len(corpus)} commands")
+    print(f"ad-hoc parsing:  {old:10.0f} commands/s")
+    print(f"commands.parse:  {new:10.0f} commands/s")
+
+
+def resolving(repeat="20000"):
+    """Day resolution per update: memoized dates.resolve vs. computing it"""
+    repeat = int(repeat)
+    phrases = [commands.parse(text).time for text in COMMANDS] + ["next fri", "mar 5"]
+    phrases = [phrase for phrase in phrases if phrase] * (repeat // len(phrases))
+    now = datetime.now()
+
+    def timed(resolve):
+        start = time.perf_counter()
+        for phrase in phrases:
+            resolve(phrase, "Europe/Prague", now.date())
+        return len(phrases) / (time.perf_counter() - start)
+
+    computed, memoized = timed(dates.resolve.__wrapped__), timed(dates.resolve)
+    print(f"{len(phrases)} phrases, {dates.resolve.cache_info()}")
+    print(f"computed:  {computed:10.0f} phrases/s")
+    print(f"memoized:  {memoized:10.0f} phrases/s")
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+
+
+class FakeMessage:
+    """Just enough of `telegram.Message` for `up_data` and `send_reply`"""
+
+    def __init__(self, user_id, text, date, message_id=None):
+        self.from_user = FakeUser(user_id)
+        self.message_id = message_id
+        self.chat_id = user_id
+        self.text = text
+        self.date = date
+        self.replies = []
+
+    def reply_text(self, text, **kw):
+        self.replies.append(text)
+
+
+class FakeUpdate:
+    def __init__(self, user_id, text, date, update_id=None, message_id=None):
+        self.update_id = update_id
+        self.message = FakeMessage(user_id, text, date, message_id)
+
+
+# share of each command in the generated traffic
+MIX = {"add": 0.4, "tasks": 0.25, "done": 0.2, "edit": 0.1, "del": 0.05}
+
+FIXTURES = {"empty": 0, "small": 30, "large": 1000}  # days of history per user
+
+
+def synthetic_updates(users, count, mix=MIX, seed=1):
+    """Yields (command, FakeUpdate) with a realistic mix of commands
+
+    Task numbers follow the number of tasks the generated adds created,
+    so most done/edit/del updates hit an existing task.
+    """
+    rng = random.Random(seed)
+    names, weights = zip(*mix.items())
+    sizes = defaultdict(int)    # (user, day) -> tasks added today or tomorrow
+    now = datetime.now()
+
+    for i in range(count):
+        user = rng.randrange(1, users + 1)
+        command = rng.choices(names, weights)[0]
+        when = rng.choice(["", "", "", "tmr "])
+        size = sizes[user, when]
+        number = rng.randint(1, size) if size else 1
+
+        if command == "add":
+            sizes[user, when] += 1
+            text = f"/add {when}{rng.choice(['buy', 'call', 'fix', 'read'])} thing {i}"
+        elif command == "tasks":
+            text = rng.choice(["/tasks", "/tasks today", "/tasks tmr"])
+        elif command == "done":
+            text = f"/done {when}{number}"
+        elif command == "edit":
+            text = f"/edit {when}{number} changed {i}"
+        else:
+            if size:
+                sizes[user, when] -= 1
+            text = f"/del {when}{number}"
+        yield command, FakeUpdate(user, text, now)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def _write_config(directory, db_config):
+    config = {"log": {"debug": f"{directory}/debug.log",
+                      "filename": f"{directory}/bot.log",
+                      "db": f"{directory}/db.log",
+                      "logformat": "%(asctime)s %(name)s %(message)s"},
+              "db": db_config}
+    with open(f"{directory}/config.json", 'w') as f:
+        json.dump(config, f)
+
+
+def _load_bot(directory, db_config):
+    """Imports bot.py with a config pointing the db and its other files into `directory`"""
+    import dbmanager
+    _write_config(directory, db_config)
+    cwd, botdir = os.getcwd(), dbmanager.BOTDIR
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(directory)
+    dbmanager.BOTDIR = os.path.abspath(directory)
+    try:
+        sys.modules.pop("bot", None)
+        return importlib.import_module("bot")
+    finally:
+        dbmanager.BOTDIR = botdir
+        os.chdir(cwd)
+        sys.path.pop(0)
+
+
+def handlers(users="200", updates="20000", fixture="small", backend="json", out=""):
+    """Latency of the command handlers driven by synthetic updates
+
+    Every user starts with the `fixture` history (empty, small, large).
+    Results are written as json to `out` if given, see `compare`.
+    """
+    users, updates = int(users), int(updates)
+    history = _history(FIXTURES[fixture])
+    today = datetime.strftime(datetime.now(), DATEFORMAT)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = f"{tmp}/db.sqlite" if backend == "sqlite" else f"{tmp}/tododb"
+        os.makedirs(f"{tmp}/tododb", exist_ok=True)
+        db_config = {"backend": backend, "path": path, "durability": "none",
+                     "cache_size": 256, "flush_interval": 30}
+        bot = _load_bot(tmp, db_config)
+        for user in range(1, users + 1):
+            dbm.cache.storage.store(str(user), dict(history, **{today: {"tasks": {}}}))
+
+        callbacks = {"add": bot.add_task, "tasks": bot.get_task, "done": bot.done_task,
+                     "edit": bot.edit_task, "del": bot.delete_task}
+        latencies = defaultdict(list)
+        generated = list(synthetic_updates(users, updates))
+
+        start = time.perf_counter()
+        for command, update in generated:
+            begin = time.perf_counter()
+            callbacks[command](None, update)
+            latencies[command].append(time.perf_counter() - begin)
+        dbm.cache.flush(wait=True)
+        duration = time.perf_counter() - start
+
+    everything = [value for values in latencies.values() for value in values]
+    results = {
+        "scenario": "handlers",
+        "params": {"users": users, "updates": updates, "fixture": fixture,
+                   "backend": backend},
+        "python": platform.python_version(),
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "throughput": updates / duration,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "latency_ms": {command: {"count": len(values),
+                                 "p50": _percentile(values, 0.5) * 1000,
+                                 "p99": _percentile(values, 0.99) * 1000}
+                       for command, values in sorted(latencies.items())},
+    }
+    results["latency_ms"]["all"] = {"count": len(everything),
+                                    "p50": _percentile(everything, 0.5) * 1000,
+                                    "p99": _percentile(everything, 0.99) * 1000}
+
+    print(f"{updates} updates, {users} users, {fixture} history, {backend}")
+    print(f"{'command':>8} {'count':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for command, stats in results["latency_ms"].items():
+        print(f"{command:>8} {stats['count']:>7} {stats['p50']:>8.3f} {stats['p99']:>8.3f}")
+    print(f"throughput {results['throughput']:.0f} updates/s, "
+          f"peak RSS {results['peak_rss_mb']:.1f} MB")
+
+    if out:
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def bulk(tasks="5", history="1000", repeat="50"):
+    """Adding and marking `tasks` tasks: one command each vs. one batch command
+
+    The db is written through on every command, like with locking or a
+    flush interval of 0.
+    """
+    tasks, repeat = int(tasks), int(repeat)
+    numbers = " ".join(str(i) for i in range(1, tasks + 1))
+    single = [f"/add task {i}" for i in range(tasks)] + [f"/done {i}" for i in range(1, tasks + 1)]
+    batch = ["/add " + "\n".join(f"task {i}" for i in range(tasks)), f"/done {numbers}"]
+    results = {}
+    ok = True
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(f"{tmp}/tododb")
+        db_config = {"backend": "json", "path": f"{tmp}/tododb", "durability": "none",
+                     "flush_interval": 0}
+        bot = _load_bot(tmp, db_config)
+        callbacks = {"add": bot.add_task, "done": bot.done_task, "del": bot.delete_task}
+        now = datetime.now()
+        today = datetime.strftime(now, DATEFORMAT)
+
+        for name, texts in (("single", single), ("batch", batch)):
+            dbm.cache.storage.store(name, _history(int(history)))
+            metrics.registry.clear()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for text in texts + [f"/del {numbers}"]:
+                    callbacks[text.split()[0][1:]](None, FakeUpdate(name, text, now))
+            duration = (time.perf_counter() - start) / repeat * 1000
+            written = metrics.snapshot()["db_bytes_written_total"][""] / repeat
+            results[name] = duration, written
+
+            with dbm(name) as db:
+                # last round's tasks were deleted again
+                ok &= not db.get(today)['tasks']
+            update = FakeUpdate(name, batch[0], now)
+            bot.add_task(None, update)
+            with dbm(name) as db:
+                added = db.get(today)['tasks']
+                ok &= [task['text'] for task in added.values()] == [f"task {i}" for i in range(tasks)]
+            update = FakeUpdate(name, f"/done 1 {tasks + 1}", now)
+            bot.done_task(None, update)
+            with dbm(name) as db:
+                ok &= not db.get(today, 1)['done'] # nothing marked when one is missing
+            ok &= update.message.replies == [f"Task {tasks + 1} not found!"]
+            update = FakeUpdate(name, "/del 1 1", now)
+            bot.delete_task(None, update)
+            ok &= update.message.replies == ["Deleting task 1 from *today*"]
+
+        # numbering of hand-edited days with gaps
+        for keys, number, left in ((("1", "2", "5"), "1", {"1": "b", "4": "c"}),
+                                   (("2", "3"), "3", {"2": "a"})):
+            texts = dict(zip(keys, "abc"))
+            dbm.cache.storage.store("gaps", {today: {"tasks": {
+                num: {"text": text, "done": 0} for num, text in texts.items()}}})
+            dbm.cache.configure(storage=dbm.cache.storage)  # drops cached dbs
+            bot.delete_task(None, FakeUpdate("gaps", f"/del {number}", now))
+            with dbm("gaps") as db:
+                ok &= {num: task["text"] for num, task in db.get(today)["tasks"].items()} == left
+
+    print(f"{tasks} tasks added, marked done and deleted, {history} days of history")
+    for name, (duration, written) in results.items():
+        print(f"{name:>7}: {duration:8.2f} ms {written / 1024:10.0f} KiB written")
+    print("OK" if ok else "WRONG")
+    return ok
+
+
+def deduplication(updates="50000", users="100", retries="0.2", window="10000"):
+    """Redelivered updates: tasks added once, memory bounded, window kept on restart"""
+    updates, users, retries, window = int(updates), int(users), float(retries), int(window)
+    rng = random.Random(1)
+    now = datetime.now()
+    today = datetime.strftime(now, DATEFORMAT)
+
+    # telegram retries an update soon after it was sent, or resends the message in a new update
+    stream, originals, expected, redelivered = [], [], defaultdict(int), 0
+    for update_id in range(1, updates + 1):
+        user = rng.randrange(1, users + 1)
+        originals.append((update_id, user, update_id))
+        stream.append(originals[-1])
+        expected[str(user)] += 1
+        if rng.random() < retries:
+            retried = originals[-1 - rng.randint(0, min(update_id - 1, window // 4))]
+            if rng.random() < 0.5:
+                retried = (updates + update_id, retried[1], retried[2])
+            stream.append(retried)
+            redelivered += 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(f"{tmp}/tododb")
+        db_config = {"backend": "json", "path": f"{tmp}/tododb", "durability": "none"}
+        bot = _load_bot(tmp, db_config)
+        seen = Deduplicator(f"{tmp}/updates.log", window)
+        seen.load()
+        add = seen.wrap(bot.add_task)
+
+        start = time.perf_counter()
+        for update_id, user, message_id in stream:
+            add(None, FakeUpdate(user, f"/add task {message_id}", now, update_id, message_id))
+        duration = time.perf_counter() - start
+
+        ok = seen.dropped == redelivered
+        for user, count in expected.items():
+            with dbm(user) as db:
+                ok &= len(db.get(today)['tasks']) == count
+
+        # the last updates are redelivered after a restart
+        seen.close()
+        seen = Deduplicator(f"{tmp}/updates.log", window)
+        seen.load()
+        add = seen.wrap(bot.add_task)
+        for update_id, user, message_id in stream[-window // 2:]:
+            add(None, FakeUpdate(user, f"/add task {message_id}", now, update_id, message_id))
+        ok &= seen.dropped == window // 2
+        log = os.path.getsize(f"{tmp}/updates.log")
+        seen.close()
+        dbm.cache.flush(wait=True)
+
+        # memory of the window stays the same however many updates pass
+        sizes = []
+        for count in (window, 10 * window):
+            seen = Deduplicator(f"{tmp}/memory-{count}.log", window)
+            seen.load()
+            tracemalloc.start()
+            for update_id in range(1, count + 1):
+                seen.check(FakeUpdate(update_id % users, "", now, update_id, update_id))
+            sizes.append(tracemalloc.get_traced_memory()[0] / 2 ** 20)
+            tracemalloc.stop()
+
+            start = time.perf_counter()
+            for update_id in range(count + 1, count + updates + 1):
+                seen.check(FakeUpdate(update_id % users, "", now, update_id, update_id))
+            check = (time.perf_counter() - start) / updates * 10 ** 6
+            seen.close()
+
+    print(f"{len(stream)} updates of {users} users, {redelivered} redelivered, window {window}")
+    print(f"handled in {duration:.1f}s, check {check:.1f} us/update, log {log / 1024:.0f} KiB")
+    print(f"window memory after {window} updates {sizes[0]:.2f} MB, "
+          f"after {10 * window} updates {sizes[1]:.2f} MB")
+    print(f"dropped {redelivered} duplicates, {window // 2} more after restart")
+    print("OK" if ok else "WRONG")
+    return ok
+
+
+def _flood(bot, admission, light, history, duration, heavy_rate, light_rate, workers):
+    """Runs a heavy user's /tasks flood and light users' /add on `workers` threads
+
+    Returns ({kind: [latencies]}, first reply to each update of the heavy user)
+    """
+    now = datetime.now()
+    callbacks = {"tasks": bot.get_task, "add": bot.add_task}
+    if admission:
+        callbacks = {command: admission.wrap(command, callback)
+                     for command, callback in callbacks.items()}
+
+    arrivals = [(n / heavy_rate, "heavy", 0, "/tasks") for n in range(int(duration * heavy_rate))]
+    for user in range(1, light + 1):
+        offset = user / light / light_rate
+        arrivals += [(offset + n / light_rate, "light", user, f"/add task {n}")
+                     for n in range(int(duration * light_rate))]
+    arrivals.sort()
+
+    latencies = defaultdict(list)
+    heavy_replies = []
+
+    def handle(kind, user, text, sent):
+        update = FakeUpdate(user, text, now)
+        callbacks[text.split()[0][1:]](None, update)
+        latencies[kind].append(time.perf_counter() - sent)
+        if kind == "heavy":
+            heavy_replies.append(update.message.replies[0])
+
+    with ThreadPoolExecutor(workers) as pool:
+        start = time.perf_counter()
+        for at, kind, user, text in arrivals:
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(handle, kind, user, text, time.perf_counter())
+    return latencies, heavy_replies
+
+
+def admission(history="3000", light="20", duration="3", heavy_rate="100", light_rate="2",
+              workers="8"):
+    """Light users' latency while one user with a big history floods /tasks
+
+    Compares handlers without and with admission control. Light users
+    have to be served every time and the flood turned away in part.
+    Latencies are printed for comparison only, they vary between runs.
+    """
+    history, light, duration = int(history), int(light), float(duration)
+    heavy_rate, light_rate, workers = float(heavy_rate), float(light_rate), int(workers)
+    today = datetime.strftime(datetime.now(), DATEFORMAT)
+    results = {}
+    ok = True
+
+    for mode in ("off", "on"):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(f"{tmp}/tododb")
+            db_config = {"backend": "json", "path": f"{tmp}/tododb", "durability": "none"}
+            bot = _load_bot(tmp, db_config)
+            dbm.cache.storage.store("0", _history(history))
+            control = Admission(bot.send_reply, max_concurrent=workers) if mode == "on" else None
+
+            latencies, replies = _flood(bot, control, light, history, duration,
+                                        heavy_rate, light_rate, workers)
+            dbm.cache.flush(wait=True)
+            for user in range(1, light + 1):
+                with dbm(user) as db:
+                    ok &= len(db.get(today)['tasks']) == int(duration * light_rate)
+        results[mode] = latencies, replies
+
+    print(f"1 user with {history} days sending {heavy_rate:.0f} /tasks/s, "
+          f"{light} users sending {light_rate:.0f} /add/s, {workers} threads, {duration:.0f}s")
+    print(f"{'admission':>9} {'light p50':>10} {'light p99':>10} {'heavy p50':>10} "
+          f"{'rendered':>9} {'turned away':>12}")
+    for mode, (latencies, replies) in results.items():
+        light_ms = [_percentile(latencies["light"], p) * 1000 for p in (0.5, 0.99)]
+        heavy_ms = _percentile(latencies["heavy"], 0.5) * 1000
+        away = sum(1 for reply in replies if not reply.startswith("*"))
+        print(f"{mode:>9} {light_ms[0]:>10.1f} {light_ms[1]:>10.1f} {heavy_ms:>10.1f} "
+              f"{len(replies) - away:>9} {away:>12}")
+    ok &= any(not reply.startswith("*") for reply in results["on"][1])
+
+    # only an identical command is coalesced into a running one
+    control = Admission(None)
+    ok &= control.admit(1, "tasks", "/tasks") == (None, 0)
+    ok &= control.admit(1, "tasks", "/tasks tmr") == (None, 0)
+    ok &= control.admit(1, "tasks", "/tasks")[0] == "coalesced"
+    print("OK" if ok else "WRONG")
+    return ok
+
+
+def recurrences(days="400", sizes="1,10,100,1000", repeat="2000"):
+    """Recurring tasks: each occurrence materialized once, deleted ones and
+    deleted rules stay away, bounded rule storage, occurrence lookup cost by number of rules with one active on the day
+    """
+    days, repeat = int(days), int(repeat)
+    first = datetime(2019, 1, 1, 12)
+    ok = True
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(f"{tmp}/tododb")
+        db_config = {"backend": "json", "path": f"{tmp}/tododb", "durability": "none"}
+        bot = _load_bot(tmp, db_config)
+        rules = ["daily water plants", "mon,thu gym", "weekdays standup", "monthly on the 31st pay rent"]
+        for rule in rules:
+            bot.every_task(None, FakeUpdate(1, f"/every {rule}", first))
+
+        # the user looks at the week ahead every day and finishes the first task
+        sizes_seen = []
+        for n in range(days):
+            now = first + timedelta(days=n)
+            bot.get_task(None, FakeUpdate(1, "/tasks week", now))
+            bot.get_task(None, FakeUpdate(1, "/tasks tmr", now))
+            bot.done_task(None, FakeUpdate(1, "/done 1", now))
+            sizes_seen.append(os.path.getsize(bot.recurring.path(1)))
+
+        expected = {"1": "water plants", "2": "gym", "3": "standup", "4": "pay rent"}
+        with dbm(1) as db:
+            for n in range(days):
+                day = datetime.strftime(first + timedelta(days=n), DATEFORMAT)
+                found = sorted(task["rule"] for task in db.get(day)["tasks"].values())
+                wanted = sorted(number for number, _ in bot.recurring.occurrences(1, day))
+                ok &= found == wanted
+                ok &= all(task["text"] == expected[task["rule"]]
+                          for task in db.get(day)["tasks"].values())
+            materialized = sum(len(db.get(day)["tasks"]) for day in db.days())
+
+        # a deleted occurrence stays deleted, a deleted rule takes its upcoming tasks along
+        now = first + timedelta(days=days)
+        today = datetime.strftime(now, DATEFORMAT)
+        tomorrow = datetime.strftime(now + timedelta(days=1), DATEFORMAT)
+        bot.get_task(None, FakeUpdate(1, "/tasks tmr", now))
+        with dbm(1) as db:
+            before = sorted(task["rule"] for task in db.get(tomorrow)["tasks"].values())
+            deleted = db.get(tomorrow)["tasks"]["1"]["rule"]
+        bot.delete_task(None, FakeUpdate(1, "/del tmr 1", now))
+        bot.get_task(None, FakeUpdate(1, "/tasks week", now))
+        with dbm(1) as db:
+            after = sorted(task["rule"] for task in db.get(tomorrow)["tasks"].values())
+        before.remove(deleted)
+        ok &= after == before
+
+        bot.every_task(None, FakeUpdate(1, "/every del 1", now))
+        bot.get_task(None, FakeUpdate(1, "/tasks week", now))
+        with dbm(1) as db:
+            left = [(day, task) for day in db.days() for task in db.get(day)["tasks"].values()
+                    if task["rule"] == "1"]
+        ok &= bool(left)
+        ok &= all(day < today or task["done"] for day, task in left)
+
+        # the rollover moves an unfinished weekly task, a daily one is on the next day already
+        weekday = datetime.strftime(now, "%a").lower()
+        bot.every_task(None, FakeUpdate(2, "/every daily water plants", now))
+        bot.every_task(None, FakeUpdate(2, f"/every {weekday} pay rent", now))
+        bot.add_task(None, FakeUpdate(2, "/add call mom", now))
+        bot.get_task(None, FakeUpdate(2, "/tasks tmr", now))
+        dbm.cache.flush(wait=True)
+        summary = bot.rollover(today, workers=1, progressdir=tmp, rules=bot.recurring)
+        bot.get_task(None, FakeUpdate(2, "/tasks", now + timedelta(days=1)))
+        with dbm(2) as db:
+            moved = sorted(task["text"] for task in db.get(tomorrow)["tasks"].values())
+            stayed = sorted(task["text"] for task in db.get(today)["tasks"].values())
+        print(f"rollover moved {summary['moved']} tasks, next day: {', '.join(moved)}")
+        ok &= moved == ["call mom", "pay rent", "water plants"]
+        ok &= stayed == ["water plants"]
+
+        # rules added from many threads get distinct ids, a rollover in processes stores its tasks
+        threads = [threading.Thread(target=lambda: [bot.recurring.add(3, "daily", "t", today)
+                                                    for _ in range(50)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ok &= len(bot.recurring.rules(3)) == 400
+        bot.add_task(None, FakeUpdate(3, "/add call mom", now))
+        dbm.cache.flush(wait=True)
+        dbm.cache.configure(locking=True)
+        os.makedirs(f"{tmp}/processes")
+        bot.rollover(today, workers=2, processes=True, progressdir=f"{tmp}/processes",
+                     rules=bot.recurring)
+        with dbm(3) as db:
+            ok &= len(db.get(tomorrow)["tasks"]) == 401
+        dbm.cache.configure(locking=False)
+        dbm.cache.flush(wait=True)
+
+        print(f"{len(rules)} rules over {days} days viewed as /tasks week: "
+              f"{materialized} tasks materialized, each once: {'yes' if ok else 'NO'}")
+        print(f"rule file {min(sizes_seen)}..{max(sizes_seen)} bytes, "
+              f"{sizes_seen[-1]} after {days} days")
+
+        # one rule active on the day, the rest on other days of the month
+        print(f"{'rules':>7} {'lookup us':>10}")
+        lookups = []
+        for size in map(int, sizes.split(",")):
+            user = f"rules{size}"
+            bot.recurring.add(user, "daily", "active", "2019-01-01")
+            for n in range(size - 1):
+                bot.recurring.add(user, f"monthly {2 + n % 27}", f"task {n}", "2019-01-01")
+            start = time.perf_counter()
+            for _ in range(repeat):
+                found = bot.recurring.occurrences(user, "2019-03-01")
+            lookups.append((time.perf_counter() - start) / repeat * 10 ** 6)
+            ok &= len(found) == 1
+            print(f"{size:>7} {lookups[-1]:>10.2f}")
+
+    print("OK" if ok else "WRONG")
+    return ok
+
+
+def _webhook_update(update_id, user, text):
+    """Webhook json of a private text message as telegram sends it"""
+    return {"update_id": update_id,
+            "message": {"message_id": update_id,
+                        "date": int(time.time()),
+                        "chat": {"id": user, "type": "private"},
+                        "from": {"id": user, "is_bot": False, "first_name": f"user{user}"},
+                        "text": text,
+                        "entities": [{"type": "bot_command", "offset": 0,
+                                      "length": text.index(" ")}]}}
+
+
+def _post_updates(port, path, updates):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    for data in updates:
+        connection.request("POST", f"/{path}", json.dumps(data).encode(),
+                           {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"webhook answered {response.status}")
+    connection.close()
+
+
+def sharding(workers="1,2,4", users="400", updates="20000", clients="4"):
+    """Webhook front routing to 1, 2, 4 worker processes: order and updates/s
+
+    `clients` processes post the updates, each for its own users, so the
+    order of every user's updates is known. Every user has to end up
+    with all of its tasks in order, in its own shard only.
+    """
+    users, updates, clients = int(users), int(updates), int(clients)
+    load = [(n, random.randrange(1, users + 1)) for n in range(updates)]
+    counts = defaultdict(int)
+    batches = [[] for _ in range(clients)]
+    for n, user in load:
+        batches[user % clients].append(_webhook_update(n, user, f"/add task {counts[user]}"))
+        counts[user] += 1
+
+    ok = True
+    ctx = get_context("fork")
+    print(f"{updates} updates, {len(counts)} users, {clients} clients")
+    for n in map(int, workers.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_config = {"backend": "json", "path": f"{tmp}/tododb",
+                         "durability": "none", "flush_interval": 0}
+            _write_config(tmp, db_config)
+            front = shards.Front({"listen": "127.0.0.1", "path": "hook"}, n, tmp,
+                                 FakeBot(chat_limit=10 ** 9, global_limit=10 ** 9))
+            front.start()
+
+            start = time.perf_counter()
+            posters = [ctx.Process(target=_post_updates, args=(front.port, "hook", batch))
+                       for batch in batches]
+            for p in posters:
+                p.start()
+            for p in posters:
+                p.join()
+            front.stop()
+            duration = time.perf_counter() - start
+
+            correct = True
+            for shard in range(n):
+                storage = make_storage(db_config, tmp, shard)
+                for user in storage.users():
+                    tasks = [task["text"] for data in storage.load(user).values()
+                             for task in data["tasks"].values()]
+                    expected = [f"task {k}" for k in range(counts[int(user)])]
+                    correct &= tasks == expected and shards.shard_of(user, n) == shard
+            stored = sum(len(make_storage(db_config, tmp, shard).users()) for shard in range(n))
+            correct &= stored == len(counts)
+
+        ok &= correct
+        print(f"{n} workers: {updates / duration:8.0f} updates/s, routed {front.routed}, "
+              f"{'OK' if correct else 'WRONG'}")
+    return ok
+
+
+def compare(old, new, tolerance="0.1"):
+    """Compares two `handlers` result files, fails on regressions
+
+    A p50/p99 latency growing or the throughput dropping by more than
+    `tolerance` (a fraction) is a regression.
+    """
+    tolerance = float(tolerance)
+    with open(old) as f:
+        old = json.load(f)
+    with open(new) as f:
+        new = json.load(f)
+    if old["params"] != new["params"]:
+        print(f"warning: different parameters {old['params']} vs {new['params']}")
+
+    regressions = 0
+    rows = [("throughput", old["throughput"], new["throughput"], -1)]
+    for command, stats in new["latency_ms"].items():
+        if command in old["latency_ms"]:
+            for key in ("p50", "p99"):
+                rows.append((f"{command} {key} ms", old["latency_ms"][command][key],
+                             stats[key], 1))
+
+    for name, before, after, sign in rows:
+        change = (after - before) / before if before else 0
+        regressed = change * sign > tolerance
+        regressions += regressed
+        print(f"{name:>16} {before:>10.3f} {after:>10.3f} {change:>+8.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return not regressions
+
+
+SCENARIOS = {
+    "stress": stress,
+    "dispatch": dispatch,
+    "outbox": outbox,
+    "lazy": lazy,
+    "archive": archiving,
+    "snapshot": snapshot,
+    "render": rendering,
+    "parser": parser,
+    "dates": resolving,
+    "handlers": handlers,
+    "bulk": bulk,
+    "shards": sharding,
+    "dedup": deduplication,
+    "admission": admission,
+    "recurring": recurrences,
+    "reminders": reminders,
+    "search": searching,
+    "ranges": ranges,
+    "compare": compare,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in SCENARIOS:
+        print(__doc__.strip())
+        print("scenarios:", ", ".join(SCENARIOS))
+        sys.exit(1)
+
+    result = SCENARIOS[sys.argv[1]](*sys.argv[2:])
+    sys.exit(0 if result is not False else 1)
@@ -1,3 +1,4 @@
+import atexit
 import logging
 import json
 import sys
@@ -8,7 +9,22 @@ from functools import wraps
 from telegram.ext import CommandHandler, Updater
 from telegram import ParseMode
 
-from dbmanager import DBManager as dbm
+import metrics
+import shards
+from admission import Admission
+from aiodispatch import AsyncDispatcher
+from archive import archive_old, make_archive
+from commands import SPANS, ParseError, parse
+from dates import Timezones, resolve_day, resolve_due
+from dedup import Deduplicator
+from outbox import Outbox
+from recurring import Recurring, describe as describe_rule
+from reminders import Reminders
+from render import format_day, render_days, split_message
+from rollover import rollover
+from dbmanager import BOTDIR, DBManager as dbm
+from logsetup import setup_logging
+from storage import make_storage
 from extras import *
 
 # load config
@@ -17,41 +33,64 @@ with open("config.json") as f:
 
 #logging
 log_config = config.get("log")
-
-LOGFILE = log_config.get("debug")
-BOTLOG = log_config.get("filename")
-LOGFORMAT = log_config.get("logformat")
-LOGLEVEL = logging.INFO
-
-logging.basicConfig(format=LOGFORMAT, level=LOGLEVEL, filename=LOGFILE)
+log_listener = setup_logging(log_config)
 logger = logging.getLogger(__name__)
 
-#handlers
-filehandler = logging.FileHandler(BOTLOG)
-filehandler.setLevel(LOGLEVEL)
 
-formatter = logging.Formatter(LOGFORMAT)
-filehandler.setFormatter(formatter)
+PARSEMODE = ParseMode.MARKDOWN
+
+# db cache
+db_config = config.get("db", {})
+dbm.cache.configure(storage=make_storage(db_config, BOTDIR),
+                    size=db_config.get("cache_size"),
+                    interval=db_config.get("flush_interval"),
+                    locking=db_config.get("locking"),
+                    archive=make_archive(config.get("archive"), BOTDIR))
+atexit.register(dbm.cache.flush, wait=True)
 
-logger.addHandler(filehandler)
+# per-user timezones, the server's local time without one
+timezones = Timezones(f"{BOTDIR}/timezones.json", config.get("timezone"))
 
+# rules of recurring tasks, one file per user
+recurring = Recurring(f"{BOTDIR}/recurring", config.get("recurring", {}).get("horizon", 62))
 
-PARSEMODE = ParseMode.MARKDOWN
+# outbound queue, async dispatcher, reminders and duplicate filter, created by `setup`
+outbox = None
+aiodispatcher = None
+reminders = None
+deduplicator = None
 
 # named tuple for unpacked update
 Update = namedtuple('Update', 'username, user_id, text, date')
 
 
+def send_reply(update, text, **kw):
+    """Replies through the outbound queue if there is one"""
+    if outbox:
+        outbox.reply(update, text, **kw)
+    else:
+        update.message.reply_text(text, **kw)
+
+
 def help(func):
+    """Parses the command once, answers help requests and invalid input
+
+    The wrapped handler gets the parsed `commands.Command` as third argument
+    """
     @wraps(func)
     def wrapper(*a, **kw):
         update = a[1]
-        text = update.message.text.split()
-        if len(text) == 2 and text[1] in ['help', 'h']:
+        try:
+            command = parse(update.message.text)
+        except ParseError as e:
+            send_reply(update, e.reply, parse_mode=PARSEMODE)
+            return
+
+        if command.help:
             helptext = helpdata.get(func.__name__)
-            update.message.reply_text(helptext, parse_mode=PARSEMODE)
+            send_reply(update, helptext, parse_mode=PARSEMODE)
         else:
-            return func(*a, **kw)
+            return func(*a, command, **kw)
     return wrapper
 
 
@@ -73,344 +112,363 @@ def up_data(update):
 
 def start(bot, update):
     upd = up_data(update)
-    available_commands = "\n".join(["`/add`", "`/tasks`", "`/del`", "`/edit`", "`/done`"])
+    available_commands = "\n".join(["`/add`", "`/tasks`", "`/del`", "`/edit`", "`/done`", "`/find`", "`/every`", "`/tz`"])
 
-    update.message.reply_text(STARTTEXT.format(available_commands), parse_mode=PARSEMODE)
-    logger.info(f"/start by '{upd.user_id}:{upd.username}'")
+    send_reply(update, STARTTEXT.format(available_commands), parse_mode=PARSEMODE)
+    logger.info("/start by '%s:%s'", upd.user_id, upd.username)
 
 
 @help
-def add_task(bot, update):
+def add_task(bot, update, command):
     upd = up_data(update)
+
+    messages = command.text.split("\n") # one task per line
+    day = resolve_day(command.time, upd.date, timezones.get(upd.user_id))
+    due = resolve_due(command.time, upd.date) if reminders is not None else None
     
-    # parse input
-    message = upd.text
-    message = message.split()[1:]
+    # add to db
+    with dbm(upd.user_id) as db:
+        db.add(day, messages, due=due)
+    if due:
+        reminders.add(upd.user_id, day, due)
 
-    parsed = parse_date(message, update)
+    logger.info("Adding '%s' for user '%s:%s' to '%s'", "', '".join(messages), upd.user_id, upd.username, day)
+    reply = "Updating tasklist" if len(messages) == 1 else f"Adding {len(messages)} tasks"
+    send_reply(update, f"{reply} ..." if not due else f"{reply}, I'll remind you")
 
-    if not parsed:
-        update.message.reply_text("Specified timeperiod not found!")
-        return
 
-    message = parsed[1]
-    
-    day = datetime.strftime(parsed[0], DATEFORMAT)
-    
-    # add to db
+@help
+def get_task(bot, update, command):
+    upd = up_data(update)
+    tz = timezones.get(upd.user_id)
+    today = resolve_day(None, upd.date, tz)
+
     with dbm(upd.user_id) as db:
-        db.add(day, message)
+        if command.text in SPANS:
+            end = resolve_day(f"in {SPANS[command.text] - 1} days", upd.date, tz)
+            recurring.materialize(db, today, end, today)
+            days = db.next_n_days(today, SPANS[command.text])
+            where = f"this {command.text}"
+        elif command.until:
+            start, end = sorted([resolve_day(command.time, upd.date, tz),
+                                 resolve_day(command.until, upd.date, tz)])
+            recurring.materialize(db, start, end, today)
+            days = db.get_range(start, end)
+            where = f"{start}..{end}"
+        elif not command.time:
+            recurring.materialize(db, today, today, today)
+            days = db.days() # sorted by date ascending
+            where = None
+        else:
+            day = resolve_day(command.time, upd.date, tz)
+            recurring.materialize(db, day, day, today)
+            days = [day] if db.get(day) else []
+            where = day
+
+        blocks = render_days(db, days)
 
-    logger.info(f"Adding '{message}' for user '{upd.user_id}:{upd.username}' to '{day}'")
-    update.message.reply_text("Updating tasklist ...")
+    if not blocks:
+        reply = "*Todo List* is empty!"
+        if where:
+            reply = f"*{where}* - {reply}"
+        blocks = [reply]
 
+    for reply in split_message(blocks):
+        send_reply(update, reply, parse_mode=PARSEMODE)
+    logger.info("Getting tasks for '%s:%s'", upd.user_id, upd.username)
 
 @help
-def get_task(bot, update):
+def delete_task(bot, update, command):
     upd = up_data(update)
+    tz = timezones.get(upd.user_id)
+    today = resolve_day(None, upd.date, tz)
+    day = resolve_day(command.time, upd.date, tz)
+    where = "*today*" if day == today else day
 
-    reply = ""
-    message = upd.text.split()[1:]
     with dbm(upd.user_id) as db:
-        if not message:
-            data = db.get()
-            day = datetime.strftime(upd.date, DATEFORMAT) # default get today
+        if command.all:
+            db.delete(force=True)
+            reply = "Deleting database"
+            logger.info("Deleting all tasks for '%s:%s'", upd.user_id, upd.username)
+
+        elif not command.numbers:
+            rules = _rules_of(db, day, today)
+            try:
+                db.delete(day)
+                reply = f"Deleting {'*today*' if day == today else f'day *{day}*'}"
+                logger.info("Deleting '%s' for '%s:%s'", day, upd.user_id, upd.username)
+            except KeyError:
+                reply = f"{day} not found!"
+            else:
+                if rules: # recurring tasks shouldn't come back
+                    recurring.skip(upd.user_id, day, rules, today)
+
         else:
-            day, _ = parse_date(message, update)
-            day = datetime.strftime(day, DATEFORMAT)
-            data = db.get(day)
-            if not data:
-                reply += f"*{day}* - "
-    
-    if not data:
-        reply += "*Todo List* is empty!"
-    elif len(data.keys()) == 1:
-        reply += f"*{day}*\n"
-        try:
-            data = data['tasks']
-        except KeyError:
+            tasks = ", ".join(command.numbers)
+            rules = _rules_of(db, day, today, command.numbers)
             try:
-                data = data[day]['tasks']
+                db.delete_many(day, command.numbers)
+                reply = f"Deleting task {tasks} from {where}"
+                logger.info("Deleting '%s' from '%s' for '%s:%s'", tasks, day, upd.user_id, upd.username)
             except KeyError:
-                day, data = list(data.items())[0]
-                data = data['tasks']
-                reply = f"*{day}*\n"
-        
-        for num, task in data.items():
-            if task['done']:
-                reply += f"`{num})` \u2705 "
+                reply = f"Task {_missing(db, day, command.numbers)} not found in {day}"
             else:
-                reply += f"`{num})` \u274c "
-            reply += f"{task['text']}\n"
+                if rules:
+                    recurring.skip(upd.user_id, day, rules, today)
+
+    send_reply(update, reply, parse_mode=PARSEMODE)
+
+
+def _missing(db, day, numbers) -> str:
+    """Those of task `numbers` not in `day`, for replies"""
+    return ", ".join(number for number in numbers if db.get(day, number) is None)
+
+
+def _rules_of(db, day, today, numbers=None) -> list:
+    """Rules of the recurring tasks `numbers` (all without) of `day` from `today` on"""
+    data = db.get(day) if day >= today else None
+    if not data:
+        return []
+    return [task["rule"] for num, task in data["tasks"].items()
+            if "rule" in task and (numbers is None or num in numbers)]
 
-    else:
-        data = data.items()
-        items = [(day, day_data) for day, day_data in data]
-        items.sort(key=lambda x: x[0]) # sort by date ascending
-
-        days = []
-        for day, data in items:
-            reply_piece = f"*{day}*\n"
-            for num, task in data['tasks'].items():
-                if task['done']:
-                    reply_piece += f"`{num})` \u2705 "
-                else:
-                    reply_piece += f"`{num})` \u274c "
-                reply_piece += f"{task['text']}\n"
-            days.append(reply_piece)
-
-        reply += "\n".join(days)
-
-    update.message.reply_text(reply, parse_mode=PARSEMODE)
-    logger.info(f"Getting tasks for '{upd.user_id}:{upd.username}'")
 
 @help
-def delete_task(bot, update):
+def edit_task(bot, update, command):
     upd = up_data(update)
-    day = datetime.strftime(upd.date, DATEFORMAT)
-    reply = ""
+    day = resolve_day(command.time, upd.date, timezones.get(upd.user_id))
+    number = command.numbers[0]
+
+    with dbm(upd.user_id) as db:
+        try:
+            db.edit(day, number, command.text)
+            reply = f"Editing task {number} on {day}"
+            logger.info("Editing '%s' from '%s' for '%s:%s'", number, day, upd.user_id, upd.username)
+        except KeyError:
+            reply = f"Task _{number}_ on *{day}* not found!"
+
+    send_reply(update, reply, parse_mode=PARSEMODE)
 
-    message = upd.text.split()[1:]
 
-    if not message:
-        reply += "Tell me what to delete."
-        logger.debug("/delete command empty")
-        update.message.reply_text(reply)
-        return
+@help
+def done_task(bot, update, command):
+    upd = up_data(update)
+    tz = timezones.get(upd.user_id)
+    day = resolve_day(command.time, upd.date, tz)
+    where = f"on {day} " if command.time else ""
 
     with dbm(upd.user_id) as db:
-        date_match = re.match(DATEREGEX, message[0])
-        if len(message) == 1:
-            if message[0] == 'all':
-                db.delete(force=True)
-                reply += "Deleting database"
-                logger.info("Deleting all tasks for '{upd.user_id}:{upd.username}'")
-
-            # Without specifying date default delete task from today
-            if message[0].isdigit():
-                try:
-                    db.delete(day, message[0])
-                    reply += f"Deleting task {message[0]} from *today*"
-                    logger.info(f"Deleting '{message[0]}' on '{day}' for '{upd.user_id}:{upd.username}'")
-                except KeyError:
-                    reply += f"Task {message[0]} in list {day} not found!"
-                
-            if date_match:
-                if message[0] in tomorrow:
-                    message[0] = datetime.strftime(upd.date+timedelta(days=1), DATEFORMAT)
-                try:
-                    if message[0] == 'today':
-                        db.delete(day)
-                        reply += "Deleting *today*"
-                    else:
-                        db.delete(message[0])
-                        reply += f"Deleting day *{message[0]}*"
-                    logger.info(f"Deleting '{message[0]}' for '{upd.user_id}:{upd.username}'")
-                except KeyError:
-                    reply += f"{message[0]} not found!"
-
-            if not reply:
-                reply += f"\"{message[0]}\" not found!"
-
-            
-        else:
-            if not date_match:
-                reply += f"{message[0]} not found!"
-            else:
-                if message[0] in tomorrow:
-                    message[0] = datetime.strftime(upd.date+timedelta(days=1), DATEFORMAT)
-                if message[1].isdigit():
-                    try:
-                        db.delete(message[0], message[1])
-                        reply += f"Deleting task {message[1]} from {message[0]}"
-                        logger.info(f"Deleting '{message[1]}' from '{message[0]}' for '{upd.user_id}:{upd.username}'")
-                    except KeyError:
-                        reply += f"Task {message[1]} not found in {message[0]}"
-
-        update.message.reply_text(reply, parse_mode=PARSEMODE)
+        # numbers refer to the list including the day's recurring tasks
+        recurring.materialize(db, day, day, resolve_day(None, upd.date, tz))
+        try:
+            flipped = db.done_many(day, command.numbers)
+            replies = []
+            for done in (1, 0):
+                tasks = [number for number, state in flipped.items() if state == done]
+                if tasks:
+                    logmessage = 'DONE' if done else 'UNDONE'
+                    replies.append(f"Marking task {', '.join(tasks)} {where}*{logmessage}*")
+                    logger.info("Marking '%s' %s on '%s' for '%s:%s'", ", ".join(tasks), logmessage, day, upd.user_id, upd.username)
+            reply = "\n".join(replies)
+        except KeyError:
+            reply = f"Task {_missing(db, day, command.numbers)} {where}not found!"
+
+    send_reply(update, reply, parse_mode=PARSEMODE)
+
 
 @help
-def edit_task(bot, update):
+def find_task(bot, update, command):
     upd = up_data(update)
-    day = datetime.strftime(upd.date, DATEFORMAT)
-    reply = ""
-    
-    message = upd.text.split()[1:]
-    if not message:
-        reply += "Tell me what task to edit"
+    limit = config.get("search", {}).get("limit", 50)
 
-    elif len(message) < 2:
-        reply += "I didn't get that :(\nType: /edit _help_"
-    else:
-        with dbm(upd.user_id) as db:
+    with dbm(upd.user_id) as db:
+        hits = db.find(command.text, limit)
+        days = {}
+        for day, num in hits:
+            days.setdefault(day, {})[num] = dict(db.get(day, num))
 
-            if message[0].isdigit():
-                text = " ".join(message[1:])
-                try:
-                    db.edit(day, message[0], text)
-                    reply += f"Editing task {message[0]} on {day}"
-                    logger.info(f"Editing '{message[1]}' from '{day}' for '{upd.user_id}:{upd.username}'")
-                except KeyError:
-                    reply += f"Task {message[0]} not found!"
-            else:
-                if not message[1].isdigit():
-                    reply += f"Second argument should be _task number_\nType: /edit _help_"
-                else:
-                    time = message[0]
-                    date_match = re.match(DATEREGEX, time)
-                    if date_match:
-                        if time in tomorrow:
-                            time = upd.date + timedelta(days=1)
-                            time = str(time.date())
-                    else:
-                        update.message.reply_text(f"*\"{time}\"* not found!", parse_mode=PARSEMODE)
-                        return
-                    
-
-                    text = " ".join(message[2:])
-                    try:
-                        db.edit(time, message[1], text)
-                        reply += f"Editing task {message[1]} on {time}"
-                        logger.info(f"Editing '{message[1]}' from '{time}' for '{upd.user_id}:{upd.username}'")
-                    except KeyError:
-                        reply += f"Task _{message[1]}_ on *{time}* not found!"
-
-    update.message.reply_text(reply, parse_mode=PARSEMODE)
+    blocks = [format_day(day, tasks) for day, tasks in days.items()]
+    if not blocks:
+        blocks = [f"No tasks with *{command.text}* found!"]
+    elif len(hits) == limit:
+        blocks.insert(0, f"Latest {limit} tasks with *{command.text}*:\n")
 
+    for reply in split_message(blocks):
+        send_reply(update, reply, parse_mode=PARSEMODE)
+    logger.info("Finding '%s' for '%s:%s', %d found", command.text, upd.user_id, upd.username, len(hits))
 
 
 @help
-def done_task(bot, update):
+def every_task(bot, update, command):
     upd = up_data(update)
-    time = datetime.strftime(upd.date, DATEFORMAT)
-    reply = ""
 
-    message = upd.text.split()[1:]
+    if command.rule:
+        today = resolve_day(None, upd.date, timezones.get(upd.user_id))
+        number = recurring.add(upd.user_id, command.rule, command.text, today)
+        reply = f"Adding rule {number}: _{command.text}_ {describe_rule(command.rule)}"
+        logger.info("Adding rule '%s' '%s' for '%s:%s'", command.rule, command.text, upd.user_id, upd.username)
+    elif command.numbers:
+        number = command.numbers[0]
+        today = resolve_day(None, upd.date, timezones.get(upd.user_id))
+        with dbm(upd.user_id) as db:
+            removed = recurring.remove(db, number, today)
+        if removed:
+            reply = f"Deleting rule {number} and its unfinished tasks from today on"
+            logger.info("Deleting rule '%s' for '%s:%s'", number, upd.user_id, upd.username)
+        else:
+            reply = f"Rule {number} not found!"
+    else:
+        rules = recurring.rules(upd.user_id)
+        lines = [f"`{number})` {rule['text']} _{describe_rule(rule['rule'])}_"
+                 for number, rule in rules.items()]
+        reply = "*Recurring tasks*\n" + "\n".join(lines) if lines else "No recurring tasks!"
+
+    send_reply(update, reply, parse_mode=PARSEMODE)
 
-    if not message:
-        reply += "Which task?"
+
+@help
+def set_timezone(bot, update, command):
+    upd = up_data(update)
+
+    if not command.text:
+        tz = timezones.get(upd.user_id)
+        reply = f"Your timezone is *{tz}*" if tz else "Timezone not set, using server time"
     else:
-        with dbm(upd.user_id) as db:
-            if message[0].isdigit():
-                number = message[0]
-                try:
-                    done = db.done(time, number)
-                    reply += f"Marking task {number} "
-                    if done:
-                        reply += "*DONE*"
-                        logmessage = 'DONE'
-                    else:
-                        reply += "*UNDONE*"
-                        logmessage = 'UNDONE'
-
-                    logger.info(f"Marking '{number}' {logmessage} on '{time}' for '{upd.user_id}:{upd.username}'")
-                except KeyError:
-                    reply += f"Task {number} not found!"
-            else:
-                time = message[0]
-                number = message[1]
-                
-                if not number.isdigit():
-                    update.message.reply_text(f"*{number}* is not a digit!")
-                    return
-
-                date_match = re.match(DATEREGEX, time)
-                if date_match:
-                    if time in tomorrow:
-                        time = datetime.strftime(upd.date + timedelta(days=1), DATEFORMAT)
-                        time = str(time)
-                    try:
-                        done = db.done(time, number)
-                        reply += f"Marking task {number} on {time} "
-                        if done:
-                            reply += "*DONE*"
-                            logmessage = 'DONE'
-                        else:
-                            reply += "*UNDONE*"
-                            logmessage = 'DONE'
-
-                        logger.debug(f"Marking '{number}' {logmessage} on '{time}' for '{upd.user_id}:{upd.username}'")
-                    except KeyError:
-                        reply += f"Task {number} on {time} not found!"
-                else:
-                    reply += "*\"{time}\"* not found!"
-
-
-    update.message.reply_text(reply, parse_mode=PARSEMODE)
-    pass
-
-        
+        try:
+            timezones.set(upd.user_id, command.text)
+            reply = f"Timezone set to *{command.text}*"
+        except ValueError as e:
+            reply = str(e)
+
+    send_reply(update, reply, parse_mode=PARSEMODE)
+
 
 def daily_maintenance(bot, job):
-    """Moves all tasks from today to day after that at the end of the day"""
+    """Moves unfinished tasks of the day that just ended to the next day
+
+    and archives old days when configured.
+    """
 
-    dtoday = datetime.today() 
-    #dtoday = datetime.today() - timedelta(days=1)
+    # job runs right after midnight
+    dtoday = datetime.today() - timedelta(days=1)
     today = datetime.strftime(dtoday, DATEFORMAT)
-    tomorrow = datetime.strftime(dtoday + timedelta(days=1), DATEFORMAT) 
 
-    with dbm(upd.user_id) as db:
-        today_data = db.get(today)['tasks']
-        db.add(tomorrow, today_data)
-        db.delete(today)
-    
-    message = f"Moved {today} data to {tomorrow} at {dtoday.time().strftime('%H:%M:%S')}" 
+    rollover_config = config.get("rollover", {})
+    summary = rollover(today,
+                       workers=rollover_config.get("workers", 8),
+                       processes=rollover_config.get("processes", False),
+                       rules=recurring)
+
+    message = (f"Moved {summary['moved']} tasks of {summary['users']} users "
+               f"from {today} in {summary['duration']:.1f}s "
+               f"({summary['users_per_sec']:.0f} users/s)")
+    if summary['errors']:
+        message += f", {summary['errors']} failed"
+
+    if dbm.cache.archive:
+        archived = archive_old(dbm.cache.archive, today,
+                               config["archive"].get("after_days", 90))
+        message += f"\nArchived {archived['days']} days of {archived['users']} users"
     logger.info(message)
-    bot.send_message(chat_id=config['auth']['myid'], text=message)
+    if outbox:
+        outbox.send(config['auth']['myid'], message)
+    else:
+        bot.send_message(chat_id=config['auth']['myid'], text=message)
 
 
-def parse_date(datestring: list, update):
-    """Calculates datetime.timedelta from natural input.
-       If no input is found, defaults to today. 
+def flush_db(bot, job):
+    """Writes back dirty cached databases"""
+    dbm.cache.flush()
 
-       Returns:
-       List[datetime.datetime, str(message)]
-    """
 
-    today = datetime.today()
-    accepted_keywords = {'today': today,
-                         'tomorrow': today + timedelta(days=1), 
-                         'tmr': today + timedelta(days=1)}
-    
-    response = []
-    wordsused = 0
-
-    if datestring[0] in accepted_keywords.keys():
-        response.append(accepted_keywords[datestring[0]])
-        wordsused += 1
-
-    elif datestring[0] == "in":
-        # Expected pattern is: int(n) str(timeperiod)
-        # e.g. 2 days | 5 w | 3 months | 10 mins
-
-        #make sure first arg is a number
-        if not datestring[1].isdigit():
-            update.message.reply_text("argument is not a digit")
-            return None
-
-        test = " ".join(datestring[1:3])
-        match = match_re(test)
-
-        # regext test
-        if not match:
-            return None
-        
-        num, period = datestring[1:3]
-        period = period.lower()
-        num = int(num)
-
-        if period[:2] == 'mo': # handle minute & month collision
-            delta = timeperiods[period[:2]](num)
-        else:
-            delta = timeperiods[period[0]](num)
-        response.append(today + delta)
-        wordsused += 3
+def setup(dispatcher, jobq, bot, shard=None):
+    """Registers handlers and jobs, starts the optional outbox and async dispatch
 
+    Worker `shard` of the sharded mode serves its metrics on the
+    configured port + 1 + shard.
+    """
+    global outbox, aiodispatcher, reminders, deduplicator
+    suffix = "" if shard is None else f".shard-{shard}"
+
+    outbox_config = config.get("outbox")
+    if outbox_config:
+        outbox = Outbox(bot, **outbox_config)
+        outbox.start()
+
+    # optionally run handlers on the asyncio pipeline
+    dispatch_config = config.get("dispatch", {})
+    if dispatch_config.get("mode") == "async":
+        aiodispatcher = AsyncDispatcher(dispatch_config.get("workers", 8))
+        aiodispatcher.start()
+        wrap = aiodispatcher.handler
     else:
-        response.append(today)
-    
-    response.append(" ".join(datestring[wordsused:]))
-    return response
+        wrap = lambda func: func
+
+    # telegram retries updates when we are slow, handle every one once
+    deduplicator = Deduplicator(f"{BOTDIR}/updates{suffix}.log",
+                                config.get("dedup", {}).get("size", 10000))
+    deduplicator.load()
+
+    # optional token buckets keep one user from taking all handler threads
+    admission_config = config.get("admission")
+    admission = Admission(send_reply, **admission_config) if admission_config else None
+
+    handlers = {'start': start,
+                'add': add_task,
+                'tasks': get_task,
+                'del': delete_task,
+                'edit': edit_task,
+                'done': done_task,
+                'find': find_task,
+                'every': every_task,
+                'tz': set_timezone}
+    for command, callback in handlers.items():
+        callback = metrics.instrument(command, callback)
+        if admission:
+            callback = admission.wrap(command, callback)
+        callback = deduplicator.wrap(callback)
+        dispatcher.add_handler(CommandHandler(command, wrap(callback)))
+
+    # metrics on http://host:port/metrics
+    metrics_config = config.get("metrics")
+    if metrics_config:
+        metrics.registry.gauge("db_cache_entries", lambda: len(dbm.cache.entries))
+        metrics.registry.gauge("db_cache_dirty", lambda: len(dbm.cache.pending))
+        if admission:
+            metrics.registry.gauge("handlers_running", lambda: sum(admission.running.values()))
+        if outbox:
+            metrics.registry.gauge("outbox_depth", lambda: outbox.stats()["depth"])
+        port = metrics_config.get("port", 9100)
+        metrics.serve(port if shard is None else port + 1 + shard,
+                      metrics_config.get("host", "127.0.0.1"))
+
+    # one job fires the reminders of all users
+    def send_reminder(user, text):
+        if outbox:
+            outbox.send(user, text)
+        else:
+            bot.send_message(chat_id=user, text=text)
+
+    reminders_config = config.get("reminders", {})
+    reminders = Reminders(f"{BOTDIR}/reminders{suffix}.idx", send_reminder,
+                          reminders_config.get("batch", 500))
+    reminders.load()
+
+    #jobs
+    jobq.run_repeating(flush_db, interval=dbm.cache.interval or 30, first=0)
+    jobq.run_daily(daily_maintenance, time=time(0,1))
+    jobq.run_repeating(reminders.fire, interval=reminders_config.get("tick", 5), first=0)
+
+
+def shutdown():
+    """Finishes queued callbacks and messages and writes back the db cache"""
+    if aiodispatcher:
+        aiodispatcher.stop()
+    if outbox:
+        outbox.stop()
+    if deduplicator:
+        deduplicator.close()
+    dbm.cache.flush(wait=True)
 
 
 if __name__ == "__main__":
@@ -418,21 +476,15 @@ if __name__ == "__main__":
     con = config.get("con")
     args = sys.argv[1:]
 
-    updater = Updater(token=auth.get("token"))
-    dispatcher = updater.dispatcher
-    jobq = updater.job_queue
-
-    dispatcher.add_handler(CommandHandler('start', start))
-    dispatcher.add_handler(CommandHandler('add', add_task))
-    dispatcher.add_handler(CommandHandler('tasks', get_task))
-    dispatcher.add_handler(CommandHandler('del', delete_task))
-    dispatcher.add_handler(CommandHandler('edit', edit_task))
-    dispatcher.add_handler(CommandHandler('done', done_task))
-
+    # webhook front routing updates to worker processes by user
+    shards_config = config.get("shards")
+    if args and shards_config:
+        shards.run(config, shards_config.get("workers", 4))
+        sys.exit()
 
-    #jobs
-    #jobq.run_daily(daily_maintenance, time=time(0,1))
-    #jobq.run_repeating(daily_maintenance, first=0, interval=600)
+    updater = Updater(token=auth.get("token"))
+    setup(updater.dispatcher, updater.job_queue, updater.bot)
+    atexit.register(shutdown)
 
     if args:
         updater.start_webhook(listen="0.0.0.0",
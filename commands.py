@@ -0,0 +1,197 @@
+"""Command grammar of the bot
+
+Every update is tokenized once by `parse`, handlers get a `Command`:
+
+  /add [time] text, one task per line
+  /tasks [time | week | month | time..time]
+  /del all | [time] [number ...]
+  /edit [time] number text
+  /done [time] number
+  /tz [timezone]
+  /find words
+  /every rule text | /every del number | /every
+
+time is any phrase of `dates`, e.g. `tmr`, `2019-03-01`, `in 2 months`, `next fri`.
+"""
+import re
+from collections import namedtuple
+
+from dates import match as parse_time
+from recurring import match as parse_rule
+
+# time is a normalized phrase of `dates.match`, None without time,
+# until is the last day of a range of days, rule one of `recurring.match`
+Command = namedtuple('Command', 'name, help, time, numbers, text, all, until, rule',
+                     defaults=(None, None))
+
+HELP = ('help', 'h')
+
+# /tasks spans, number of days starting today
+SPANS = {'week': 7, 'month': 30}
+
+# words and line breaks, for commands taking one item per line
+LINES_RE = re.compile(r"\S+|\n")
+MULTILINE = ('add',)
+
+
+class ParseError(Exception):
+    """Command couldn't be parsed, `reply` is the markdown answer to it"""
+
+    def __init__(self, code, reply):
+        super().__init__(reply)
+        self.code = code
+        self.reply = reply
+
+
+def _numbers(tokens, start, usage):
+    """Task numbers from `tokens[start]` on, each once in the given order"""
+    for number in tokens[start:]:
+        if not number.isdigit():
+            raise ParseError('number', f"*{number}* is not a task number!\nType: /{usage} _help_")
+    return tuple(dict.fromkeys(str(int(number)) for number in tokens[start:]))
+
+
+def _lines(tokens) -> list:
+    lines = [[]]
+    for token in tokens:
+        if token == "\n":
+            lines.append([])
+        else:
+            lines[-1].append(token)
+    return [" ".join(line) for line in lines if line]
+
+
+def _parse_add(args):
+    multiline = "\n" in args
+    while multiline and args and args[0] == "\n":
+        args = args[1:]
+    time, used = parse_time(args)
+    if not used and args and args[0].lower() == 'in':
+        raise ParseError('time', "Specified timeperiod not found!")
+    text = "\n".join(_lines(args[used:])) if multiline else " ".join(args[used:])
+    if not text:
+        raise ParseError('empty', "Tell me what to add.")
+    return time, (), text, False
+
+
+def _parse_day(args):
+    time, used = parse_time(args)
+    if not used or used < len(args):
+        raise ParseError('time', f"*\"{' '.join(args)}\"* not found!")
+    return time
+
+
+def _parse_tasks(args):
+    if not args:
+        return None, (), "", False
+    if len(args) == 1 and args[0].lower() in SPANS:
+        return None, (), args[0].lower(), False
+
+    text = " ".join(args)
+    if ".." in text:
+        start, end = text.split("..", 1)
+        return _parse_day(start.split()), (), "", False, _parse_day(end.split())
+    return _parse_day(args), (), "", False
+
+
+def _parse_del(args):
+    if not args:
+        raise ParseError('empty', "Tell me what to delete.")
+    if args == ['all']:
+        return None, (), "", True
+    if args[0].isdigit():
+        return None, _numbers(args, 0, 'del'), "", False
+
+    time, used = parse_time(args)
+    if not used:
+        raise ParseError('time', f"\"{args[0]}\" not found!")
+    return time, _numbers(args, used, 'del'), "", False
+
+
+def _parse_edit(args):
+    if not args:
+        raise ParseError('empty', "Tell me what task to edit")
+    if len(args) < 2:
+        raise ParseError('usage', "I didn't get that :(\nType: /edit _help_")
+    if args[0].isdigit():
+        return None, (args[0],), " ".join(args[1:]), False
+
+    time, used = parse_time(args)
+    if not used:
+        raise ParseError('time', f"*\"{args[0]}\"* not found!")
+    if len(args) <= used or not args[used].isdigit():
+        raise ParseError('number', "Second argument should be _task number_\nType: /edit _help_")
+    return time, (args[used],), " ".join(args[used + 1:]), False
+
+
+def _parse_done(args):
+    if not args:
+        raise ParseError('empty', "Which task?")
+    if args[0].isdigit():
+        return None, _numbers(args, 0, 'done'), "", False
+
+    time, used = parse_time(args)
+    if not used:
+        raise ParseError('time', f"*\"{args[0]}\"* not found!")
+    if len(args) <= used:
+        raise ParseError('empty', "Which task?")
+    return time, _numbers(args, used, 'done'), "", False
+
+
+def _parse_find(args):
+    if not args:
+        raise ParseError('empty', "What should I look for?")
+    return None, (), " ".join(args), False
+
+
+def _parse_every(args):
+    if not args:
+        return None, (), "", False
+    if args[0] == 'del':
+        if len(args) != 2:
+            raise ParseError('usage', "Which rule?\nType: /every _help_")
+        return None, _numbers(args, 1, 'every'), "", False
+
+    rule, used = parse_rule(args)
+    if not used:
+        raise ParseError('rule', f"*\"{args[0]}\"* is not a rule!\nType: /every _help_")
+    text = " ".join(args[used:])
+    if not text:
+        raise ParseError('empty', "Tell me what to repeat.")
+    return None, (), text, False, None, rule
+
+
+GRAMMAR = {
+    'add': _parse_add,
+    'tasks': _parse_tasks,
+    'del': _parse_del,
+    'edit': _parse_edit,
+    'done': _parse_done,
+    'find': _parse_find,
+    'every': _parse_every,
+}
+
+# plain /command without bot name or capitals, skips normalizing the name
+NAMES = {f"/{name}": name for name in GRAMMAR}
+
+
+def parse(text: str) -> Command:
+    """Parses a command message
+
+    Raises `ParseError` with the reply for the user on invalid input
+    """
+    tokens = text.split()
+    if not tokens:
+        return Command("", False, None, (), "", False)
+    name = NAMES.get(tokens[0]) or tokens[0][1:].split('@', 1)[0].lower()
+    args = tokens[1:]
+    if name in MULTILINE and "\n" in text:
+        args = LINES_RE.findall(text)[1:]
+
+    if len(args) == 1 and args[0] in HELP:
+        return Command(name, True, None, (), "", False)
+
+    rule = GRAMMAR.get(name)
+    if rule is None:
+        return Command(name, False, None, (), " ".join(args), False)
+    return Command(name, False, *rule(args))
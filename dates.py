@@ -0,0 +1,262 @@
+"""Resolution of time phrases to days
+
+Phrases are normalized by `match` and resolved to a YYYY-MM-DD day
+relative to the user's local date by `resolve_day`:
+
+  today, tomorrow/tmr, yesterday
+  YYYY-MM-DD, march 5 / mar 5
+  in N seconds/minutes/hours/days/weeks/months/years
+  friday, this fri (today or later), next fri (after today)
+
+Months and years are calendar arithmetic, the day is clamped to the
+end of shorter months (jan 31 + 1 month is feb 28/29).
+"""
+import calendar
+import json
+import logging
+import re
+import threading
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+
+from extras import DATEFORMAT, PERIOD_RE
+from storage import write_file
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError: # python < 3.9, only UTC offsets
+    ZoneInfo = None
+
+logger = logging.getLogger(__name__)
+
+KEYWORDS = {'today': 'today', 'tomorrow': 'tomorrow', 'tmr': 'tomorrow',
+            'yesterday': 'yesterday'}
+
+DAYNAMES = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+WEEKDAYS = {'tues': 1, 'thur': 3, 'thurs': 3}
+for num, name in enumerate(DAYNAMES):
+    WEEKDAYS[name] = WEEKDAYS[name[:3]] = num
+
+MONTHNAMES = ('january', 'february', 'march', 'april', 'may', 'june', 'july',
+              'august', 'september', 'october', 'november', 'december')
+MONTHS = {'sept': 9}
+for num, name in enumerate(MONTHNAMES, start=1):
+    MONTHS[name] = MONTHS[name[:3]] = num
+
+UNITS = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days',
+         'w': 'weeks', 'mo': 'months', 'y': 'years'}
+SUBDAY = ('seconds', 'minutes', 'hours')
+
+DAY_RE = re.compile(r"^(\d{1,2})(st|nd|rd|th)?$")
+OFFSET_RE = re.compile(r"^(?:utc|gmt)?([+-])(\d{1,2})(?::?(\d{2}))?$")
+
+
+def _is_date(token):
+    if len(token) != 10 or token[4] != '-' or token[7] != '-':
+        return False
+    return _valid_date(token)
+
+
+@lru_cache(maxsize=1024)
+def _valid_date(token):
+    try: # much cheaper than strptime
+        date(int(token[:4]), int(token[5:7]), int(token[8:]))
+    except ValueError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=256)
+def _unit(period):
+    """Unit of a lowercase period word like `days` or `mo`, None for others"""
+    if not PERIOD_RE.match(f"1 {period}"):
+        return None
+    return UNITS['mo' if period[:2] == 'mo' else period[0]] # minute & month collision
+
+
+def match(tokens, i=0):
+    """Normalized time phrase starting at `tokens[i]`
+
+    Abbreviated weekdays are only recognized after this/next/on, so
+    tasks starting with words like "sun" or "sat" stay intact.
+
+    Returns
+    (phrase or None, number of tokens used)
+    """
+    if i >= len(tokens):
+        return None, 0
+
+    token = tokens[i].lower()
+    keyword = KEYWORDS.get(token)
+    if keyword:
+        return keyword, 1
+
+    if _is_date(token):
+        return token, 1
+
+    after = tokens[i + 1].lower() if i + 1 < len(tokens) else ""
+
+    if token == 'in' and i + 2 < len(tokens) and after.isdigit():
+        unit = _unit(tokens[i + 2].lower())
+        if unit:
+            return f"in {int(after)} {unit}", 3
+
+    if token in DAYNAMES:
+        return f"this {token[:3]}", 1
+    if token in ('this', 'next', 'on') and after in WEEKDAYS:
+        which = 'next' if token == 'next' else 'this'
+        return f"{which} {DAYNAMES[WEEKDAYS[after]][:3]}", 2
+
+    if token in MONTHS and after:
+        day = DAY_RE.match(after)
+        if day and 1 <= int(day.group(1)) <= 31:
+            return f"{MONTHNAMES[MONTHS[token] - 1][:3]} {int(day.group(1))}", 2
+
+    return None, 0
+
+
+def add_months(day: date, months: int) -> date:
+    """`day` moved by calendar months, clamped to the end of the month"""
+    month = day.month - 1 + months
+    year = day.year + month // 12
+    month = month % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+@lru_cache(maxsize=4096)
+def resolve(phrase: str, tz: str, today: date) -> str:
+    """YYYY-MM-DD day of a day based `phrase` for the user's local `today`
+
+    `tz` is part of the key only, `today` is already local to it.
+    """
+    if phrase == 'today':
+        return today.strftime(DATEFORMAT)
+    if phrase == 'tomorrow':
+        return (today + timedelta(days=1)).strftime(DATEFORMAT)
+    if phrase == 'yesterday':
+        return (today - timedelta(days=1)).strftime(DATEFORMAT)
+
+    words = phrase.split()
+    if len(words) == 1: # YYYY-MM-DD
+        return phrase
+
+    if words[0] == 'in':
+        num, unit = int(words[1]), words[2]
+        if unit == 'months':
+            day = add_months(today, num)
+        elif unit == 'years':
+            day = add_months(today, num * 12)
+        else:
+            day = today + timedelta(**{unit: num})
+        return day.strftime(DATEFORMAT)
+
+    if words[0] in ('this', 'next'):
+        ahead = (WEEKDAYS[words[1]] - today.weekday()) % 7
+        if words[0] == 'next' and not ahead:
+            ahead = 7
+        return (today + timedelta(days=ahead)).strftime(DATEFORMAT)
+
+    # month day, the next one from today on
+    month, num = MONTHS[words[0]], int(words[1])
+    for year in range(today.year, today.year + 9): # feb 29 may be years away
+        if num <= calendar.monthrange(year, month)[1]:
+            day = date(year, month, num)
+            if day >= today:
+                return day.strftime(DATEFORMAT)
+    raise ValueError(f"No day for '{phrase}'")
+
+
+def get_timezone(name):
+    """tzinfo of an IANA zone name or a UTC offset like +2, -05:30, UTC+1
+
+    Raises `ValueError` for unknown zones
+    """
+    if not name or name.lower() in ('utc', 'gmt'):
+        return timezone.utc
+
+    offset = OFFSET_RE.match(name.lower())
+    if offset:
+        sign, hours, minutes = offset.groups()
+        delta = timedelta(hours=int(hours), minutes=int(minutes or 0))
+        if delta >= timedelta(hours=24):
+            raise ValueError(f"Invalid UTC offset '{name}'")
+        return timezone(-delta if sign == '-' else delta)
+
+    if ZoneInfo is None:
+        raise ValueError(f"Unknown timezone '{name}', use a UTC offset like +2")
+    try:
+        return ZoneInfo(name)
+    except Exception: # ZoneInfoNotFoundError, invalid keys
+        raise ValueError(f"Unknown timezone '{name}'")
+
+
+def local_now(now: datetime, tz=None) -> datetime:
+    """`now` in timezone `tz` (name), naive `now` is the server's local time"""
+    if tz is None:
+        return now
+    return now.astimezone(_tzinfo(tz))
+
+
+@lru_cache(maxsize=256)
+def _tzinfo(name):
+    return get_timezone(name)
+
+
+def resolve_day(phrase, now: datetime, tz=None) -> str:
+    """YYYY-MM-DD day of `phrase` relative to `now` in timezone `tz`
+
+    Day based phrases are memoized per (phrase, tz, local date), phrases
+    of seconds to hours depend on the time of day and are computed.
+    """
+    now = local_now(now, tz)
+    if phrase is None:
+        return now.strftime(DATEFORMAT)
+
+    if phrase.startswith('in ') and phrase.endswith(SUBDAY):
+        _, num, unit = phrase.split()
+        return (now + timedelta(**{unit: int(num)})).strftime(DATEFORMAT)
+
+    return resolve(phrase, tz, now.date())
+
+
+def resolve_due(phrase, now: datetime):
+    """Unix time `phrase` points to if it's seconds to hours, else None
+
+    Only these phrases carry a time of day, used as reminder time.
+    """
+    if phrase is None or not (phrase.startswith('in ') and phrase.endswith(SUBDAY)):
+        return None
+    _, num, unit = phrase.split()
+    return int((now + timedelta(**{unit: int(num)})).timestamp())
+
+
+class Timezones:
+    """Timezones of users, persisted in a json file"""
+
+    def __init__(self, filename, default=None):
+        self.filename = filename
+        self.default = default
+        self.lock = threading.Lock()
+        try:
+            with open(filename) as f:
+                self.zones = json.load(f)
+        except FileNotFoundError:
+            self.zones = {}
+
+    def get(self, user):
+        return self.zones.get(str(user), self.default)
+
+    def set(self, user, name):
+        """Sets timezone of `user`, None resets it to the default
+
+        Raises `ValueError` for unknown zones
+        """
+        if name is not None:
+            _tzinfo(name)
+        with self.lock:
+            if name is None:
+                self.zones.pop(str(user), None)
+            else:
+                self.zones[str(user)] = name
+            write_file(self.filename, json.dumps(self.zones, indent=2).encode())
+        logger.info("Timezone of '%s' set to %s", user, name)
@@ -1,20 +1,261 @@
-import json
+import heapq
+import itertools
 import logging
+from bisect import bisect_left, bisect_right
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from os import path
 
+import metrics
+from extras import DATEFORMAT
+from search import SearchIndex
+from storage import JSONStorage, remove_tasks
+
 BOTDIR = path.abspath(path.curdir)
 
 logger = logging.getLogger(__name__)
-filehandler = logging.FileHandler('db.log')
-filehandler.setLevel(logging.DEBUG)
 
-formatter = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s | %(message)s')
-filehandler.setFormatter(formatter)
 
-logger.addHandler(filehandler)
+class DayIndex:
+    """Days of one user's db in ascending order, for range queries"""
+
+    def __init__(self, days=()):
+        self.days = sorted(days)
+
+    def add(self, day):
+        i = bisect_left(self.days, day)
+        if i == len(self.days) or self.days[i] != day:
+            self.days.insert(i, day)
+
+    def discard(self, day):
+        i = bisect_left(self.days, day)
+        if i < len(self.days) and self.days[i] == day:
+            del self.days[i]
+
+    def clear(self):
+        self.days.clear()
+
+    def range(self, start, end) -> list:
+        """Days from `start` to `end`, both included"""
+        return self.days[bisect_left(self.days, start):bisect_right(self.days, end)]
+
+
+class DBCache:
+    """Shared LRU cache of loaded user databases
+
+    Databases stay in memory between commands. Modified ones are marked
+    dirty and written back to `storage` by `flush()`, which the bot runs
+    every `interval` seconds (0 writes through on every exit), and on
+    eviction.
+
+    `DBManager` holds the user's mutex from load to store, so handlers of
+    different users can run in parallel threads. Flushing skips users
+    whose db is being modified at that moment; their owner stores them.
+
+    Days moved to the optional `archive` are read from there by
+    `DBManager.get(day)` and `get_range`, and moved back on changes.
+
+    With `locking` the storage is shared with other processes, so every
+    load reads the storage again and every store writes through, both
+    under the per-user lock taken by `DBManager`.
+
+    A db whose store failed stays dirty, the next write replaces it in
+    the storage completely, as a failed store may have been partial.
+    """
+
+    def __init__(self, storage, size=256, interval=30, locking=False, archive=None):
+        self.storage = storage
+        self.archive = archive
+        self.size = size
+        self.interval = interval
+        self.locking = locking
+        self.entries = OrderedDict()
+        self.pending = {}   # name -> operations not yet stored
+        self.failed = set() # names whose last store raised
+        self.mutexes = {}   # name -> lock held by DBManager
+        self.versions = {}  # name -> {day: version}, None is the whole db
+        self.indexes = {}   # name -> SearchIndex, built on first search
+        self.day_indexes = {}   # name -> DayIndex, built on first range query
+        self.counter = itertools.count(1)
+        self.lock = threading.RLock()
+
+    def configure(self, storage=None, size=None, interval=None, locking=None, archive=None):
+        if storage is not None:
+            self.flush(wait=True)
+        with self.lock:
+            if storage is not None:
+                self.entries.clear()
+                self.indexes.clear()
+                self.day_indexes.clear()
+                self.storage = storage
+            if size is not None:
+                self.size = size
+            if interval is not None:
+                self.interval = interval
+            if locking is not None:
+                self.locking = locking
+            if archive is not None:
+                self.archive = archive
+        self._evict()
+
+    def mutex(self, name):
+        with self.lock:
+            return self.mutexes.setdefault(name, threading.RLock())
+
+    def load(self, name):
+        with self.lock:
+            db = self.entries.get(name)
+            if db is not None and not self.locking:
+                self.entries.move_to_end(name)
+                return db
+
+        with metrics.timer("db_load_seconds"):
+            db = self.storage.load(name)
+        with self.lock:
+            self.entries[name] = db
+            self.versions[name] = {None: next(self.counter)}
+            self.indexes.pop(name, None)
+            self.day_indexes.pop(name, None)
+        self._evict()
+        return db
+
+    def index(self, name, db) -> SearchIndex:
+        """Search index of `name`, built from `db` and its archive when missing"""
+        with self.lock:
+            index = self.indexes.get(name)
+        if index is None:
+            if self.archive is not None:
+                archived = {day: data for day, data in self.archive.load(name).items()
+                            if data and day not in db}
+                if archived:
+                    db = dict(archived, **db)
+            index = SearchIndex.build(db)
+            with self.lock:
+                self.indexes[name] = index
+        return index
+
+    def day_index(self, name, db=None) -> DayIndex:
+        """Sorted days of `name`, built from `db` when missing and given"""
+        with self.lock:
+            index = self.day_indexes.get(name)
+        if index is None and db is not None:
+            index = DayIndex(db)
+            with self.lock:
+                self.day_indexes[name] = index
+        return index
+
+    def unindex(self, name, day):
+        """Drops `day` of `name` from the search index"""
+        with self.lock:
+            index = self.indexes.get(name)
+        if index is not None:
+            index.delete_day(day)
+
+    def touch(self, name, day=None):
+        """Bumps version of `day`, or of all days of `name` without `day`"""
+        with self.lock:
+            days = self.versions.setdefault(name, {})
+            if day is None:
+                days.clear()
+            days[day] = next(self.counter)
+
+    def version(self, name, day):
+        """Changes whenever `day` of `name` is modified or reloaded"""
+        with self.lock:
+            days = self.versions.get(name, {})
+            return days.get(None), days.get(day)
+
+    def day_versions(self, name) -> dict:
+        """Copy of versions of `name`, days missing in it are unmodified"""
+        with self.lock:
+            return dict(self.versions.get(name, {}))
+
+    def store(self, name, db, ops, archived=()):
+        """Mark `db` as the current dirty state of `name`
+
+        The days in `archived` were moved to the archive, they stay in
+        the search index.
+        """
+        with self.lock:
+            self.entries[name] = db
+            self.entries.move_to_end(name)
+            self.pending.setdefault(name, []).extend(ops)
+            index = self.indexes.get(name)
+        if index is not None:
+            index.apply([op for op in ops if op[0] != "delete" or op[2] is not None
+                         or op[1] not in archived] if archived else ops)
+
+        # the periodic flush job writes the others back
+        if self.locking or not self.interval:
+            self._write(name, wait=True)
+        self._evict()
+
+    def flush(self, wait=False):
+        """Writes back dirty databases
+
+        Without `wait` databases currently held by another thread are
+        left for a later flush.
+        """
+        with self.lock:
+            names = list(self.pending)
+        for name in names:
+            self._retry(name, wait)
+
+    def sync(self, name):
+        """Writes back `name` now if it is dirty"""
+        self._write(name, wait=True)
+
+    def _evict(self):
+        with self.lock:
+            over = len(self.entries) - max(self.size, 1)
+            victims = list(self.entries)[:over] if over > 0 else []
+
+        for name in victims:
+            if name in self.pending:
+                self._retry(name)
+            with self.lock:
+                if name in self.entries and name not in self.pending:
+                    del self.entries[name]
+                    self.versions.pop(name, None)
+                    self.indexes.pop(name, None)
+                    self.day_indexes.pop(name, None)
+                    logger.debug("Evicted %s from cache", name)
+
+    def _write(self, name, wait=False):
+        mutex = self.mutex(name)
+        if not mutex.acquire(blocking=wait):
+            return
+        try:
+            with self.lock:
+                ops = self.pending.pop(name, None)
+                db = self.entries.get(name)
+                replace = name in self.failed
+            if ops is None:
+                return
+            try:
+                with metrics.timer("db_store_seconds"):
+                    self.storage.store(name, db, None if replace else ops)
+            except Exception:
+                with self.lock:
+                    self.pending[name] = ops + self.pending.get(name, [])
+                    self.failed.add(name)
+                raise
+            with self.lock:
+                self.failed.discard(name)
+        finally:
+            mutex.release()
+
+    def _retry(self, name, wait=False):
+        """`_write` for other users' dbs, a failure is logged and retried later"""
+        try:
+            self._write(name, wait)
+        except Exception:
+            logger.exception("Storing %s failed, keeping it for the next flush", name)
+
 
 class DBManager:
-    """Simple json db manager
+    """Simple task db manager
 
     Expected db format:
 
@@ -35,32 +276,52 @@ class DBManager:
     """
 
     defaultday = lambda self, day: {day: {"tasks": {}}}
+    cache = DBCache(JSONStorage(f"{BOTDIR}/tododb"))
 
     def __init__(self, name):
-        self.name = f"{BOTDIR}/tododb/{name}.json"
+        self.name = str(name)
         self.write = False
-        self.db = self._load_db(self.name)
+        self.ops = []
+        self.archived = set()   # days moved to the archive by `unload`
+        self.lock = None
+
+        # locks span the whole load-modify-store cycle
+        self.mutex = self.cache.mutex(self.name)
+        self.mutex.acquire()
+        try:
+            if self.cache.locking:
+                self.lock = self.cache.storage.lock(self.name)
+                self.lock.acquire()
+            self.db = self.cache.load(self.name)
+        except Exception:
+            self._release()
+            raise
 
     def __enter__(self):
         return self 
 
     def __exit__(self, *a):
-        if self.write:
-            with open(self.name, 'w') as f:
-                json.dump(self.db, f, indent=2)
-
-    def _load_db(self, db):
-        """Load db from file, create it if doesn't exist"""
         try:
-            with open(db) as f:
-                return json.load(f)         
-        except FileNotFoundError:
-            with open(db, 'w') as f:
-                json.dump({}, f)
-            return {}
-
-
-    def add(self, day, task):
+            if self.write:
+                self.cache.store(self.name, self.db, self.ops, self.archived)
+        finally:
+            self._release()
+
+    def _release(self):
+        if self.lock:
+            self.lock.release()
+            self.lock = None
+        if self.mutex:
+            self.mutex.release()
+            self.mutex = None
+
+
+    def add(self, day, task, due=None):
+        """Adds task text, a list of texts or a dict of tasks to `day`
+
+        `due` is the unix time to remind the new texts at
+        """
+        self._restore(day)
         self.write = True
         new_dict = {}
 
@@ -70,131 +331,297 @@ class DBManager:
         if not writeday: 
             numid = 1
             self.db.update(self.defaultday(day))
-        else: # else get id of last task on the day
-            old_tasks = list(writeday['tasks'].keys())
-            if not old_tasks:
-                numid = 1
-            else:
-                last = max([int(i) for i in old_tasks])
-                numid = int(last) + 1
+            days = self.cache.day_index(self.name)
+            if days is not None:
+                days.add(day)
+        else: # tasks are numbered 1..n, so next id is n + 1
+            old_tasks = writeday['tasks']
+            numid = len(old_tasks) + 1
+            while str(numid) in old_tasks: # db edited by hand
+                numid += 1
 
         if isinstance(task, str):
-            new_dict.update({numid: {"text": task, "done": 0}})
-            logmessage = f"Adding task {numid} to {day}"
+            task = [task]
+
+        if isinstance(task, list):
+            for text in task:
+                new_dict[str(numid)] = {"text": text, "done": 0}
+                if due is not None:
+                    new_dict[str(numid)]["due"] = due
+                numid += 1
 
         if isinstance(task, dict):
             tasks = task.values()
-            print(tasks) # debug
 
             for task in tasks:
-                new_dict.update({numid: task})
+                new_dict.update({str(numid): task})
                 numid += 1
 
-            logmessage = f"Adding tasks {numid-len(tasks)}:{numid-1} to {day}"
-
         self.db[day]['tasks'].update(new_dict)
-        logger.debug(logmessage)
+        self.ops.append(("add", day, {k: dict(v) for k, v in new_dict.items()}))
+        self.cache.touch(self.name, day)
+        logger.debug("Adding tasks %s to %s", ", ".join(new_dict), day)
 
 
-    def get(self, day=0, task=0):
+    def get(self, day=0, task=0, archived=False):
+        """Whole db, a day or a task of it
+
+        Days missing in the db are looked up in the archive, the whole db
+        only includes archived days with `archived`.
+        """
         if not day and not task:
+            if archived and self.cache.archive:
+                days = {day: data for day, data in self.cache.archive.load(self.name).items()
+                        if data}
+                return dict(days, **self.db)
             return self.db
 
         if not day:
             logger.debug("Specify date")
             return
 
-        dayindb = self._presence(day)
-        if not dayindb:
-            logger.debug(f"Day {day} not found")
+        data = self.db.get(day)
+        if data is None:
+            data = self._archived(day)
+        if not data:
+            logger.debug("Day %s not found", day)
             return
 
         if not task:
-            return self.db.get(day)
+            return data
         
         task = str(task)
-        taskintasks = self._presence(day, task)
-        if taskintasks:
-            return self.db[day]['tasks'][task]
+        if task in data['tasks']:
+            return data['tasks'][task]
         
-        logger.debug(f"Task {task} in {day} not found")
+        logger.debug("Task %s in %s not found", task, day)
         return 
     
 
+    def days(self) -> list:
+        """All days in ascending order"""
+        return list(self.cache.day_index(self.name, self.db).days)
+
+    def get_range(self, start, end, archived=True) -> list:
+        """Days from `start` to `end` (YYYY-MM-DD, both included) in ascending order
+
+        Includes archived days unless `archived` is False.
+        """
+        days = self.cache.day_index(self.name, self.db).range(start, end)
+        if archived and self.cache.archive is not None:
+            old = [day for day in self.cache.archive.range(self.name, start, end)
+                   if day not in self.db]
+            if old:
+                days = list(heapq.merge(old, days))
+        return days
+
+    def next_n_days(self, today, n) -> list:
+        """Days of the `n` days starting with `today` (YYYY-MM-DD)"""
+        last = datetime.strptime(today, DATEFORMAT) + timedelta(days=n - 1)
+        return self.get_range(today, datetime.strftime(last, DATEFORMAT))
+
     def delete(self, day=0, task=0, force=False):
         if not day and not task:
             if force: # delete whole db
                 self.db = {}
+                if self.cache.archive is not None:
+                    self.cache.archive.remove(self.name)
+                days = self.cache.day_index(self.name)
+                if days is not None:
+                    days.clear()
+                self.ops.append(("clear",))
+                self.cache.touch(self.name)
                 self.write = True
                 return
             logger.debug("task and date not specified!")
             return
 
         if not day:
-            logger.debug(f"Specify date for task {task}")
+            logger.debug("Specify date for task %s", task)
             return
 
+        archived = self._archived(day) is not None
+        if not task and archived: # deleted in the archive too, so it doesn't show up again
+            self.cache.archive.append(self.name, {day: None})
+            self.cache.touch(self.name, day)
+            self.cache.unindex(self.name, day)
+            if not self._presence(day):
+                logger.debug("Deleting archived day %s", day)
+                return
+        elif archived:
+            self._restore(day)
+
         dayindays = self._presence(day)
         if not dayindays:
-            logger.error(f"Day {day} not found")
+            logger.error("Day %s not found", day)
             raise KeyError(f"Day {day} not found")
 
         if not task:
-            del self.db[day]
-            logger.debug(f"Deleting day {day}")
-            self.write = True
+            self._drop([day])
+            logger.debug("Deleting day %s", day)
             return
 
         task = str(task)
         taskintasks = self._presence(day, task)
         if not taskintasks:
-            logger.error(f"Task {task} in day {day} not found")
+            logger.error("Task %s in day %s not found", task, day)
             raise KeyError(f"Task {task} in day {day} not found")
 
-        del self.db[day]['tasks'][task] 
-        logger.debug(f"Deleting task {task} from day {day}")
+        remove_tasks(self.db[day]['tasks'], [task])
+        self.ops.append(("delete", day, task))
+        self.cache.touch(self.name, day)
+        logger.debug("Deleting task %s from day %s", task, day)
         self.write = True
-        
-        # rearrange
-        tasks = self.db[day]['tasks']
-        count = 1
-        newtasks = {}
-        for i in tasks.values():
-            newtasks.update({count: i})
-            count += 1
-        self.db[day] = {'tasks': newtasks}
-
         return
 
+    def delete_many(self, day, tasks):
+        """Deletes several tasks of `day` and renumbers the rest once"""
+        self._restore(day)
+        dayindays = self._presence(day)
+        if not dayindays:
+            logger.error("Day %s not found", day)
+            raise KeyError(f"Day {day} not found")
+
+        tasks = sorted({str(task) for task in tasks}, key=int, reverse=True)
+        missing = [task for task in tasks if not self._presence(day, task)]
+        if missing:
+            logger.error("Tasks %s in day %s not found", ", ".join(missing), day)
+            raise KeyError(f"Tasks {', '.join(missing)} in day {day} not found")
+
+        remove_tasks(self.db[day]['tasks'], tasks)
+        # highest first, so every stored operation sees the right numbers
+        self.ops.extend(("delete", day, task) for task in tasks)
+        self.cache.touch(self.name, day)
+        logger.debug("Deleting tasks %s from day %s", ", ".join(tasks), day)
+        self.write = True
+
+    def unload(self, days):
+        """Removes `days` from the db only, for days moved to the archive"""
+        self._drop(days)
+        self.archived.update(days)
+
+    def _drop(self, days):
+        index = self.cache.day_index(self.name)
+        for day in days:
+            del self.db[day]
+            if index is not None:
+                index.discard(day)
+            self.ops.append(("delete", day, None))
+            self.cache.touch(self.name, day)
+        self.write = True
 
     def edit(self, day, task, text):
+        self._restore(day)
         task = str(task)
         taskintasks = self._presence(day, task)
 
         if not taskintasks:
-            logger.debug(f"Task {task} in {day} not found")
+            logger.debug("Task %s in %s not found", task, day)
             raise KeyError(f"Task {task} in {day} not found")
 
         self.db[day]['tasks'][task]['text'] = text 
-        logger.debug(f"Modifying task {task} -> {text}")
+        self.ops.append(("edit", day, task, text))
+        self.cache.touch(self.name, day)
+        logger.debug("Modifying task %s -> %s", task, text)
         self.write = True
         return
 
     def done(self, day: str, task: int, done=True) -> int:
+        self._restore(day)
         task = str(task)
         taskintasks = self._presence(day, task)
 
         if not taskintasks:
-            logger.debug(f"Task {task} in {day} not found")
+            logger.debug("Task %s in %s not found", task, day)
             raise KeyError(f"Task {task} in {day} not found")
 
         self.db[day]['tasks'][task]['done'] ^= 1 # flip 0 and 1
         done = self.db[day]['tasks'][task]['done']
+        self.ops.append(("done", day, task, done))
+        self.cache.touch(self.name, day)
 
         self.write = True
-        logger.debug(f"Flipping task {task} on {day}")
+        logger.debug("Flipping task %s on %s", task, day)
         return done
 
+    def done_many(self, day, tasks) -> dict:
+        """Flips several tasks of `day`, none of them unless all exist
+
+        Returns {task: done}
+        """
+        self._restore(day)
+        if not self._presence(day):
+            logger.debug("Day %s not found", day)
+            raise KeyError(f"Day {day} not found")
+
+        tasks = sorted({str(task) for task in tasks}, key=int)
+        missing = [task for task in tasks if not self._presence(day, task)]
+        if missing:
+            logger.debug("Tasks %s in %s not found", ", ".join(missing), day)
+            raise KeyError(f"Tasks {', '.join(missing)} in {day} not found")
+
+        flipped = {}
+        for task in tasks:
+            self.db[day]['tasks'][task]['done'] ^= 1
+            flipped[task] = self.db[day]['tasks'][task]['done']
+            self.ops.append(("done", day, task, flipped[task]))
+        self.cache.touch(self.name, day)
+
+        self.write = True
+        logger.debug("Flipping tasks %s on %s", ", ".join(tasks), day)
+        return flipped
+
+    def set_due(self, day, task, due=None):
+        """Sets reminder time of `task`, None removes it"""
+        self._restore(day)
+        task = str(task)
+        if not self._presence(day) or not self._presence(day, task):
+            logger.debug("Task %s in %s not found", task, day)
+            raise KeyError(f"Task {task} in {day} not found")
+
+        if due is None:
+            self.db[day]['tasks'][task].pop('due', None)
+        else:
+            self.db[day]['tasks'][task]['due'] = due
+        self.ops.append(("due", day, task, due))
+        self.cache.touch(self.name, day)
+        self.write = True
+
+    def find(self, query, limit=None) -> list:
+        """(day, task) of tasks containing every word of `query`, by day"""
+        return self.cache.index(self.name, self.db).search(query, limit)
+
+    def _archived(self, day):
+        if self.cache.archive is None:
+            return None
+        return self.cache.archive.get(self.name, day)
+
+    def _restore(self, day):
+        """Moves archived `day` back into the db before it is changed"""
+        if day in self.db:
+            return
+        data = self._archived(day)
+        if not data:
+            return
+        self.db[day] = {"tasks": {num: dict(task) for num, task in data["tasks"].items()}}
+        index = self.cache.day_index(self.name)
+        if index is not None:
+            index.add(day)
+        self.ops.append(("add", day, {num: dict(task) for num, task in data["tasks"].items()}))
+        self.cache.touch(self.name, day)
+        self.write = True
+        logger.debug("Restoring archived day %s", day)
+
+    def version(self, day):
+        """Version of `day`, changes with every modification of it"""
+        return self.cache.version(self.name, day)
+
+    def versions(self, days) -> list:
+        """Versions of several days, see `version`"""
+        versions = self.cache.day_versions(self.name)
+        generation = versions.get(None)
+        return [(generation, versions.get(day)) for day in days]
+
     def _presence(self, day=False, task=False) -> bool:
         if not task:
             return day in self.db.keys()
@@ -0,0 +1,114 @@
+"""Suppression of updates telegram delivers more than once
+
+A slow webhook makes telegram send an update again. The retry has the
+same `update_id`, a message may also come back in another update with
+the same message id, so both are remembered for the last `size` updates.
+"""
+import logging
+import threading
+from collections import deque
+from functools import wraps
+
+import metrics
+from storage import write_file
+
+logger = logging.getLogger(__name__)
+
+
+def keys(update) -> tuple:
+    """Keys identifying `update`, update ids and user's message ids don't collide"""
+    found = []
+    update_id = getattr(update, "update_id", None)
+    if update_id is not None:
+        found.append(-1 - update_id)
+    message = getattr(update, "message", None)
+    if message is not None and getattr(message, "message_id", None) is not None:
+        found.append(message.from_user.id << 32 | message.message_id)
+    return tuple(found)
+
+
+class Deduplicator:
+    """Keys of the last `size` updates in a ring buffer and a set
+
+    Memory is fixed by `size`. Keys are appended to `filename`, so the
+    window survives restarts; the file is rewritten with the window once
+    it holds twice as many updates.
+    """
+
+    def __init__(self, filename, size=10000):
+        self.filename = filename
+        self.size = size
+        self.ring = deque(maxlen=size)  # keys of one update per entry
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.lines = 0
+        self.dropped = 0
+        self.file = None
+
+    def load(self):
+        """Restores the window from the file and compacts it"""
+        try:
+            with open(self.filename) as f:
+                entries = deque(f, maxlen=self.size)
+        except FileNotFoundError:
+            entries = ()
+
+        with self.lock:
+            for line in entries:
+                try:
+                    self._remember(tuple(int(key) for key in line.split()))
+                except ValueError: # torn write of the last record
+                    continue
+            self._compact()
+        logger.info("Loaded %d update keys", len(self.ring))
+
+    def check(self, update) -> bool:
+        """True for new updates, which are remembered, False for duplicates"""
+        found = keys(update)
+        if not found:
+            return True
+
+        with self.lock:
+            if any(key in self.seen for key in found):
+                self.dropped += 1
+                metrics.inc("updates_duplicate_total")
+                return False
+            self._remember(found)
+            self.file.write(" ".join(map(str, found)) + "\n")
+            self.file.flush()
+            self.lines += 1
+            if self.lines >= 2 * self.size:
+                self._compact()
+        return True
+
+    def wrap(self, func):
+        """Handler `func` only called for new updates"""
+        @wraps(func)
+        def wrapper(bot, update, *a, **kw):
+            if not self.check(update):
+                logger.info("Dropped duplicate update %s", getattr(update, "update_id", None))
+                return
+            return func(bot, update, *a, **kw)
+        return wrapper
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def _remember(self, found):
+        if len(self.ring) == self.size:
+            for key in self.ring[0]:
+                self.seen.discard(key)
+        self.ring.append(found)
+        self.seen.update(found)
+
+    def _compact(self):
+        """Rewrites the file with the window, holding `lock`"""
+        if self.file:
+            self.file.close()
+        write_file(self.filename,
+                   "".join(" ".join(map(str, found)) + "\n" for found in self.ring).encode())
+        self.file = open(self.filename, 'a')
+        self.lines = len(self.ring)
@@ -1,31 +1,12 @@
 import json
 import re
-from datetime import timedelta
 
 REGEX = "(^[0-9]+)\s?(s(ec)?(ond)?[s]?$|m(in)?[s]?(ute)?[s]?$|h[r]?[s]?(our)?[s]?$|d(ay)?[s]?$|w(eek)?[s]?$|month[s]?$|y[r]?(ear)?[s]?$)" 
 
 DATEREGEX = "\d{4}-\d{2}-\d{2}|tmr|tomorrow|today"
 DATEFORMAT = "%Y-%m-%d"
 
-
-def match_re(inp):
-    match = re.match(REGEX, inp)
-    if not match:
-        return None
-    
-    grps = match.groups()
-    return grps
-
-
-timeperiods = {
-        "s": lambda x: timedelta(seconds=x),
-        "m": lambda x: timedelta(seconds=x*60),
-        "h": lambda x: timedelta(seconds=x*60*60),
-        "d": lambda x: timedelta(days=x),
-        "w": lambda x: timedelta(days=x*7),
-        "mo": lambda x: timedelta(days=x*7*4),
-        "y": lambda x: timedelta(days=x*7*4*12)
-        }
+PERIOD_RE = re.compile(REGEX)
 
 tomorrow = ['tmr', 'tomorrow']
 
@@ -38,9 +19,17 @@ This will add task to *TODAY* list
 This will add task to list specified by *time*
 
 *time* can be any natural input such as
-_tomorrow, in 2 days, in 4 weeks, in 14 years_
+_tomorrow, in 2 days, in 4 weeks, in 14 years, friday, next mon, march 5_
 or a specific date in YYYY-MM-DD format (preferred)
 
+Every line is added as a separate task:
+/add *tmr* _buy milk_
+_call mom_
+_pay rent_
+
+Periods in seconds, minutes or hours also remind you:
+/add *in 30 mins* _take the cake out_
+
 `Examples`
 /add *in 2 days* _buy milk_
 /add *tmr* _walk the dog_
@@ -53,13 +42,19 @@ GET_TASK = """
 This will show tasks on day specified by *time*
 
 *time* can be any natural input such as
-_tomorrow, in 2 days, in 4 weeks, in 14 years_
+_tomorrow, in 2 days, in 4 weeks, in 14 years, friday, next mon, march 5_
 or a specific date in YYYY-MM-DD format (preferred)
 
+/tasks *week* shows today and the next 6 days
+/tasks *month* shows today and the next 29 days
+/tasks *time*..*time* shows all days in between
+
 `Examples`
 /tasks *today*
 /tasks *tmr*
 /tasks *in 5 days*
+/tasks *week*
+/tasks *2019-01-01..2019-01-31*
 """
 DELETE_TASK = """
 `Usage`
@@ -67,11 +62,13 @@ DELETE_TASK = """
 This will delete specified task from todo list
 
 *time* can be any natural input such as
-_tomorrow, in 2 days, in 4 weeks, in 14 years_
+_tomorrow, in 2 days, in 4 weeks, in 14 years, friday, next mon, march 5_
 or a specific date in YYYY-MM-DD format (preferred)
 
 _task number_ is number of a task (you can check the number with /tasks command)
 
+/del *time* _1 3 5_ deletes several tasks at once
+
 /del without _task number_ will delete entire specified day
 
 /del *all* to delete entire todo list
@@ -80,14 +77,15 @@ _task number_ is number of a task (you can check the number with /tasks command)
 /del 1
 /del tmr
 /del 2019-10-10 3
+/del tmr 2 5
 """
 EDIT_TASK = """
 `Usage`
 /edit *time* _tasknum_ *new_task*
 This will change _task_ on _day_ to *new_task*
 
-*time* can be either _today_, _tomorrow_, _tmr_
-or a specific date in format YYYY-MM-DD
+*time* can be either _today_, _tomorrow_, _tmr_, a weekday
+such as _friday_ or _next mon_ or a specific date in format YYYY-MM-DD
 
 _taksnum_ is the number of a task
 
@@ -104,17 +102,68 @@ DONE_TASK = """
 This will mark task _tasknum_ on day *time* DONE
 Using /done again on the same task will mark it UNDONE
 
-*time* can be either _today_, _tomorrow_, _tmr_
-or a specific date in format YYYY-MM-DD
+*time* can be either _today_, _tomorrow_, _tmr_, a weekday
+such as _friday_ or _next mon_ or a specific date in format YYYY-MM-DD
 
 _taksnum_ is the number of a task
 
+/done *time* _1 3 4_ marks several tasks at once
+
 /done without time will mark tasks on TODAY list
 
 `Examples`
 /done 2
 /done tmr 1
 /done 2019-02-02 2
+/done 1 3 4
+"""
+TIMEZONE = """
+`Usage`
+/tz *timezone*
+Sets your timezone, so _today_ and _tomorrow_ follow your clock
+
+*timezone* is a name such as _Europe/Prague_ or a UTC offset such as _+2_ or _-05:30_
+
+/tz without *timezone* shows the current one
+
+`Examples`
+/tz Europe/Prague
+/tz +2
+"""
+FIND_TASK = """
+`Usage`
+/find *words*
+Shows tasks of all days containing every one of the *words*
+
+Case doesn't matter, only whole words match
+At most the latest 50 matching tasks are shown
+
+`Examples`
+/find dentist
+/find call mom
+"""
+
+EVERY_TASK = """
+`Usage`
+/every *rule* _task_
+Adds _task_ to every day matching *rule*, from today on
+
+*rule* can be
+_daily_, _weekdays_,
+weekdays such as _mon,thu_ or _monday and thursday_,
+_monthly on the 1st_ or _monthly 15_ (the last day in shorter months)
+
+/every lists your rules
+/every del _number_ deletes a rule and its unfinished tasks from today on
+
+Unfinished recurring tasks move to the next day like other tasks,
+unless the rule has a task on that day too
+
+`Examples`
+/every daily water the plants
+/every mon,thu gym
+/every monthly on the 1st pay rent
+/every del 2
 """
 
 helpdata = {
@@ -122,7 +171,10 @@ helpdata = {
         "delete_task": DELETE_TASK.strip(),
         "get_task": GET_TASK.strip(),
         "edit_task": EDIT_TASK.strip(),
-        "done_task": DONE_TASK.strip()
+        "done_task": DONE_TASK.strip(),
+        "find_task": FIND_TASK.strip(),
+        "every_task": EVERY_TASK.strip(),
+        "set_timezone": TIMEZONE.strip()
         }
 
 
@@ -0,0 +1,111 @@
+"""Non-blocking logging configured from the `log` section of config.json
+
+Loggers only put records on a queue, a background `QueueListener`
+writes them to the files:
+
+  "log": {
+    "debug": "debug.log",       // all records, stderr when null
+    "filename": "bot.log",      // records of the bot's handlers
+    "db": "db.log",             // records of the db cache, storage and archive, null disables
+    "level": "INFO",
+    "db_level": "INFO",
+    "logformat": "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    "format": "text",           // or "json", one object per line
+    "max_bytes": 0,             // rotate at this size ...
+    "when": null,               // ... or at this interval, e.g. "midnight"
+    "backup_count": 7
+  }
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+
+DEFAULT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+BOT_LOGGERS = ("__main__", "bot")
+DB_LOGGERS = ("dbmanager", "storage", "archive")
+
+
+class JSONFormatter(logging.Formatter):
+    """One json object per record"""
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class NameFilter(logging.Filter):
+    """Passes records of the `names` loggers and their children"""
+
+    def __init__(self, names):
+        super().__init__()
+        self.filters = [logging.Filter(name) for name in names]
+
+    def filter(self, record):
+        return any(f.filter(record) for f in self.filters)
+
+
+def _file_handler(filename, log_config):
+    when = log_config.get("when")
+    backups = log_config.get("backup_count", 7)
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(filename, when=when,
+                                                         backupCount=backups)
+    if log_config.get("max_bytes"):
+        return logging.handlers.RotatingFileHandler(filename,
+                                                    maxBytes=log_config["max_bytes"],
+                                                    backupCount=backups)
+    return logging.FileHandler(filename)
+
+
+def setup_logging(log_config: dict) -> logging.handlers.QueueListener:
+    """Routes all logging through a queue to the configured files
+
+    The listener is stopped, and the queue drained, at exit.
+    """
+    if log_config.get("format") == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter(log_config.get("logformat") or DEFAULT_FORMAT)
+    level = logging.getLevelName(log_config.get("level", "INFO"))
+
+    handlers = []
+    debug = log_config.get("debug")
+    handlers.append(_file_handler(debug, log_config) if debug else logging.StreamHandler())
+
+    if log_config.get("filename"):
+        handler = _file_handler(log_config["filename"], log_config)
+        handler.addFilter(NameFilter(BOT_LOGGERS))
+        handlers.append(handler)
+
+    db = log_config.get("db", "db.log")
+    if db:
+        handler = _file_handler(db, log_config)
+        handler.addFilter(NameFilter(DB_LOGGERS))
+        handlers.append(handler)
+        db_level = logging.getLevelName(log_config.get("db_level", "INFO"))
+        for name in DB_LOGGERS:
+            logging.getLogger(name).setLevel(db_level)
+
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,189 @@
+"""Prometheus style metrics of the bot
+
+Counters and latency histograms are kept in the process wide `registry`,
+`snapshot()` returns them as a dict and `serve()` exposes them in the
+Prometheus text format on http://host:port/metrics.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> dict:
+        """Counts per upper bound as in the exposition format"""
+        result = {}
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            result[str(bound)] = total
+        return result
+
+
+def _labels(labels) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+
+class Registry:
+    """Counters, histograms and gauges keyed by name and labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # name -> {labels: value}
+        self.histograms = {}    # name -> {labels: Histogram}
+        self.gauges = {}        # name -> function returning the value
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _labels(labels)
+        with self.lock:
+            values = self.histograms.setdefault(name, {})
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, func):
+        """Registers `func()` as the current value of gauge `name`"""
+        with self.lock:
+            self.gauges[name] = func
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the duration of the block in histogram `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        """All metrics as {name: {labels: value}}, histograms as dicts"""
+        with self.lock:
+            result = {name: dict(values) for name, values in self.counters.items()}
+            for name, values in self.histograms.items():
+                result[name] = {key: {"count": h.count, "sum": h.sum,
+                                      "buckets": h.cumulative()}
+                                for key, h in values.items()}
+            gauges = list(self.gauges.items())
+        for name, func in gauges:
+            result[name] = {"": func()}
+        return result
+
+    def render(self) -> str:
+        """Prometheus text exposition of all metrics"""
+        lines = []
+        kinds = {}
+        with self.lock:
+            kinds.update((name, "counter") for name in self.counters)
+            kinds.update((name, "histogram") for name in self.histograms)
+            kinds.update((name, "gauge") for name in self.gauges)
+        snapshot = self.snapshot()
+
+        for name in sorted(snapshot):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kinds[name]}")
+            for key, value in sorted(snapshot[name].items()):
+                if kinds[name] != "histogram":
+                    lines.append(f"{name}{{{key}}} {value}" if key else f"{name} {value}")
+                    continue
+                sep = "," if key else ""
+                for bound, count in value["buckets"].items():
+                    lines.append(f'{name}_bucket{{{key}{sep}le="{bound}"}} {count}')
+                suffix = f"{{{key}}}" if key else ""
+                lines.append(f"{name}_sum{suffix} {value['sum']}")
+                lines.append(f"{name}_count{suffix} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+snapshot = registry.snapshot
+
+registry.describe("bot_commands_total", "Handled commands")
+registry.describe("bot_command_errors_total", "Commands whose handler raised")
+registry.describe("bot_command_seconds", "Handler latency")
+registry.describe("db_load_seconds", "Time spent loading user databases")
+registry.describe("db_store_seconds", "Time spent writing user databases")
+registry.describe("db_bytes_written_total", "Bytes written by the storage")
+
+
+def instrument(command, func):
+    """Wraps a handler to count calls and errors and time it per `command`
+
+    Meant to wrap the outermost handler, e.g. one decorated with `help`.
+    """
+    @wraps(func)
+    def wrapper(*a, **kw):
+        start = time.perf_counter()
+        try:
+            return func(*a, **kw)
+        except Exception:
+            inc("bot_command_errors_total", command=command)
+            raise
+        finally:
+            inc("bot_commands_total", command=command)
+            observe("bot_command_seconds", time.perf_counter() - start, command=command)
+    return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(port=9100, host="127.0.0.1") -> ThreadingHTTPServer:
+    """Serves /metrics from a daemon thread, `shutdown()` the result to stop"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on %s:%s", host, server.server_address[1])
+    return server
@@ -0,0 +1,204 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def wait(self, now) -> float:
+        """Seconds until a token is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Outbox:
+    """Rate limited outbound message queue
+
+    `send` only queues the message, a single sender thread delivers it
+    through `bot.send_message`. Messages of one chat keep their order.
+    A chat is sent to at most `chat_rate` messages per second and all
+    chats together at most `global_rate`, with short bursts of
+    `chat_burst` and `global_burst`, which keeps the bot below
+    Telegram's flood limits. On `RetryAfter` the chat is paused for the
+    requested time, other network errors are retried with exponential
+    backoff up to `retries` times.
+    """
+
+    def __init__(self, bot, global_rate=25, global_burst=5, chat_rate=1,
+                 chat_burst=2, retries=5, backoff=0.5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.backoff = backoff
+
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self.buckets = {}   # chat_id -> TokenBucket
+        self.chats = {}     # chat_id -> deque of pending messages
+        self.ready = []     # heap of (time, seq, chat_id) of scheduled chats
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        """Delivers queued messages for up to `timeout` seconds and stops"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.chats and time.monotonic() < deadline:
+                self.cond.wait(0.05)
+            self.running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def send(self, chat_id, text, **kw):
+        message = {"chat_id": chat_id, "text": text, "kw": kw,
+                   "queued": time.monotonic(), "attempt": 0}
+        with self.cond:
+            queue = self.chats.get(chat_id)
+            if queue is None:
+                queue = self.chats[chat_id] = deque()
+                self._schedule(chat_id, time.monotonic())
+            queue.append(message)
+            self.cond.notify()
+
+    def reply(self, update, text, **kw):
+        self.send(update.message.chat_id, text, **kw)
+
+    def stats(self) -> dict:
+        with self.cond:
+            depth = sum(len(queue) for queue in self.chats.values())
+        return {"depth": depth,
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "latency_avg": self.latency_total / self.sent if self.sent else 0,
+                "latency_max": self.latency_max}
+
+    def _schedule(self, chat_id, when):
+        heapq.heappush(self.ready, (when, next(self.seq), chat_id))
+
+    def _prune(self):
+        """Forgets idle chats whose bucket has refilled"""
+        now = time.monotonic()
+        for chat_id, bucket in list(self.buckets.items()):
+            if chat_id not in self.chats and not bucket.wait(now) \
+                    and bucket.tokens >= bucket.burst:
+                del self.buckets[chat_id]
+
+    def _next(self):
+        """Waits for a chat whose message may be sent now"""
+        with self.cond:
+            while self.running:
+                now = time.monotonic()
+                if not self.ready:
+                    self.cond.wait()
+                    continue
+                when, _, chat_id = self.ready[0]
+                if when > now:
+                    self.cond.wait(when - now)
+                    continue
+
+                bucket = self.buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate,
+                                                                 self.chat_burst)
+                wait = max(self.bucket.wait(now), bucket.wait(now))
+                heapq.heappop(self.ready)
+                if wait:
+                    self._schedule(chat_id, now + wait)
+                    continue
+
+                self.bucket.take()
+                bucket.take()
+                return chat_id, self.chats[chat_id].popleft()
+        return None, None
+
+    def _run(self):
+        while True:
+            chat_id, message = self._next()
+            if message is None:
+                return
+
+            delay = self._deliver(message)
+            with self.cond:
+                queue = self.chats[chat_id]
+                if delay is not None:
+                    queue.appendleft(message)
+                if queue:
+                    self._schedule(chat_id, time.monotonic() + (delay or 0))
+                else:
+                    del self.chats[chat_id]
+                    if len(self.buckets) > 1024:
+                        self._prune()
+                self.cond.notify_all()
+
+    def _deliver(self, message):
+        """Sends one message, returns retry delay or None when done"""
+        chat_id = message["chat_id"]
+        try:
+            self.bot.send_message(chat_id=chat_id, text=message["text"],
+                                  **message["kw"])
+        except RetryAfter as e:
+            self.retried += 1
+            logger.info("Flood limit for chat %s, retry in %ss", chat_id, e.retry_after)
+            return e.retry_after
+        except BadRequest as e:
+            self.failed += 1
+            logger.error("Dropping message to %s: %s", chat_id, e)
+            return None
+        except NetworkError as e:
+            message["attempt"] += 1
+            if message["attempt"] > self.retries:
+                self.failed += 1
+                logger.error("Giving up message to %s: %s", chat_id, e)
+                return None
+            self.retried += 1
+            return self.backoff * 2 ** (message["attempt"] - 1)
+        except TelegramError as e: # blocked by user, chat migrated, ...
+            self.failed += 1
+            logger.error("Dropping message to %s: %s", chat_id, e)
+            return None
+        except Exception: # a bug must not stop the only sender thread
+            self.failed += 1
+            logger.exception("Dropping message to %s", chat_id)
+            return None
+
+        latency = time.monotonic() - message["queued"]
+        self.sent += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        return None
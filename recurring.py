@@ -0,0 +1,295 @@
+"""Recurring tasks stored as rules and materialized lazily
+
+Rules are normalized by `match`:
+
+  daily              every day
+  weekdays           monday to friday
+  weekly 0 3         on the listed weekdays, monday is 0
+  monthly 1          on a day of the month, the last day in shorter months
+
+Every user's rules are in `<directory>/<user>.json`. An occurrence only
+becomes a task, tagged with the rule's id, when a handler reads or marks
+a day or the rollover closes it (`materialize`). The tags of a day's
+tasks tell which rules are already on it, so nothing but the rules and
+the occurrences deleted by the user is stored outside the db.
+"""
+import calendar
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from dates import DAYNAMES, WEEKDAYS
+from extras import DATEFORMAT
+from storage import write_file
+
+logger = logging.getLogger(__name__)
+
+DAILY = ('daily', 'day')
+WEEKDAY_WORDS = ('weekdays', 'weekday', 'workdays')
+MONTHLY = ('monthly', 'month')
+ORDINAL_SUFFIXES = ('st', 'nd', 'rd', 'th')
+
+
+def _weekdays(token):
+    days = []
+    for part in token.lower().split(','):
+        if part and part not in WEEKDAYS:
+            return None
+        if part:
+            days.append(WEEKDAYS[part])
+    return days
+
+
+def _month_day(token):
+    token = token.lower()
+    for suffix in ORDINAL_SUFFIXES:
+        if token.endswith(suffix):
+            token = token[:-len(suffix)]
+            break
+    if token.isdigit() and 1 <= int(token) <= 31:
+        return int(token)
+    return None
+
+
+def match(tokens, i=0):
+    """Normalized rule starting at `tokens[i]`
+
+    Returns
+    (rule or None, number of tokens used)
+    """
+    if i >= len(tokens):
+        return None, 0
+
+    token = tokens[i].lower()
+    if token in DAILY:
+        return 'daily', 1
+    if token in WEEKDAY_WORDS:
+        return 'weekdays', 1
+
+    if token in MONTHLY:
+        used = 1
+        while i + used < len(tokens) and tokens[i + used].lower() in ('on', 'the'):
+            used += 1
+        day = _month_day(tokens[i + used]) if i + used < len(tokens) else None
+        if day is None: # plain "monthly"
+            return 'monthly 1', 1
+        return f"monthly {day}", used + 1
+
+    # mon,thu / mon thu / monday and thursday
+    days, used = set(), 0
+    while i + used < len(tokens):
+        word = tokens[i + used]
+        if days and word.lower() == 'and':
+            used += 1
+            continue
+        found = _weekdays(word)
+        if not found:
+            break
+        days.update(found)
+        used += 1
+    if used and tokens[i + used - 1].lower() == 'and':
+        used -= 1
+    if days:
+        return "weekly " + " ".join(map(str, sorted(days))), used
+    return None, 0
+
+
+def describe(rule) -> str:
+    words = rule.split()
+    if words[0] == 'daily':
+        return "every day"
+    if words[0] == 'weekdays':
+        return "on weekdays"
+    if words[0] == 'weekly':
+        return "every " + ", ".join(DAYNAMES[int(day)][:3] for day in words[1:])
+    day = int(words[1])
+    suffix = 'th' if 10 <= day % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
+    return f"monthly on the {day}{suffix}"
+
+
+class Recurring:
+    """Rules of all users, the last `cache_size` users' kept in memory
+
+    Every cached user also has the rules indexed by when they recur, so
+    the occurrences of a day cost O(rules active on that day). A user's
+    rules are read and changed under the user's mutex, handlers and the
+    rollover threads may use them at the same time.
+    """
+
+    def __init__(self, directory, horizon=62, cache_size=1024):
+        self.directory = directory
+        self.horizon = horizon  # days from today that are materialized
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # user -> (state, index)
+        self.mutexes = {}   # user -> lock of the user's rules
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, user):
+        return f"{self.directory}/{user}.json"
+
+    def mutex(self, user):
+        with self.lock:
+            return self.mutexes.setdefault(str(user), threading.RLock())
+
+    def forked(self):
+        """Fresh locks for a forked process, the parent's may be held"""
+        self.mutexes = {}
+        self.lock = threading.Lock()
+
+    def rules(self, user) -> dict:
+        """{id: {"rule", "text", "start"}} of `user`"""
+        with self.mutex(user):
+            return dict(self._state(user)[0]["rules"])
+
+    def add(self, user, rule, text, start) -> str:
+        """Adds a rule recurring from `start` (YYYY-MM-DD), returns its id"""
+        with self.mutex(user):
+            state, _ = self._state(user)
+            number = str(state["next"])
+            state["next"] += 1
+            state["rules"][number] = {"rule": rule, "text": text, "start": start}
+            self._save(user, state)
+        return number
+
+    def remove(self, db, number, today) -> bool:
+        """Removes a rule and its unfinished tasks from `today` on
+
+        Finished and past tasks of the rule stay. `db` is the user's
+        `DBManager`.
+        """
+        number = str(number)
+        with self.mutex(db.name):
+            state, _ = self._state(db.name)
+            if state["rules"].pop(number, None) is None:
+                return False
+            self._save(db.name, state)
+
+            for day in db.get_range(today, _shift(today, self.horizon), archived=False):
+                tasks = [num for num, task in db.get(day)["tasks"].items()
+                         if task.get("rule") == number and not task["done"]]
+                if tasks:
+                    db.delete_many(day, tasks)
+        return True
+
+    def skip(self, user, day, numbers, today):
+        """Keeps deleted tasks of the rules `numbers` from coming back on `day`"""
+        with self.mutex(user):
+            state, _ = self._state(user)
+            skipped = {past: rules for past, rules in state.get("skipped", {}).items()
+                       if past >= today}
+            skipped[day] = sorted(set(skipped.get(day, [])) | {str(number) for number in numbers})
+            state["skipped"] = skipped
+            self._save(user, state)
+
+    def occurrences(self, user, day) -> list:
+        """[(id, rule)] of the rules recurring on `day` (YYYY-MM-DD)"""
+        date = datetime.strptime(day, DATEFORMAT)
+        last = calendar.monthrange(date.year, date.month)[1]
+        with self.mutex(user):
+            state, index = self._state(user)
+            found = index["daily"] + index["weekly"][date.weekday()] + index["monthly"].get(date.day, [])
+            if date.day == last: # rules of the 29th-31st in shorter months
+                for month_day in range(last + 1, 32):
+                    found += index["monthly"].get(month_day, [])
+            rules = state["rules"]
+            return [(number, rules[number]) for number in found
+                    if number in rules and rules[number]["start"] <= day]
+
+    def materialize(self, db, start, end, today) -> int:
+        """Adds the occurrences of days `start` to `end` to `db`
+
+        Only days from `today` up to the horizon are filled in. A rule
+        with a task on the day, finished, moved there by the rollover or
+        deleted (`skip`), isn't added again. `db` is the user's
+        `DBManager`.
+
+        Returns number of added tasks
+        """
+        user = db.name
+        first = max(start, today)
+        last = min(end, _shift(today, self.horizon))
+        if first > last:
+            return 0
+
+        added = 0
+        with self.mutex(user):
+            state, _ = self._state(user)
+            if not state["rules"]:
+                return 0
+
+            skipped = state.get("skipped", {})
+            day = first
+            while day <= last:
+                found = self.occurrences(user, day)
+                if found:
+                    data = db.get(day)
+                    present = set(skipped.get(day, ()))
+                    if data:
+                        present.update(task["rule"] for task in data["tasks"].values() if "rule" in task)
+                    tasks = {number: {"text": rule["text"], "done": 0, "rule": number}
+                             for number, rule in found if number not in present}
+                    if tasks:
+                        db.add(day, tasks)
+                        added += len(tasks)
+                day = _shift(day, 1)
+
+        if added:
+            logger.debug("Materialized %d recurring tasks of '%s'", added, user)
+        return added
+
+    def users(self) -> list:
+        return sorted(name[:-5] for name in os.listdir(self.directory)
+                      if name.endswith(".json"))
+
+    def _state(self, user):
+        user = str(user)
+        with self.lock:
+            cached = self.cache.get(user)
+            if cached:
+                self.cache.move_to_end(user)
+                return cached
+        try:
+            with open(self.path(user)) as f:
+                state = json.load(f)
+            state.pop("materialized", None)  # kept by older versions
+        except FileNotFoundError:
+            state = {"next": 1, "rules": {}}
+        cached = (state, _index(state["rules"]))
+        with self.lock:
+            self.cache[user] = cached
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return cached
+
+    def _save(self, user, state):
+        """Writes the rules of `user` and reindexes them"""
+        user = str(user)
+        write_file(self.path(user), json.dumps(state).encode())
+        with self.lock:
+            self.cache[user] = (state, _index(state["rules"]))
+            self.cache.move_to_end(user)
+
+
+def _index(rules) -> dict:
+    index = {"daily": [], "weekly": [[] for _ in range(7)], "monthly": {}}
+    for number, rule in rules.items():
+        words = rule["rule"].split()
+        if words[0] == 'daily':
+            index["daily"].append(number)
+        elif words[0] == 'weekdays':
+            for weekday in range(5):
+                index["weekly"][weekday].append(number)
+        elif words[0] == 'weekly':
+            for weekday in words[1:]:
+                index["weekly"][int(weekday)].append(number)
+        else:
+            index["monthly"].setdefault(int(words[1]), []).append(number)
+    return index
+
+
+def _shift(day, days) -> str:
+    return datetime.strftime(datetime.strptime(day, DATEFORMAT) + timedelta(days=days), DATEFORMAT)
@@ -0,0 +1,117 @@
+import heapq
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from dbmanager import DBManager as dbm
+from extras import DATEFORMAT
+
+logger = logging.getLogger(__name__)
+
+ALARM = "\u23f0"
+
+
+class Reminders:
+    """Reminder times of all users' tasks in one heap
+
+    The tasks themselves keep their reminder in a `due` field, the heap
+    only holds (due, user, day) and is rebuilt from an append-only index
+    file on start, so restarts don't have to scan every user's db. A
+    single repeating job calls `fire`, which handles at most `batch`
+    due reminders per call.
+
+    Entries are only hints: when one is due the task is looked up by
+    its due time on the day and the next one (the rollover may have
+    moved it), deleted or finished tasks are skipped. A fired task
+    loses its `due`, so it can't fire twice.
+    """
+
+    def __init__(self, filename, send, batch=500):
+        self.filename = filename
+        self.send = send    # send(user, text)
+        self.batch = batch
+        self.heap = []
+        self.lock = threading.Lock()
+        self.lines = 0      # records in the index file
+        self.fired = 0
+
+    def load(self):
+        """Rebuilds the heap from the index file and compacts it"""
+        entries = []
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        due, user, day = line.split()
+                    except ValueError: # torn write of the last record
+                        continue
+                    entries.append((int(due), sys.intern(user), sys.intern(day)))
+        except FileNotFoundError:
+            pass
+
+        with self.lock:
+            self.heap = list(set(entries))
+            heapq.heapify(self.heap)
+            self._compact()
+        logger.info("Loaded %d reminders", len(self.heap))
+
+    def add(self, user, day, due):
+        entry = (int(due), sys.intern(str(user)), sys.intern(day))
+        with self.lock:
+            heapq.heappush(self.heap, entry)
+            with open(self.filename, 'a') as f:
+                f.write("%d %s %s\n" % entry)
+            self.lines += 1
+
+    def next_due(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def fire(self, bot=None, job=None):
+        """Sends due reminders, usable as job callback"""
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now and len(due) < self.batch:
+                due.append(heapq.heappop(self.heap))
+            if due and self.lines > 2 * len(self.heap) + 1024:
+                self._compact()
+
+        for entry in due:
+            try:
+                self._fire(*entry)
+            except Exception:
+                logger.exception("Reminder %s failed", entry)
+
+    def _fire(self, due, user, day):
+        nextday = datetime.strftime(datetime.strptime(day, DATEFORMAT) + timedelta(days=1),
+                                    DATEFORMAT)
+        texts = []
+        with dbm(user) as db:
+            for candidate in (day, nextday):
+                data = db.get(candidate)
+                if not data:
+                    continue
+                for num, task in list(data['tasks'].items()):
+                    if task.get('due') == due:
+                        db.set_due(candidate, num, None)
+                        if not task['done']:
+                            texts.append(task['text'])
+
+        for text in texts:
+            self.send(user, f"{ALARM} {text}")
+            self.fired += 1
+
+    def _compact(self):
+        """Rewrites the index file with the pending entries, holding `lock`"""
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, 'w') as f:
+            f.writelines("%d %s %s\n" % entry for entry in self.heap)
+        os.replace(tmp, self.filename)
+        self.lines = len(self.heap)
@@ -0,0 +1,138 @@
+import threading
+from collections import OrderedDict
+
+MESSAGE_LIMIT = 4096    # telegram's maximum message length
+
+DONE = "\u2705"
+UNDONE = "\u274c"
+
+
+class RenderCache:
+    """LRU cache of formatted days keyed by (user, day)
+
+    Entries carry the day version from `DBManager.version`, a changed
+    day is formatted again on the next read.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def get_many(self, keys, versions) -> list:
+        """Cached texts for `keys`, None where missing or outdated"""
+        texts = []
+        with self.lock:
+            for key, version in zip(keys, versions):
+                entry = self.entries.get(key)
+                if entry is None or entry[0] != version:
+                    texts.append(None)
+                else:
+                    self.entries.move_to_end(key)
+                    texts.append(entry[1])
+        return texts
+
+    def put(self, key, version, text):
+        self.put_many([(key, version, text)])
+
+    def put_many(self, items):
+        """Caches (key, version, text) of several days under one lock"""
+        with self.lock:
+            entries = self.entries
+            for key, version, text in items:
+                if key in entries: # outdated, new keys are added last anyway
+                    del entries[key]
+                entries[key] = (version, text)
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+
+
+cache = RenderCache()
+
+
+def format_day(day, tasks: dict) -> str:
+    lines = [f"*{day}*\n"]
+    for num, task in tasks.items():
+        lines.append(f"`{num})` {DONE if task['done'] else UNDONE} {task['text']}\n")
+    return "".join(lines)
+
+
+def render_days(db, days) -> list:
+    """Formatted blocks of `days` from a `DBManager` db, cached per version"""
+    keys = [(db.name, day) for day in days]
+    versions = db.versions(days)
+    texts = cache.get_many(keys, versions)
+    missing = [i for i, text in enumerate(texts) if text is None]
+    for i in missing:
+        day = days[i]
+        texts[i] = format_day(day, db.get(day)['tasks'])
+    if missing:
+        cache.put_many([(keys[i], versions[i], texts[i]) for i in missing])
+    return texts
+
+
+def split_message(blocks, limit=MESSAGE_LIMIT, sep="\n") -> list:
+    """Joins `blocks` with `sep` into messages of at most `limit` characters
+
+    Blocks are only split when a single one doesn't fit, then at line
+    ends, so markdown entities stay within one message.
+    """
+    lengths = list(map(len, blocks))
+    if max(lengths, default=0) <= limit:
+        return _join_blocks(blocks, lengths, limit, sep)
+
+    def pieces():
+        for block in blocks:
+            if len(block) <= limit:
+                yield sep, block
+                continue
+            glue = sep
+            for line in block.splitlines(keepends=True):
+                while len(line) > limit:
+                    yield glue, line[:limit]
+                    glue, line = "", line[limit:]
+                yield glue, line
+                glue = ""
+
+    messages = []
+    current = []
+    size = 0
+    for glue, piece in pieces():
+        if current and size + len(glue) + len(piece) > limit:
+            messages.append("".join(current))
+            current, size = [], 0
+        if current:
+            current.append(glue)
+            size += len(glue)
+        current.append(piece)
+        size += len(piece)
+
+    if current:
+        messages.append("".join(current))
+    return messages
+
+
+def _join_blocks(blocks, lengths, limit, sep) -> list:
+    """`split_message` of blocks that all fit into a message"""
+    messages = []
+    start = size = 0
+    glue = len(sep)
+    for i, length in enumerate(lengths):
+        if i == start:
+            size = length
+        elif size + glue + length > limit:
+            messages.append(sep.join(blocks[start:i]))
+            start, size = i, length
+        else:
+            size += glue + length
+    if blocks:
+        messages.append(sep.join(blocks[start:]))
+    return messages
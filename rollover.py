@@ -0,0 +1,152 @@
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+
+from dbmanager import BOTDIR, DBManager as dbm
+from extras import DATEFORMAT
+
+logger = logging.getLogger(__name__)
+
+recurring = None  # rules materialized on the day before it is closed, see `rollover`
+
+
+def rollover_user(user, day: str, nextday: str) -> int:
+    """Moves unfinished tasks of `user` from `day` to `nextday`
+
+    Adding to `nextday` and removing from `day` is stored as one change,
+    so running it again for the same day moves nothing. Recurring tasks
+    move as well, unless their rule already has a task on `nextday`.
+
+    Returns number of moved tasks
+    """
+    with dbm(user) as db:
+        if recurring is not None: # the user may not have looked at the day
+            recurring.materialize(db, day, day, day)
+
+        data = db.get(day)
+        if not data:
+            return 0
+
+        following = db.get(nextday)
+        rules = {task['rule'] for task in following['tasks'].values()
+                 if 'rule' in task} if following else set()
+        unfinished = {num: task for num, task in data['tasks'].items()
+                      if not task['done'] and task.get('rule') not in rules}
+        if not unfinished:
+            return 0
+
+        db.add(nextday, {num: dict(task) for num, task in unfinished.items()})
+        db.delete_many(day, unfinished)
+
+    # progress may only be recorded once the move is stored
+    dbm.cache.sync(str(user))
+    return len(unfinished)
+
+
+def _init_process():
+    # processes don't share the cache, so go through the storage locks
+    dbm.cache.configure(locking=True)
+    if recurring is not None:
+        recurring.forked()
+
+
+class Progress:
+    """Append-only record of users already rolled over for `day`"""
+
+    def __init__(self, directory, day):
+        self.name = f"{directory}/rollover-{day}.progress"
+        self.lock = threading.Lock()
+
+        # progress of older runs is not needed anymore
+        for name in os.listdir(directory):
+            if name.startswith("rollover-") and name.endswith(".progress") \
+                    and f"{directory}/{name}" != self.name:
+                os.remove(f"{directory}/{name}")
+
+        try:
+            with open(self.name) as f:
+                self.done = set(f.read().split())
+        except FileNotFoundError:
+            self.done = set()
+
+    def add(self, user):
+        with self.lock, open(self.name, 'a') as f:
+            f.write(f"{user}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.add(user)
+
+
+def rollover(day: str, workers=8, processes=False, progressdir=BOTDIR, rules=None) -> dict:
+    """Moves unfinished tasks from `day` to the next day for every user
+
+    Users are processed by a pool of `workers` threads, or processes
+    when `processes` is set (requires storage locking, as the processes
+    share the storage with the bot). Users finished by an interrupted
+    run for the same `day` are skipped. The occurrences of the
+    `Recurring` rules `rules` are added to `day` before it is closed.
+
+    Returns summary of the run
+    """
+    global recurring
+    if processes and not dbm.cache.locking:
+        raise ValueError("Rollover in processes requires db locking")
+
+    recurring = rules # forked processes inherit it
+
+    nextday = datetime.strftime(datetime.strptime(day, DATEFORMAT) + timedelta(days=1),
+                                DATEFORMAT)
+    progress = Progress(progressdir, day)
+    skipped = len(progress.done)
+    users = [user for user in dbm.cache.storage.users() if user not in progress.done]
+
+    if processes:
+        pool = ProcessPoolExecutor(workers, mp_context=get_context("fork"),
+                                   initializer=_init_process)
+    else:
+        pool = ThreadPoolExecutor(workers, thread_name_prefix="rollover")
+
+    start = time.perf_counter()
+    moved = errors = 0
+    with pool:
+        futures = {pool.submit(rollover_user, user, day, nextday): user
+                   for user in users}
+        for future in as_completed(futures):
+            user = futures[future]
+            try:
+                moved += future.result()
+            except Exception:
+                errors += 1
+                logger.exception("Rollover of %s failed for '%s'", day, user)
+                continue
+            progress.add(user)
+    duration = time.perf_counter() - start
+
+    summary = {"day": day,
+               "users": len(users) - errors,
+               "skipped": skipped,
+               "errors": errors,
+               "moved": moved,
+               "duration": duration,
+               "users_per_sec": (len(users) - errors) / duration if duration else 0}
+    logger.info("Rollover %s -> %s: %s", day, nextday, summary)
+    return summary
+
+
+if __name__ == "__main__":
+    # usage: python rollover.py YYYY-MM-DD [workers]
+    if len(sys.argv) < 2:
+        print("usage: python rollover.py YYYY-MM-DD [workers]")
+        sys.exit(1)
+
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    summary = rollover(sys.argv[1], workers)
+    dbm.cache.flush(wait=True)
+    print(f"{summary['users']} users in {summary['duration']:.2f}s "
+          f"({summary['users_per_sec']:.0f} users/s), {summary['moved']} tasks moved, "
+          f"{summary['skipped']} skipped, {summary['errors']} errors")
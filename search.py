@@ -0,0 +1,105 @@
+import heapq
+import re
+import sys
+from collections import defaultdict
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text) -> set:
+    return {sys.intern(token) for token in TOKEN_RE.findall(text.lower())}
+
+
+class SearchIndex:
+    """Inverted index of one user's task texts, token -> {(day, task)}
+
+    Kept up to date with the `Storage` operations of every change, so a
+    query only touches the postings of its tokens, whatever the size of
+    the history. Task numbers are shifted on delete like in the db.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.docs = {}      # day -> {task: tokens}
+
+    @classmethod
+    def build(cls, db):
+        index = cls()
+        for day in db:
+            for num, task in db[day]['tasks'].items():
+                index.add(day, num, task['text'])
+        return index
+
+    def add(self, day, num, text):
+        day = sys.intern(day)
+        tokens = tokenize(text)
+        self.docs.setdefault(day, {})[num] = tokens
+        for token in tokens:
+            self.postings[token].add((day, num))
+
+    def remove(self, day, num):
+        tokens = self.docs[day].pop(num)
+        self._unpost(day, num, tokens)
+
+    def delete(self, day, num):
+        """Removes task `num` of `day` and moves the later tasks down"""
+        tasks = self.docs.get(day)
+        if not tasks or num not in tasks:
+            return
+        self.remove(day, num)
+        for later in sorted((n for n in tasks if int(n) > int(num)), key=int):
+            tokens = tasks.pop(later)
+            self._unpost(day, later, tokens)
+            moved = str(int(later) - 1)
+            tasks[moved] = tokens
+            for token in tokens:
+                self.postings[token].add((day, moved))
+
+    def delete_day(self, day):
+        for num, tokens in self.docs.pop(day, {}).items():
+            self._unpost(day, num, tokens)
+
+    def apply(self, ops):
+        """Updates the index with `Storage` operations"""
+        for op in ops:
+            kind = op[0]
+            if kind == "add":
+                for num, task in op[2].items():
+                    self.add(op[1], num, task['text'])
+            elif kind == "delete":
+                if op[2] is None:
+                    self.delete_day(op[1])
+                else:
+                    self.delete(op[1], op[2])
+            elif kind == "edit":
+                if op[2] in self.docs.get(op[1], {}):
+                    self.remove(op[1], op[2])
+                self.add(op[1], op[2], op[3])
+            elif kind == "clear":
+                self.postings.clear()
+                self.docs.clear()
+
+    def search(self, query, limit=None) -> list:
+        """(day, task) of tasks containing every word of `query`, by day
+
+        With `limit` only the tasks of the latest days are returned.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        postings = sorted((self.postings.get(token, set()) for token in tokens), key=len)
+        found = postings[0]
+        for posting in postings[1:]:
+            found = found & posting
+
+        key = lambda hit: (hit[0], int(hit[1]))
+        if limit is not None and len(found) > limit:
+            return heapq.nlargest(limit, found, key=key)[::-1]
+        return sorted(found, key=key)
+
+    def _unpost(self, day, num, tokens):
+        for token in tokens:
+            posting = self.postings[token]
+            posting.discard((day, num))
+            if not posting:
+                del self.postings[token]
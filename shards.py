@@ -0,0 +1,335 @@
+"""Sharded deployment: one webhook front process and N worker processes
+
+The front receives webhook updates and routes every update by a hash of
+its user id to one of the worker processes. A user always lands on the
+same worker, which handles its updates one by one in arrival order and
+owns the user's db in its own shard of the storage (`tododb/shard-N`),
+so no locking between processes is needed.
+
+Changing the number of workers moves users to other shards, run
+`python shards.py reshard <old workers> <new workers>` before restarting
+(0 is the unsharded layout).
+"""
+import json
+import logging
+import os
+import ssl
+import sys
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+
+from archive import make_archive
+from storage import make_storage
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(user_id, workers) -> int:
+    """Worker of `user_id`, stable across processes and restarts"""
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+def user_of(data: dict):
+    """User id of a webhook update, None for updates without a sender"""
+    for value in data.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"].get("id")
+    return None
+
+
+def worker(shard, updates, directory=None, tgbot=None):
+    """Handles the updates of `shard` from the `updates` queue until None
+
+    Runs in a forked process, `bot` is imported here, so it reads the
+    config of `directory` and configures logging and the db for this
+    shard only.
+    """
+    if directory:
+        os.chdir(directory)
+        # the parent may have imported dbmanager in another directory
+        import dbmanager
+        dbmanager.BOTDIR = os.path.abspath(directory)
+
+    import bot as todobot
+    from dates import Timezones
+    from recurring import Recurring
+    from dbmanager import BOTDIR
+    from logsetup import setup_logging
+    from telegram import Bot, Update
+    from telegram.ext import Dispatcher, JobQueue
+
+    # every shard writes its own log files
+    todobot.log_listener.stop()
+    log_config = dict(todobot.log_config)
+    log_config.setdefault("db", "db.log")
+    for key in ("debug", "filename", "db"):
+        if log_config.get(key):
+            log_config[key] = f"{log_config[key]}.shard-{shard}"
+    listener = setup_logging(log_config)
+
+    todobot.dbm.cache.configure(storage=make_storage(todobot.db_config, BOTDIR, shard),
+                                archive=make_archive(todobot.config.get("archive"), BOTDIR, shard))
+    todobot.timezones = Timezones(f"{BOTDIR}/timezones.shard-{shard}.json",
+                                  todobot.config.get("timezone"))
+    todobot.recurring = Recurring(f"{BOTDIR}/recurring/shard-{shard}",
+                                  todobot.recurring.horizon)
+
+    tgbot = tgbot or Bot(todobot.config["auth"]["token"])
+    jobq = JobQueue(tgbot)
+    dispatcher = Dispatcher(tgbot, None, job_queue=jobq)
+    todobot.setup(dispatcher, jobq, tgbot, shard=shard)
+    jobq.start()
+    logger.info("Shard %s started", shard)
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        try:
+            dispatcher.process_update(Update.de_json(data, tgbot))
+        except Exception:
+            logger.exception("Update %s failed in shard %s", data.get('update_id'), shard)
+
+    jobq.stop()
+    todobot.shutdown()
+    logger.info("Shard %s stopped", shard)
+    listener.stop()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive for telegram's connections
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.strip("/") != self.server.front.path:
+            self._respond(404)
+            return
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self._respond(400)
+            return
+        self.server.front.route(data)
+        self._respond(200)
+
+    def _respond(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class Front:
+    """Webhook server routing updates to `workers` worker processes
+
+    `con` is the "con" section of config.json. Workers are forked with
+    `directory` as working directory and `tgbot` instead of a
+    `telegram.Bot`, both for testing.
+    """
+
+    def __init__(self, con, workers=4, directory=None, tgbot=None):
+        self.con = con
+        self.path = (con.get("path") or "").strip("/")
+        self.workers = workers
+        self.directory = directory
+        self.tgbot = tgbot
+        self.queues = []
+        self.processes = []
+        self.server = None
+        self.lock = threading.Lock()
+        self.routed = [0] * workers
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        ctx = get_context("fork")
+        for shard in range(self.workers):
+            updates = ctx.Queue()
+            process = ctx.Process(target=worker, name=f"shard-{shard}",
+                                  args=(shard, updates, self.directory, self.tgbot))
+            process.start()
+            self.queues.append(updates)
+            self.processes.append(process)
+
+        self.server = ThreadingHTTPServer((self.con.get("listen", "0.0.0.0"),
+                                           self.con.get("port", 0)), WebhookHandler)
+        self.server.front = self
+        if self.con.get("key") and self.con.get("cert"):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.con["cert"], self.con["key"])
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        threading.Thread(target=self.server.serve_forever, name="webhook",
+                         daemon=True).start()
+        logger.info("Webhook front on port %s with %s workers", self.port, self.workers)
+
+    def route(self, data):
+        user = user_of(data)
+        shard = shard_of(user, self.workers) if user is not None else 0
+        with self.lock: # queue order is the order updates arrived in
+            self.routed[shard] += 1
+            self.queues[shard].put(data)
+
+    def stop(self):
+        """Stops receiving, lets the workers finish their queues and waits"""
+        self.server.shutdown()
+        self.server.server_close()
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join()
+        logger.info("Webhook front stopped, routed %s", self.routed)
+
+
+def run(config, workers):
+    """Runs the sharded webhook deployment until interrupted"""
+    from telegram import Bot
+
+    con = config.get("con")
+    front = Front(con, workers)
+    front.start()
+
+    # telegram sends the updates to the front from now on
+    bot = Bot(config["auth"]["token"])
+    if con.get("cert"):
+        with open(con["cert"], "rb") as certificate:
+            bot.set_webhook(url=con.get("url"), certificate=certificate)
+    else:
+        bot.set_webhook(url=con.get("url"))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        front.stop()
+
+
+def reshard(db_config, botdir, old, new, archive_config=None) -> int:
+    """Moves users, timezones, reminders, recurring rules and archives from `old` to `new` shards
+
+    0 is the unsharded layout.
+
+    Returns number of moved users
+    """
+    def storage(shard, workers):
+        return make_storage(db_config, botdir, shard if workers else None)
+
+    def timezones(shard, workers):
+        if not workers:
+            return f"{botdir}/timezones.json"
+        return f"{botdir}/timezones.shard-{shard}.json"
+
+    def reminders(shard, workers):
+        if not workers:
+            return f"{botdir}/reminders.idx"
+        return f"{botdir}/reminders.shard-{shard}.idx"
+
+    def target_of(user):
+        return shard_of(user, new) if new else 0
+
+    zones = {}
+    for shard in range(max(old, 1)):
+        try:
+            with open(timezones(shard, old)) as f:
+                zones.update(json.load(f))
+        except FileNotFoundError:
+            pass
+
+    moved = 0
+    targets = [storage(shard, new) for shard in range(max(new, 1))]
+    for shard in range(max(old, 1)):
+        source = storage(shard, old)
+        for user in source.users():
+            if not old and user.startswith("shard-"): # DayStorage lists shard dirs
+                continue
+            if old and new and target_of(user) == shard:
+                continue
+            db = dict(source.load(user))
+            if not db: # left behind by an earlier reshard
+                continue
+            targets[target_of(user)].store(user, db)
+            source.store(user, {})
+            moved += 1
+
+    for shard in range(max(new, 1)):
+        shard_zones = {user: zone for user, zone in zones.items()
+                       if target_of(user) == shard}
+        with open(timezones(shard, new), "w") as f:
+            json.dump(shard_zones, f, indent=2)
+
+    # index lines are "due user day", each shard's scheduler fires its own users
+    entries = [[] for _ in range(max(new, 1))]
+    for shard in range(max(old, 1)):
+        try:
+            with open(reminders(shard, old)) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 3: # torn write of the last record
+                        entries[target_of(fields[1])].append(" ".join(fields) + "\n")
+        except FileNotFoundError:
+            pass
+    for shard in range(max(new, 1)):
+        with open(reminders(shard, new), "w") as f:
+            f.writelines(entries[shard])
+
+    def rules(shard, workers):
+        return f"{botdir}/recurring/shard-{shard}" if workers else f"{botdir}/recurring"
+
+    for shard in range(max(old, 1)):
+        source = rules(shard, old)
+        if not os.path.isdir(source):
+            continue
+        for name in os.listdir(source):
+            if not name.endswith(".json"):
+                continue
+            target = rules(target_of(name[:-5]), new)
+            if target != source:
+                os.makedirs(target, exist_ok=True)
+                os.replace(f"{source}/{name}", f"{target}/{name}")
+
+    if archive_config is not None:
+        archives = [make_archive(archive_config, botdir, shard if new else None)
+                    for shard in range(max(new, 1))]
+        for shard in range(max(old, 1)):
+            source = make_archive(archive_config, botdir, shard if old else None)
+            for user in source.users():
+                target = archives[target_of(user)]
+                if target.directory == source.directory:
+                    continue
+                # records are self-contained, so archives can be concatenated
+                with open(source.path(user), "rb") as f, open(target.path(user), "ab") as out:
+                    out.write(f.read())
+                    out.flush()
+                    os.fsync(out.fileno())
+                os.remove(source.path(user))
+            for target in archives:
+                target.advance(source.before)
+
+    def files(workers):
+        return {layout(shard, workers) for layout in (timezones, reminders)
+                for shard in range(max(workers, 1))}
+
+    for name in files(old) - files(new):
+        if os.path.exists(name):
+            os.remove(name)
+    return moved
+
+
+if __name__ == "__main__":
+    # usage: python shards.py reshard <old workers> <new workers>
+    if len(sys.argv) != 4 or sys.argv[1] != "reshard":
+        print("usage: python shards.py reshard <old workers> <new workers>")
+        sys.exit(1)
+
+    from dbmanager import BOTDIR
+    with open("config.json") as f:
+        config = json.load(f)
+    moved = reshard(config.get("db", {}), BOTDIR, int(sys.argv[2]), int(sys.argv[3]),
+                    config.get("archive"))
+    print(f"Moved {moved} users")
@@ -0,0 +1,804 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import zlib
+from bisect import bisect_left
+from collections.abc import MutableMapping
+from os import listdir, path
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Storage:
+    """Storage backend interface used by `DBManager`
+
+    `store` receives the full in-memory db together with the list of
+    operations applied to it since the last store. Backends may write
+    the whole db or only apply the operations. `ops=None` means the
+    stored db has to be replaced completely.
+
+    Operations:
+      ("add", day, {"1": {"text": ..., "done": 0}, ...})
+      ("delete", day, task)     // task None deletes whole day
+      ("edit", day, task, text)
+      ("done", day, task, done)
+      ("due", day, task, due)   // reminder unix time, None removes it
+      ("clear",)
+    """
+
+    def load(self, user) -> dict:
+        raise NotImplementedError
+
+    def store(self, user, db: dict, ops: list = None):
+        raise NotImplementedError
+
+    def users(self) -> list:
+        raise NotImplementedError
+
+    def lockpath(self, user) -> str:
+        raise NotImplementedError
+
+    def lock(self, user):
+        """Advisory lock of `user` shared with other processes"""
+        return FileLock(self.lockpath(user))
+
+
+class FileLock:
+    """Exclusive `flock` on a lock file, usable as context manager"""
+
+    def __init__(self, name):
+        self.name = name
+        self.fd = None
+
+    def acquire(self):
+        self.fd = os.open(self.name, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *a):
+        self.release()
+
+
+class JSONStorage(Storage):
+    """One json file per user, rewritten on every store"""
+
+    def __init__(self, directory, durability="file"):
+        self.directory = directory
+        self.durability = durability
+
+    def path(self, user):
+        return f"{self.directory}/{user}.json"
+
+    def lockpath(self, user):
+        return f"{self.directory}/{user}.lock"
+
+    def load(self, user):
+        """Load db from file, create it if doesn't exist"""
+        name = self.path(user)
+        try:
+            with open(name) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            with open(name, 'w') as f:
+                json.dump({}, f)
+            return {}
+
+    def store(self, user, db, ops=None):
+        data = json.dumps(db, indent=2).encode()
+        write_file(self.path(user), data, self.durability)
+
+    def users(self):
+        return [name[:-5] for name in sorted(listdir(self.directory))
+                if name.endswith(".json")]
+
+
+class JournalStorage(JSONStorage):
+    """Json snapshot per user plus an append-only operation log
+
+    Every store appends the operations to `<user>.log`, one json record
+    per line. Loading replays the log on top of `<user>.json`. Once the
+    log grows past `compact_size` bytes it is folded into a new snapshot.
+
+    The first log record holds the crc32 of the snapshot it applies to,
+    so a log left behind by a crash during compaction is recognised as
+    already included in the snapshot and dropped.
+    """
+
+    def __init__(self, directory, compact_size=64 * 1024, durability="file"):
+        super().__init__(directory, durability)
+        self.compact_size = compact_size
+
+    def logpath(self, user):
+        return f"{self.directory}/{user}.log"
+
+    def load(self, user):
+        try:
+            with open(self.path(user), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        db = json.loads(data) if data else {}
+
+        try:
+            with open(self.logpath(user), 'rb') as f:
+                log = f.read()
+        except FileNotFoundError:
+            return db
+
+        end = log.find(b"\n") + 1
+        if not end or json.loads(log[:end]).get("crc") != zlib.crc32(data):
+            logger.debug("Dropping stale log of %s", user)
+            return db
+
+        while end < len(log):
+            stop = log.find(b"\n", end) + 1
+            try:
+                if not stop:
+                    raise ValueError("record without newline")
+                op = json.loads(log[end:stop])
+            except ValueError: # torn write of the last record
+                logger.error("Truncating damaged log of %s after %d bytes", user, end)
+                self.truncate(user, end)
+                break
+            apply_op(db, op)
+            end = stop
+        return db
+
+    def truncate(self, user, size):
+        """Cuts the log back to `size` bytes, so new records don't follow a torn one"""
+        with open(self.logpath(user), 'r+b') as f:
+            f.truncate(size)
+            if self.durability != "none":
+                os.fsync(f.fileno())
+
+    def store(self, user, db, ops=None):
+        logfile = self.logpath(user)
+        if ops is None or not path.exists(logfile):
+            self.compact(user, db)
+            return
+
+        records = "".join(json.dumps(op) + "\n" for op in ops).encode()
+        with open(logfile, 'ab') as f:
+            f.write(records)
+            size = f.tell()
+            if self.durability != "none":
+                f.flush()
+                os.fsync(f.fileno())
+
+        metrics.inc("db_bytes_written_total", len(records))
+        if size > self.compact_size:
+            self.compact(user, db)
+
+    def compact(self, user, db):
+        """Writes `db` as the new snapshot and starts an empty log"""
+        data = json.dumps(db).encode()
+        write_file(self.path(user), data, self.durability)
+        header = json.dumps({"crc": zlib.crc32(data)}) + "\n"
+        write_file(self.logpath(user), header.encode(), self.durability)
+        logger.debug("Compacted log of %s", user)
+
+    def users(self):
+        names = {name.rsplit(".", 1)[0] for name in listdir(self.directory)
+                 if name.endswith((".json", ".log"))}
+        return sorted(names)
+
+
+class LazyDays(MutableMapping):
+    """User db of `DayStorage`, days are read from disk on first access
+
+    The directory is only listed when all days are needed (iteration,
+    `len`), looking up a single day opens just that day's file.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.loaded = {}        # day -> data read or written in memory
+        self.deleted = set()    # days deleted in memory, maybe still on disk
+        self.listing = None     # all days, listed on demand
+        self.cleared = False    # nothing on disk belongs to the db anymore
+
+    def path(self, day):
+        return f"{self.directory}/{day}.json"
+
+    def __getitem__(self, day):
+        if day in self.loaded:
+            return self.loaded[day]
+        if self.cleared or day in self.deleted:
+            raise KeyError(day)
+        try:
+            with open(self.path(day)) as f:
+                data = self.loaded[day] = json.load(f)
+        except FileNotFoundError:
+            raise KeyError(day) from None
+        return data
+
+    def __contains__(self, day):
+        if day in self.loaded:
+            return True
+        if self.cleared or day in self.deleted:
+            return False
+        if self.listing is not None:
+            return day in self.listing
+        return path.exists(self.path(day))
+
+    def __setitem__(self, day, data):
+        self.loaded[day] = data
+        self.deleted.discard(day)
+        if self.listing is not None:
+            self.listing.add(day)
+
+    def __delitem__(self, day):
+        if day not in self:
+            raise KeyError(day)
+        self.loaded.pop(day, None)
+        self.deleted.add(day)
+        if self.listing is not None:
+            self.listing.discard(day)
+
+    def __iter__(self):
+        return iter(list(self._days()))
+
+    def __len__(self):
+        return len(self._days())
+
+    def clear(self):
+        self.loaded = {}
+        self.deleted = set()
+        self.listing = set()
+        self.cleared = True
+
+    def _days(self):
+        if self.listing is None:
+            try:
+                names = listdir(self.directory)
+            except FileNotFoundError:
+                names = []
+            self.listing = {name[:-5] for name in names if name.endswith(".json")}
+            self.listing -= self.deleted
+            self.listing |= self.loaded.keys()
+        return self.listing
+
+
+class DayStorage(Storage):
+    """Directory per user with one json file per day
+
+    Loading returns a `LazyDays`, so commands touching one day never
+    read the rest of the history. Stores rewrite only the changed days.
+    """
+
+    def __init__(self, directory, durability="file"):
+        self.directory = directory
+        self.durability = durability
+
+    def path(self, user):
+        return f"{self.directory}/{user}"
+
+    def lockpath(self, user):
+        return f"{self.directory}/{user}.lock"
+
+    def load(self, user):
+        return LazyDays(self.path(user))
+
+    def store(self, user, db, ops=None):
+        userdir = self.path(user)
+        os.makedirs(userdir, exist_ok=True)
+
+        if ops is None:
+            ops = [("clear",)] + [("add", day, None) for day in db]
+
+        changed = {}
+        for op in ops:
+            if op[0] == "clear":
+                for name in listdir(userdir):
+                    if name.endswith(".json"):
+                        os.remove(f"{userdir}/{name}")
+                changed = {}
+            elif op[0] == "delete" and op[2] is None:
+                changed[op[1]] = False
+            else:
+                changed[op[1]] = True
+
+        for day, present in changed.items():
+            name = f"{userdir}/{day}.json"
+            if present and day in db:
+                write_file(name, json.dumps(db[day]).encode(), self.durability)
+            elif path.exists(name):
+                os.remove(name)
+
+    def users(self):
+        return sorted(name for name in listdir(self.directory)
+                      if path.isdir(f"{self.directory}/{name}"))
+
+
+class PackedDays(MutableMapping):
+    """User db of `BinaryStorage`, days are decoded from the mmap on access"""
+
+    def __init__(self, data=None, index=None):
+        self.data = data        # mmap of the snapshot
+        self.index = index or {}    # day -> (offset, length) of undecoded days
+        self.loaded = {}
+
+    def __getitem__(self, day):
+        if day in self.loaded:
+            return self.loaded[day]
+        offset, length = self.index[day]
+        data = self.loaded[day] = decode_day(self.data[offset:offset + length])
+        del self.index[day]
+        return data
+
+    def __contains__(self, day):
+        return day in self.loaded or day in self.index
+
+    def __setitem__(self, day, data):
+        self.index.pop(day, None)
+        self.loaded[day] = data
+
+    def __delitem__(self, day):
+        if day not in self:
+            raise KeyError(day)
+        self.index.pop(day, None)
+        self.loaded.pop(day, None)
+
+    def __iter__(self):
+        return iter(list(self.loaded) + list(self.index))
+
+    def __len__(self):
+        return len(self.loaded) + len(self.index)
+
+    def clear(self):
+        self.index = {}
+        self.loaded = {}
+
+    def raw(self, day):
+        """Undecoded record of `day`, None once it is decoded"""
+        if day not in self.index:
+            return None
+        offset, length = self.index[day]
+        return self.data[offset:offset + length]
+
+
+# binary snapshot, all integers little endian:
+#   header  "TDB" version:u8 days:u32 keys length:u32
+#   keys    day keys, utf-8 joined by newlines
+#   offsets days + 1 u32 record boundaries, relative to the first record
+#   records per day: flags:u8 count:u32 done bits, [numbers u32...], texts
+#           text: length:u16 utf-8, flags 2 is a json day that doesn't pack
+SNAPSHOT_MAGIC = b"TDB"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<3sBII")
+DAY_HEADER = struct.Struct("<BI")
+TEXT_LENGTH = struct.Struct("<H")
+
+SEQUENTIAL, NUMBERED, JSON_DAY = 0, 1, 2
+
+
+def _packable(data) -> bool:
+    if data.keys() != {"tasks"}:
+        return False
+    for num, task in data["tasks"].items():
+        if task.keys() != {"text", "done"} or task["done"] not in (0, 1) \
+                or not num.isdigit() or len(task["text"].encode()) > 0xFFFF:
+            return False
+    return True
+
+
+def encode_day(data) -> bytes:
+    if not _packable(data):
+        return DAY_HEADER.pack(JSON_DAY, 0) + json.dumps(data).encode()
+
+    tasks = data["tasks"]
+    numbers = list(tasks)
+    sequential = numbers == [str(n) for n in range(1, len(numbers) + 1)]
+    done = bytearray((len(tasks) + 7) // 8)
+    for i, task in enumerate(tasks.values()):
+        if task["done"]:
+            done[i // 8] |= 1 << (i % 8)
+
+    parts = [DAY_HEADER.pack(SEQUENTIAL if sequential else NUMBERED, len(tasks)), done]
+    if not sequential:
+        parts.append(struct.pack(f"<{len(numbers)}I", *map(int, numbers)))
+    for task in tasks.values():
+        text = task["text"].encode()
+        parts.append(TEXT_LENGTH.pack(len(text)))
+        parts.append(text)
+    return b"".join(parts)
+
+
+def decode_day(record: bytes) -> dict:
+    flags, count = DAY_HEADER.unpack_from(record)
+    pos = DAY_HEADER.size
+    if flags == JSON_DAY:
+        return json.loads(record[pos:])
+
+    done = record[pos:pos + (count + 7) // 8]
+    pos += len(done)
+    if flags == NUMBERED:
+        numbers = [str(n) for n in struct.unpack_from(f"<{count}I", record, pos)]
+        pos += 4 * count
+    else:
+        numbers = [str(n) for n in range(1, count + 1)]
+
+    tasks = {}
+    for i, num in enumerate(numbers):
+        length, = TEXT_LENGTH.unpack_from(record, pos)
+        pos += TEXT_LENGTH.size
+        tasks[num] = {"text": record[pos:pos + length].decode(),
+                      "done": done[i // 8] >> (i % 8) & 1}
+        pos += length
+    return {"tasks": tasks}
+
+
+def encode_snapshot(db) -> bytes:
+    """Binary snapshot of a whole user db, see `BinaryStorage`
+
+    Days of a `PackedDays` that were never decoded are copied as they are.
+    """
+    days = list(db)
+    if any("\n" in day for day in days):
+        raise ValueError("Day keys can't contain newlines")
+    keys = "\n".join(days).encode()
+    raw = db.raw if isinstance(db, PackedDays) else lambda day: None
+    records = [raw(day) or encode_day(db[day]) for day in days]
+
+    offsets = [0]
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    return b"".join([SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(days), len(keys)),
+                     keys, struct.pack(f"<{len(offsets)}I", *offsets)] + records)
+
+
+def read_snapshot(data) -> PackedDays:
+    """`PackedDays` over snapshot `data` (bytes or mmap), reads only the index"""
+    magic, version, count, length = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"Not a version {SNAPSHOT_VERSION} snapshot")
+
+    pos = SNAPSHOT_HEADER.size
+    days = data[pos:pos + length].decode().split("\n") if count else []
+    pos += length
+    offsets = struct.unpack_from(f"<{count + 1}I", data, pos)
+    base = pos + 4 * (count + 1)
+    index = {day: (base + offsets[i], offsets[i + 1] - offsets[i])
+             for i, day in enumerate(days)}
+    return PackedDays(data, index)
+
+
+class BinaryStorage(Storage):
+    """One compact binary snapshot per user, `<user>.tdb`
+
+    Tasks are length-prefixed texts with the done flags packed into
+    bits and the numbers 1..n implied. The file is mapped with `mmap`,
+    loading reads only the day index and days are decoded on first
+    access. Stores rewrite the whole snapshot, copying the records of
+    days that weren't decoded.
+    """
+
+    def __init__(self, directory, durability="file"):
+        self.directory = directory
+        self.durability = durability
+
+    def path(self, user):
+        return f"{self.directory}/{user}.tdb"
+
+    def lockpath(self, user):
+        return f"{self.directory}/{user}.lock"
+
+    def load(self, user):
+        try:
+            with open(self.path(user), 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return PackedDays()
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return PackedDays()
+        return read_snapshot(data)
+
+    def store(self, user, db, ops=None):
+        write_file(self.path(user), encode_snapshot(db), self.durability)
+
+    def users(self):
+        return [name[:-4] for name in sorted(listdir(self.directory))
+                if name.endswith(".tdb")]
+
+
+class SQLiteStorage(Storage):
+    """All users in one sqlite database, one row per task
+
+    Days are listed in their own table too, so days without tasks load
+    like with the other backends.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        user_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        task_no INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        due INTEGER,
+        rule TEXT
+    );
+    CREATE INDEX IF NOT EXISTS tasks_user_day_task
+        ON tasks (user_id, day, task_no);
+    CREATE TABLE IF NOT EXISTS days (
+        user_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        PRIMARY KEY (user_id, day)
+    );
+    """
+
+    SYNCHRONOUS = {"none": "OFF", "file": "NORMAL", "dir": "FULL"}
+
+    def __init__(self, filename, durability="file"):
+        self.filename = filename
+        self.mutex = threading.Lock()
+        self.con = sqlite3.connect(filename, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(f"PRAGMA synchronous={self.SYNCHRONOUS[durability]}")
+        tables = {row[0] for row in self.con.execute("SELECT name FROM sqlite_master")}
+        self.con.executescript(self.SCHEMA)
+        if "tasks" in tables and "days" not in tables: # created before empty days were kept
+            with self.con:
+                self.con.execute("INSERT OR IGNORE INTO days SELECT DISTINCT user_id, day FROM tasks")
+
+        # databases created before reminders and recurring tasks
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(tasks)")]
+        if "due" not in columns:
+            self.con.execute("ALTER TABLE tasks ADD COLUMN due INTEGER")
+        if "rule" not in columns:
+            self.con.execute("ALTER TABLE tasks ADD COLUMN rule TEXT")
+
+    def lockpath(self, user):
+        return f"{self.filename}.{user}.lock"
+
+    def load(self, user):
+        db = {}
+        with self.mutex:
+            for day, in self.con.execute(
+                    "SELECT day FROM days WHERE user_id = ? ORDER BY day", (str(user),)):
+                db[day] = {"tasks": {}}
+            rows = self.con.execute(
+                "SELECT day, task_no, text, done, due, rule FROM tasks "
+                "WHERE user_id = ? ORDER BY day, task_no", (str(user),))
+            for day, num, text, done, due, rule in rows:
+                tasks = db.setdefault(day, {"tasks": {}})["tasks"]
+                tasks[str(num)] = {"text": text, "done": done}
+                if due is not None:
+                    tasks[str(num)]["due"] = due
+                if rule is not None:
+                    tasks[str(num)]["rule"] = rule
+        return db
+
+    def store(self, user, db, ops=None):
+        user = str(user)
+        with self.mutex, self.con:
+            if ops is None:
+                self._replace(user, db)
+                return
+            for op in ops:
+                getattr(self, f"_{op[0]}")(user, *op[1:])
+
+    def users(self):
+        with self.mutex:
+            rows = self.con.execute(
+                "SELECT user_id FROM days UNION SELECT user_id FROM tasks ORDER BY user_id")
+            return [user for user, in rows]
+
+    def _replace(self, user, db):
+        self._clear(user)
+        self.con.executemany("INSERT INTO days (user_id, day) VALUES (?, ?)",
+                             [(user, day) for day in db])
+        self.con.executemany(
+            "INSERT INTO tasks (user_id, day, task_no, text, done, due, rule) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(user, day, int(num), task["text"], task["done"], task.get("due"), task.get("rule"))
+             for day, data in db.items()
+             for num, task in data["tasks"].items()])
+
+    def _add(self, user, day, tasks):
+        self.con.execute("INSERT OR IGNORE INTO days (user_id, day) VALUES (?, ?)",
+                         (user, day))
+        self.con.executemany(
+            "INSERT INTO tasks (user_id, day, task_no, text, done, due, rule) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(user, day, int(num), task["text"], task["done"], task.get("due"), task.get("rule"))
+             for num, task in tasks.items()])
+
+    def _delete(self, user, day, task):
+        if task is None:
+            self.con.execute(
+                "DELETE FROM tasks WHERE user_id = ? AND day = ?",
+                (user, day))
+            self.con.execute(
+                "DELETE FROM days WHERE user_id = ? AND day = ?",
+                (user, day))
+            return
+        self.con.execute(
+            "DELETE FROM tasks WHERE user_id = ? AND day = ? AND task_no = ?",
+            (user, day, int(task)))
+        # keep numbering continuous, same as DBManager.delete
+        self.con.execute(
+            "UPDATE tasks SET task_no = task_no - 1 "
+            "WHERE user_id = ? AND day = ? AND task_no > ?",
+            (user, day, int(task)))
+
+    def _edit(self, user, day, task, text):
+        self.con.execute(
+            "UPDATE tasks SET text = ? "
+            "WHERE user_id = ? AND day = ? AND task_no = ?",
+            (text, user, day, int(task)))
+
+    def _done(self, user, day, task, done):
+        self.con.execute(
+            "UPDATE tasks SET done = ? "
+            "WHERE user_id = ? AND day = ? AND task_no = ?",
+            (done, user, day, int(task)))
+
+    def _due(self, user, day, task, due):
+        self.con.execute(
+            "UPDATE tasks SET due = ? "
+            "WHERE user_id = ? AND day = ? AND task_no = ?",
+            (due, user, day, int(task)))
+
+    def _clear(self, user):
+        self.con.execute("DELETE FROM tasks WHERE user_id = ?", (user,))
+        self.con.execute("DELETE FROM days WHERE user_id = ?", (user,))
+
+
+def write_file(name, data: bytes, durability="file"):
+    """Replaces `name` with `data` without leaving a partial file behind
+
+    durability:
+      none - rely on the OS to write the data back eventually
+      file - fsync the new file before renaming it over `name`
+      dir  - also fsync the directory so the rename itself is durable
+    """
+    tmp = f"{name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if durability != "none":
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, name)
+    metrics.inc("db_bytes_written_total", len(data))
+
+    if durability == "dir":
+        fd = os.open(path.dirname(path.abspath(name)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def remove_tasks(tasks: dict, numbers):
+    """Removes `numbers` from a day's tasks and renumbers the rest once
+
+    Every later task moves down by the number of removed tasks before
+    it, like the SQL backend does, so only the tasks after the lowest
+    removed number are moved and gaps of hand-edited dbs are kept.
+    Removing the last task doesn't move anything.
+    """
+    removed = sorted({int(num) for num in numbers})
+    later = sorted(num for num in map(int, tasks) if num >= removed[0])
+    moved = [(num, tasks.pop(str(num))) for num in later]
+    for num, task in moved:
+        shift = bisect_left(removed, num)
+        if shift == len(removed) or removed[shift] != num:
+            tasks[str(num - shift)] = task
+
+
+def apply_op(db: dict, op):
+    """Applies one `Storage` operation to an in-memory db"""
+    kind, args = op[0], op[1:]
+
+    if kind == "add":
+        day, tasks = args
+        db.setdefault(day, {"tasks": {}})["tasks"].update(tasks)
+    elif kind == "delete":
+        day, task = args
+        if task is None:
+            db.pop(day, None)
+            return
+        remove_tasks(db[day]["tasks"], [task])
+    elif kind == "edit":
+        day, task, text = args
+        db[day]["tasks"][task]["text"] = text
+    elif kind == "done":
+        day, task, done = args
+        db[day]["tasks"][task]["done"] = done
+    elif kind == "due":
+        day, task, due = args
+        if due is None:
+            db[day]["tasks"][task].pop("due", None)
+        else:
+            db[day]["tasks"][task]["due"] = due
+    elif kind == "clear":
+        db.clear()
+    else:
+        raise ValueError(f"Unknown operation '{kind}'")
+
+
+def make_storage(db_config: dict, botdir: str, shard=None) -> Storage:
+    """Creates storage backend from `db` section of config.json
+
+    `shard` selects the part of the storage owned by one worker of the
+    sharded mode, a subdirectory or a separate sqlite file.
+    """
+    backend = db_config.get("backend", "json")
+    durability = db_config.get("durability", "file")
+    if durability not in ("none", "file", "dir"):
+        raise ValueError(f"Unknown durability level '{durability}'")
+
+    if backend == "sqlite":
+        filename = db_config.get("path", f"{botdir}/tododb.sqlite")
+        if shard is not None:
+            root, ext = path.splitext(filename)
+            filename = f"{root}.shard-{shard}{ext}"
+        return SQLiteStorage(filename, durability)
+
+    directory = db_config.get("path", f"{botdir}/tododb")
+    if shard is not None:
+        directory = f"{directory}/shard-{shard}"
+        os.makedirs(directory, exist_ok=True)
+
+    if backend == "json":
+        return JSONStorage(directory, durability)
+    if backend == "journal":
+        return JournalStorage(directory, db_config.get("compact_size", 64 * 1024),
+                              durability)
+    if backend == "days":
+        return DayStorage(directory, durability)
+    if backend == "binary":
+        return BinaryStorage(directory, durability)
+    raise ValueError(f"Unknown storage backend '{backend}'")
+
+
+def migrate(source: Storage, target: Storage) -> int:
+    """Copies every user database from `source` to `target`"""
+    count = 0
+    for user in source.users():
+        target.store(user, dict(source.load(user)))
+        count += 1
+        logger.debug("Migrated user %s", user)
+    return count
+
+
+if __name__ == "__main__":
+    # usage: python storage.py [backend:]<source> [backend:]<target>
+    # e.g.   python storage.py tododb/ tododb.sqlite
+    #        python storage.py json:tododb/ binary:tododb-binary/
+    if len(sys.argv) != 3:
+        print("usage: python storage.py [backend:]<source> [backend:]<target>")
+        print("backends: json (default source), journal, days, binary, "
+              "sqlite (default target)")
+        sys.exit(1)
+
+    def open_storage(arg, backend):
+        if ":" in arg:
+            backend, arg = arg.split(":", 1)
+        if backend != "sqlite" and not path.isdir(arg):
+            print(f"{arg} is not a directory")
+            sys.exit(1)
+        return make_storage({"backend": backend, "path": arg}, "")
+
+    source = open_storage(sys.argv[1], "json")
+    target = open_storage(sys.argv[2], "sqlite")
+    count = migrate(source, target)
+    print(f"Imported {count} users into {sys.argv[2]}")